@@ -131,7 +131,7 @@ while (( "$#" )); do
 
     if [ "$1" = "index" ]; then
         echo "*** Indexing site content"
-        $PYTHON $DJANGO_ADMIN rebuild_index --noinput --settings=$DJANGO_SETTINGS_MODULE
+        $PYTHON $DJANGO_ADMIN build_index --settings=$DJANGO_SETTINGS_MODULE
     fi
 
     if [ "$1" = "update_index" ]; then
@@ -1,6 +1,9 @@
 from .models import Award, AwardDef, Badge
+from .models import POST_VOTES, VIEWS, BOOKMARKS, FOLLOWERS, ACCEPTED, VOTES_CAST, VOTES_RECEIVED, POSTS, PROFILE
 
 from biostar.apps.posts.models import Post, Vote
+from biostar.apps.users.models import Profile
+from django.db.models import Count
 from django.utils.translation import ugettext_lazy as _
 from django.utils.timezone import utc
 from datetime import datetime, timedelta
@@ -10,56 +13,88 @@ def now():
     return datetime.utcnow().replace(tzinfo=utc)
 
 
-def wrap_list(obj, cond):
-    return [obj] if cond else []
+def posts(**kwargs):
+    "The badge is earned for each post of the user that matches the conditions"
+    def targets(user_ids):
+        query = Post.objects.filter(**kwargs)
+        if user_ids is not None:
+            query = query.filter(author__in=user_ids)
+        return query.order_by("id").values_list("author_id", "id")
+    return targets
+
+
+def more_than(query, field, limit):
+    "The badge is earned once by the users that own more rows of the query than the limit"
+    def targets(user_ids):
+        rows = query().order_by()
+        if user_ids is not None:
+            rows = rows.filter(**{"%s__in" % field: user_ids})
+        rows = rows.values(field).annotate(total=Count("id")).filter(total__gt=limit)
+        return [(row[field], None) for row in rows]
+    return targets
+
+
+def autobio(user_ids):
+    profiles = Profile.objects.extra(where=["LENGTH(info) > 80"])
+    if user_ids is not None:
+        profiles = profiles.filter(user__in=user_ids)
+    return [(pk, None) for pk in profiles.values_list("user_id", flat=True)]
+
 
 # Award definitions
 AUTOBIO = AwardDef(
     name=_("Autobiographer"),
     desc=_("has more than 80 characters in the information field of the user's profile"),
-    func=lambda user: wrap_list(user, len(user.profile.info) > 80),
+    targets=autobio,
+    depends=[PROFILE],
     icon="fa fa-bullhorn"
 )
 
 GOOD_QUESTION = AwardDef(
     name=_("Good Question"),
     desc=_("asked a question that was upvoted at least 5 times"),
-    func=lambda user: Post.objects.filter(vote_count__gt=5, author=user, type=Post.QUESTION),
+    targets=posts(vote_count__gt=5, type=Post.QUESTION),
+    depends=[POST_VOTES],
     icon="fa fa-question"
 )
 
 GOOD_ANSWER = AwardDef(
     name=_("Good Answer"),
     desc=_("created an answer that was upvoted at least 5 times"),
-    func=lambda user: Post.objects.filter(vote_count__gt=5, author=user, type=Post.ANSWER),
+    targets=posts(vote_count__gt=5, type=Post.ANSWER),
+    depends=[POST_VOTES],
     icon="fa fa-pencil-square-o"
 )
 
 STUDENT = AwardDef(
     name=_("Student"),
     desc=_("asked a question with at least 3 up-votes"),
-    func=lambda user: Post.objects.filter(vote_count__gt=2, author=user, type=Post.QUESTION),
+    targets=posts(vote_count__gt=2, type=Post.QUESTION),
+    depends=[POST_VOTES],
     icon="fa fa-certificate"
 )
 
 TEACHER = AwardDef(
     name=_("Teacher"),
     desc=_("created an answer with at least 3 up-votes"),
-    func=lambda user: Post.objects.filter(vote_count__gt=2, author=user, type=Post.ANSWER),
+    targets=posts(vote_count__gt=2, type=Post.ANSWER),
+    depends=[POST_VOTES],
     icon="fa fa-smile-o"
 )
 
 COMMENTATOR = AwardDef(
     name=_("Commentator"),
     desc=_("created a comment with at least 3 up-votes"),
-    func=lambda user: Post.objects.filter(vote_count__gt=2, author=user, type=Post.COMMENT),
+    targets=posts(vote_count__gt=2, type=Post.COMMENT),
+    depends=[POST_VOTES],
     icon="fa fa-comment"
 )
 
 CENTURION = AwardDef(
     name=_("Centurion"),
     desc=_("created 100 posts"),
-    func=lambda user: wrap_list(user, Post.objects.filter(author=user).count() > 100),
+    targets=more_than(Post.objects.all, "author", 100),
+    depends=[POSTS],
     icon="fa fa-bolt",
     type=Badge.SILVER,
 )
@@ -67,7 +102,8 @@ CENTURION = AwardDef(
 EPIC_QUESTION = AwardDef(
     name=_("Epic Question"),
     desc=_("created a question with more than 10,000 views"),
-    func=lambda user: Post.objects.filter(author=user, view_count__gt=10000),
+    targets=posts(view_count__gt=10000),
+    depends=[VIEWS],
     icon="fa fa-bullseye",
     type=Badge.GOLD,
 )
@@ -75,7 +111,8 @@ EPIC_QUESTION = AwardDef(
 POPULAR = AwardDef(
     name=_("Popular Question"),
     desc=_("created a question with more than 1,000 views"),
-    func=lambda user: Post.objects.filter(author=user, view_count__gt=1000),
+    targets=posts(view_count__gt=1000),
+    depends=[VIEWS],
     icon="fa fa-eye",
     type=Badge.GOLD,
 )
@@ -83,7 +120,8 @@ POPULAR = AwardDef(
 ORACLE = AwardDef(
     name=_("Oracle"),
     desc=_("created more than 1,000 posts (questions + answers + comments)"),
-    func=lambda user: wrap_list(user, Post.objects.filter(author=user).count() > 1000),
+    targets=more_than(Post.objects.all, "author", 1000),
+    depends=[POSTS],
     icon="fa fa-sun-o",
     type=Badge.GOLD,
 )
@@ -91,7 +129,8 @@ ORACLE = AwardDef(
 PUNDIT = AwardDef(
     name=_("Pundit"),
     desc=_("created a comment with more than 10 votes"),
-    func=lambda user: Post.objects.filter(author=user, type=Post.COMMENT, vote_count__gt=10),
+    targets=posts(type=Post.COMMENT, vote_count__gt=10),
+    depends=[POST_VOTES],
     icon="fa fa-comments-o",
     type=Badge.SILVER,
 )
@@ -99,7 +138,8 @@ PUNDIT = AwardDef(
 GURU = AwardDef(
     name=_("Guru"),
     desc=_("received more than 100 upvotes"),
-    func=lambda user: wrap_list(user, Vote.objects.filter(post__author=user).count() > 100),
+    targets=more_than(Vote.objects.all, "post__author", 100),
+    depends=[VOTES_RECEIVED],
     icon="fa fa-beer",
     type=Badge.SILVER,
 )
@@ -107,7 +147,8 @@ GURU = AwardDef(
 CYLON = AwardDef(
     name=_("Cylon"),
     desc=_("received 1,000 up votes"),
-    func=lambda user: wrap_list(user, Vote.objects.filter(post__author=user).count() > 1000),
+    targets=more_than(Vote.objects.all, "post__author", 1000),
+    depends=[VOTES_RECEIVED],
     icon="fa fa-rocket",
     type=Badge.GOLD,
 )
@@ -115,14 +156,16 @@ CYLON = AwardDef(
 VOTER = AwardDef(
     name=_("Voter"),
     desc=_("voted more than 100 times"),
-    func=lambda user: wrap_list(user, Vote.objects.filter(author=user).count() > 100),
+    targets=more_than(Vote.objects.all, "author", 100),
+    depends=[VOTES_CAST],
     icon="fa fa-thumbs-o-up"
 )
 
 SUPPORTER = AwardDef(
     name=_("Supporter"),
     desc=_("voted at least 25 times"),
-    func=lambda user: wrap_list(user, Vote.objects.filter(author=user).count() > 25),
+    targets=more_than(Vote.objects.all, "author", 25),
+    depends=[VOTES_CAST],
     icon="fa fa-thumbs-up",
     type=Badge.SILVER,
 )
@@ -130,34 +173,37 @@ SUPPORTER = AwardDef(
 SCHOLAR = AwardDef(
     name=_("Scholar"),
     desc=_("created an answer that has been accepted"),
-    func=lambda user: Post.objects.filter(author=user, type=Post.ANSWER, has_accepted=True),
+    targets=posts(type=Post.ANSWER, has_accepted=True),
+    depends=[ACCEPTED],
     icon="fa fa-check-circle-o"
 )
 
 PROPHET = AwardDef(
     name=_("Prophet"),
     desc=_("created a post with more than 20 followers"),
-    func=lambda user: Post.objects.filter(author=user, type__in=Post.TOP_LEVEL, subs_count__gt=20),
+    targets=posts(type__in=Post.TOP_LEVEL, subs_count__gt=20),
+    depends=[FOLLOWERS],
     icon="fa fa-pagelines"
 )
 
 LIBRARIAN = AwardDef(
     name=_("Librarian"),
     desc=_("created a post with more than 10 bookmarks"),
-    func=lambda user: Post.objects.filter(author=user, type__in=Post.TOP_LEVEL, book_count__gt=10),
+    targets=posts(type__in=Post.TOP_LEVEL, book_count__gt=10),
+    depends=[BOOKMARKS],
     icon="fa fa-bookmark-o"
 )
 
-def rising_star(user):
+def rising_star(user_ids):
     # The user joined no more than three months ago
-    cond = now() < user.profile.date_joined + timedelta(weeks=15)
-    cond = cond and Post.objects.filter(author=user).count() > 50
-    return wrap_list(user, cond)
+    recent = lambda: Post.objects.filter(author__profile__date_joined__gt=now() - timedelta(weeks=15))
+    return more_than(recent, "author", 50)(user_ids)
 
 RISING_STAR = AwardDef(
     name=_("Rising Star"),
     desc=_("created 50 posts within first three months of joining"),
-    func=rising_star,
+    targets=rising_star,
+    depends=[POSTS],
     icon="fa fa-star",
     type=Badge.GOLD,
 )
@@ -188,7 +234,8 @@ SINGLE_AWARDS = [
 GREAT_QUESTION = AwardDef(
     name=_("Great Question"),
     desc=_("created a question with more than 5,000 views"),
-    func=lambda user: Post.objects.filter(author=user, view_count__gt=5000),
+    targets=posts(view_count__gt=5000),
+    depends=[VIEWS],
     icon="fa fa-fire",
     type=Badge.SILVER,
 )
@@ -196,7 +243,8 @@ GREAT_QUESTION = AwardDef(
 GOLD_STANDARD = AwardDef(
     name=_("Gold Standard"),
     desc=_("created a post with more than 25 bookmarks"),
-    func=lambda user: Post.objects.filter(author=user, book_count__gt=25),
+    targets=posts(book_count__gt=25),
+    depends=[BOOKMARKS],
     icon="fa fa-bookmark",
     type=Badge.GOLD,
 )
@@ -204,7 +252,8 @@ GOLD_STANDARD = AwardDef(
 APPRECIATED = AwardDef(
     name=_("Appreciated"),
     desc=_("created a post with more than 5 votes"),
-    func=lambda user: Post.objects.filter(author=user, vote_count__gt=4),
+    targets=posts(vote_count__gt=4),
+    depends=[POST_VOTES],
     icon="fa fa-heart",
     type=Badge.SILVER,
 )
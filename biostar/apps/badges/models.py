@@ -49,22 +49,33 @@ class Award(models.Model):
     date = models.DateTimeField()
     context = models.CharField(max_length=1000, default='')
 
+# The counters that the badges depend on.
+POST_VOTES, VIEWS, BOOKMARKS, FOLLOWERS, ACCEPTED = "post-votes", "views", "bookmarks", "followers", "accepted"
+VOTES_CAST, VOTES_RECEIVED, POSTS, PROFILE = "votes-cast", "votes-received", "posts", "profile"
+
+
 class AwardDef(object):
-    def __init__(self, name, desc, func, icon, type=Badge.BRONZE):
+    """
+    A badge and the rule that earns it. The targets function takes a list of user ids,
+    or None for all users, and returns the (user id, post id) pairs that earn the badge,
+    the post id is None for the badges that are earned by the user.
+    A change of a counter in depends triggers a check of the badge for the user.
+    """
+    def __init__(self, name, desc, targets, icon, type=Badge.BRONZE, depends=()):
         self.name = name
         self.desc = desc
-        self.fun = func
+        self.targets = targets
+        self.depends = depends
         self.icon = icon
         self.template = "badge/default.html"
         self.type = type
 
-    def validate(self, *args, **kwargs):
+    def validate(self, user_ids=None):
         try:
-            value = self.fun(*args, **kwargs)
-            return value
+            return list(self.targets(user_ids))
         except Exception, exc:
             logger.error("validator error %s" % exc)
-        return 0
+        return []
 
     def __hash__(self):
         return hash(self.name)
@@ -73,3 +84,11 @@ class AwardDef(object):
         return cmp(self.name, other.name)
 
 
+from django.db.models.signals import post_save
+from biostar.apps.posts.models import Post, Vote
+from biostar.apps.users.models import Profile
+from biostar.apps.badges import triggers
+
+post_save.connect(triggers.vote_added, sender=Vote, dispatch_uid="award-votes")
+post_save.connect(triggers.post_created, sender=Post, dispatch_uid="award-posts")
+post_save.connect(triggers.profile_saved, sender=Profile, dispatch_uid="award-profile")
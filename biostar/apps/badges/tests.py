@@ -1,6 +1,8 @@
+import os, glob, tempfile, shutil
 from django.test import TestCase
 from .models import Award, Badge
 from biostar.apps.users.models import User
+from biostar.apps.messages.models import Message
 
 # Create your tests here.
 
@@ -10,8 +12,15 @@ class AwardTest(TestCase):
     def setUp(self):
         from biostar import awards
         awards.init_awards()
+        self.spool = tempfile.mkdtemp()
+        self.override = self.settings(AWARD_SPOOL_DIR=self.spool)
+        self.override.enable()
         User.objects.create(email=self.email)
 
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.spool)
+
     def test_user_badge(self):
         from biostar import awards
         eq = self.assertEqual
@@ -30,9 +39,130 @@ class AwardTest(TestCase):
         eq(0, award_count())
 
         jane.profile.info = "A" * 1000
-        jane.save()
+        jane.profile.save()
 
         # Check for the autobiographer award.
         awards.create_user_award(jane)
 
         eq(1, award_count())
+
+    def test_award_users(self):
+        "All users are awarded in one pass, the awards are not repeated."
+        from biostar import awards
+        from biostar.apps.posts.models import Post
+        from biostar.apps.badges.award_defs import ALL_AWARDS
+        eq = self.assertEqual
+
+        jane = User.objects.get(email=self.email)
+        john = User.objects.create(email="john@site.com")
+        jane.profile.info = "A" * 100
+        jane.profile.save()
+
+        for step in range(3):
+            post = Post(title="Question %s" % step, author=john, type=Post.QUESTION, content="Hello")
+            post.save()
+        Post.objects.filter(author=john, title__in=["Question 0", "Question 1"]).update(vote_count=3)
+
+        # One query per badge, a few more to read and write the awards and three for the messages.
+        # The url patterns query the site when first loaded, the count does not depend on the order of the tests.
+        import biostar.urls
+        with self.assertNumQueries(len(ALL_AWARDS) + 10 + 3):
+            eq(3, awards.award_users())
+        eq(2, Message.objects.filter(user=john, body__subject__startswith="Congratulations").count())
+
+        eq(["Autobiographer"], [a.badge.name for a in Award.objects.filter(user=jane)])
+        eq(2, Award.objects.filter(user=john, badge__name="Student").count())
+        eq(2, Badge.objects.get(name="Student").count)
+        eq(0, awards.award_users())
+
+        # A new target is awarded once.
+        Post.objects.filter(author=john).update(vote_count=3)
+        eq(1, awards.award_users([john.id]))
+        eq(3, Badge.objects.get(name="Student").count)
+        messages = Message.objects.filter(user=john, body__subject__startswith="Congratulations")
+        eq(3, messages.count())
+        eq(3, len([m for m in messages if "Question" in m.body.text and m.body.author_id == john.id]))
+
+
+class TriggerTest(TestCase):
+
+    def setUp(self):
+        from biostar import awards
+        awards.init_awards()
+        self.spool = tempfile.mkdtemp()
+        self.override = self.settings(AWARD_SPOOL_DIR=self.spool)
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.spool)
+
+    def test_check(self):
+        "The changed counters trigger the checks of the badges that depend on them."
+        from biostar.apps.badges import triggers
+        from biostar.apps.posts.models import Post, Vote
+        eq = self.assertEqual
+
+        jane = User.objects.create(email="jane@site.com")
+        john = User.objects.create(email="john@site.com")
+        post = Post(title="Question", author=john, type=Post.QUESTION, content="Hello")
+        post.save()
+        triggers.check()
+
+        # Votes by several users on the same post are checked once for the author.
+        Post.objects.filter(pk=post.id).update(vote_count=3)
+        for step in range(3):
+            Vote.objects.create(author=jane, post=post, type=Vote.UP)
+        fnames, pairs = triggers.collect()
+        eq(set([(jane.id, "votes-cast"), (john.id, "votes-received"), (john.id, "post-votes")]), pairs)
+
+        # The files of an unfinished check are taken over after the timeout.
+        eq(0, triggers.check())
+        with self.settings(AWARD_CHECK_TIMEOUT=0):
+            # Eleven badges depend on these counters, a few more queries read and write the award and its message.
+            with self.assertNumQueries(11 + 9 + 3):
+                eq(1, triggers.check())
+        eq(["Student"], [a.badge.name for a in Award.objects.filter(user=john)])
+        eq(0, triggers.check())
+
+        # A profile change checks the profile badges only.
+        jane.profile.info = "A" * 100
+        jane.profile.save()
+        eq(1, triggers.check())
+        eq(["Autobiographer"], [a.badge.name for a in Award.objects.filter(user=jane)])
+
+        # A running check holds the lock, the changes wait for the next check.
+        Vote.objects.create(author=john, post=post, type=Vote.UP)
+        eq(True, triggers.add_flag(triggers.LOCK_FLAG, stale=60))
+        eq(0, triggers.check())
+        eq(1, len(glob.glob(os.path.join(self.spool, triggers.SPOOL_PATTERN))))
+        triggers.remove_flag(triggers.LOCK_FLAG)
+        eq(0, triggers.check())
+        eq([], glob.glob(os.path.join(self.spool, "awards-*")))
+
+    def test_award(self):
+        "The award tasks of the users wait for a running check."
+        from biostar import awards
+        from biostar.apps.badges import triggers
+        eq = self.assertEqual
+
+        jane = User.objects.create(email="jane@site.com")
+        jane.profile.info = "A" * 100
+        jane.profile.save()
+        for fname in glob.glob(os.path.join(self.spool, triggers.SPOOL_PATTERN)):
+            os.remove(fname)
+
+        # The users of a task are queued while a check holds the lock.
+        eq(True, triggers.add_flag(triggers.LOCK_FLAG, stale=60))
+        awards.award_batch([jane.id])
+        eq(0, Award.objects.filter(user=jane).count())
+        fnames, pairs = triggers.collect()
+        eq(True, (jane.id, "profile") in pairs)
+        for fname in fnames:
+            os.rename(fname, os.path.join(self.spool, "awards-1.txt"))
+        triggers.remove_flag(triggers.LOCK_FLAG)
+
+        # The next check grants the awards, a task afterwards finds nothing new.
+        eq(1, triggers.check())
+        awards.award_batch([jane.id])
+        eq(["Autobiographer"], [a.badge.name for a in Award.objects.filter(user=jane)])
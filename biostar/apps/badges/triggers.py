@@ -0,0 +1,219 @@
+"""
+Event driven award checks.
+
+Each badge declares the counters it depends on. A vote, a bookmark, a new post,
+a profile save or a flush of the post views appends the changed (user, counter) pairs
+to a spool file for each process and schedules a check after a short delay.
+The check coalesces the queued pairs and runs only the badges that depend on the
+changed counters, for only the users whose counters changed.
+
+One check runs at a time, the lock and the scheduled flag are files in the spool directory.
+The award tasks of the users take the same lock.
+A check renames the spool files to names of its own before reading them.
+"""
+from __future__ import print_function, unicode_literals, absolute_import, division
+import os, glob, time, uuid, logging
+from collections import defaultdict
+from django.conf import settings
+from biostar.apps.posts.models import Vote
+from .models import POST_VOTES, BOOKMARKS, FOLLOWERS, ACCEPTED, VOTES_CAST, VOTES_RECEIVED, POSTS, PROFILE
+
+logger = logging.getLogger(__name__)
+
+SPOOL_PATTERN = "awards-*.txt"
+
+# Exists while a check is scheduled.
+SCHEDULED_FLAG = "scheduled.flag"
+
+# Exists while a check runs.
+LOCK_FLAG = "check.lock"
+
+
+def spool_path():
+    return os.path.join(settings.AWARD_SPOOL_DIR, "awards-%s.txt" % os.getpid())
+
+
+def flag_path(name):
+    return os.path.join(settings.AWARD_SPOOL_DIR, name)
+
+
+def add_flag(name, stale):
+    "Creates the flag unless it exists. A flag older than stale seconds is replaced. Returns True when created."
+    path = flag_path(name)
+    try:
+        if time.time() - os.path.getmtime(path) > stale:
+            os.remove(path)
+    except OSError:
+        pass
+    try:
+        if not os.path.isdir(settings.AWARD_SPOOL_DIR):
+            os.makedirs(settings.AWARD_SPOOL_DIR)
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except OSError:
+        return False
+
+
+def remove_flag(name):
+    try:
+        os.remove(flag_path(name))
+    except OSError:
+        pass
+
+
+def schedule(delay=None):
+    "Schedules a check unless one is scheduled already"
+    from biostar.celery import check_awards
+
+    delay = settings.AWARD_CHECK_DELAY if delay is None else delay
+    if add_flag(SCHEDULED_FLAG, stale=delay + 60):
+        check_awards.apply_async(countdown=delay)
+
+
+def changed(user_ids, *counters):
+    "Queues the checks of the badges that depend on the counters of the users"
+    lines = ["%s %s\n" % (user_id, counter) for user_id in set(user_ids) for counter in counters]
+    if not lines:
+        return
+    try:
+        if not os.path.isdir(settings.AWARD_SPOOL_DIR):
+            os.makedirs(settings.AWARD_SPOOL_DIR)
+        with open(spool_path(), "a") as fp:
+            fp.write("".join(lines).encode("utf-8"))
+    except (IOError, OSError), exc:
+        logger.error("unable to spool award check: %s" % exc)
+        return
+    schedule()
+
+
+def collect():
+    """
+    Renames the spool files to names of this check then parses them.
+    Returns the files and the changed (user, counter) pairs.
+    """
+    token, now = uuid.uuid4().hex, time.time()
+    fnames = []
+    for fname in glob.glob(os.path.join(settings.AWARD_SPOOL_DIR, SPOOL_PATTERN)) + \
+            glob.glob(os.path.join(settings.AWARD_SPOOL_DIR, "*.check")):
+        target = "%s.%s.check" % (fname[:fname.index(".txt") + 4], token)
+        try:
+            # Files of a check that did not finish are taken over after the timeout.
+            if fname.endswith(".check") and now - os.path.getmtime(fname) < settings.AWARD_CHECK_TIMEOUT:
+                continue
+            os.rename(fname, target)
+            # The time of the rename marks the claim.
+            os.utime(target, None)
+            fnames.append(target)
+        except OSError, exc:
+            # Another check has taken the file.
+            logger.error(exc)
+
+    pairs = set()
+    for fname in fnames:
+        try:
+            lines = open(fname).readlines()
+        except IOError, exc:
+            logger.error(exc)
+            continue
+        for line in lines:
+            try:
+                user_id, counter = line.split()
+                pairs.add((int(user_id), counter))
+            except ValueError:
+                logger.error("invalid spool line: %r" % line)
+
+    return fnames, pairs
+
+
+def check():
+    "Runs the queued award checks. Returns the number of new awards."
+    # Changes made from now on wait for the next check.
+    remove_flag(SCHEDULED_FLAG)
+
+    if not add_flag(LOCK_FLAG, stale=settings.AWARD_CHECK_TIMEOUT):
+        # Another check is running, this one waits for the next turn.
+        schedule()
+        return 0
+
+    try:
+        return run()
+    finally:
+        remove_flag(LOCK_FLAG)
+
+
+def award(user_ids):
+    """
+    Checks all badges of the users under the lock of the checks, two grants at the same time
+    would create the same awards twice. While a check runs the users wait for the next check.
+    Returns the number of new awards.
+    """
+    from biostar.awards import award_users
+    from .award_defs import ALL_AWARDS
+
+    if not add_flag(LOCK_FLAG, stale=settings.AWARD_CHECK_TIMEOUT):
+        counters = set(counter for obj in ALL_AWARDS for counter in obj.depends)
+        changed(user_ids, *sorted(counters))
+        return 0
+
+    try:
+        return award_users(user_ids)
+    finally:
+        remove_flag(LOCK_FLAG)
+
+
+def run():
+    from biostar.awards import chunks, grant
+    from .award_defs import ALL_AWARDS
+
+    fnames, pairs = collect()
+
+    users = defaultdict(set)
+    for user_id, counter in pairs:
+        users[counter].add(user_id)
+
+    created = 0
+    for ids in chunks(sorted(set(user_id for user_id, counter in pairs))):
+        ids = set(ids)
+        checks = []
+        for obj in ALL_AWARDS:
+            targets = set()
+            for counter in obj.depends:
+                targets.update(users[counter] & ids)
+            if targets:
+                checks.append((obj, sorted(targets)))
+        created += grant(checks, sorted(ids))
+
+    for fname in fnames:
+        try:
+            os.remove(fname)
+        except OSError, exc:
+            logger.error(exc)
+
+    logger.info("checked %s counter changes, created %s awards" % (len(pairs), created))
+    return created
+
+
+# The post counters that change with each type of vote.
+VOTE_COUNTERS = {
+    Vote.UP: [POST_VOTES],
+    Vote.DOWN: [POST_VOTES],
+    Vote.BOOKMARK: [POST_VOTES, BOOKMARKS, FOLLOWERS],
+    Vote.ACCEPT: [POST_VOTES, ACCEPTED],
+}
+
+
+def vote_added(sender, instance, created, *args, **kwargs):
+    # Removed votes cannot earn a badge.
+    if created:
+        # The counters of the voter and of the author of the post.
+        changed([instance.author_id], VOTES_CAST)
+        changed([instance.post.author_id], VOTES_RECEIVED, *VOTE_COUNTERS.get(instance.type, []))
+
+
+def post_created(sender, instance, created, *args, **kwargs):
+    if created:
+        changed([instance.author_id], POSTS)
+
+
+def profile_saved(sender, instance, *args, **kwargs):
+    changed([instance.user_id], PROFILE)
@@ -80,6 +80,32 @@ class Message(models.Model):
         data = (self.body.subject, self.body.text, settings.DEFAULT_FROM_EMAIL, recipient_list)
         return data
 
+class FanOut(models.Model):
+    """
+    Tracks the notifications sent for a new post.
+    The subscriptions are processed in user id order so that an interrupted run can resume.
+    """
+    PENDING, DONE, FAILED = range(3)
+    STATE_CHOICES = [(PENDING, _("Pending")), (DONE, _("Done")), (FAILED, _("Failed"))]
+
+    post = models.OneToOneField("posts.Post", related_name="fanout")
+    body = models.ForeignKey(MessageBody, null=True)
+    state = models.IntegerField(choices=STATE_CHOICES, default=PENDING, db_index=True)
+
+    # The last user that has been notified.
+    last_user_id = models.IntegerField(default=0)
+
+    # Number of messages created and of emails that could not be sent.
+    sent = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    error = models.TextField(default="", blank=True)
+
+    date = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __unicode__(self):
+        return u"FanOut %s, %s" % (self.post_id, self.get_state_display())
+
 # Admin interface to Message and MessageBody.
 class MessageBodyAdmin(admin.ModelAdmin):
     search_fields = ('sender__name', 'sender__email', 'recipient__name', 'recipient__email', 'subject')
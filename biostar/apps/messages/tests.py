@@ -8,15 +8,18 @@ import logging
 from django.conf import settings
 from biostar.apps.users.models import User, Profile
 from biostar.apps.posts.models import Post, Subscription
-from biostar.apps.messages.models import Message
+from biostar.apps.messages.models import Message, FanOut
+from biostar import notify
 from django.core import mail
 
 from django.test import TestCase
+from django.test.utils import override_settings
 
 logging.disable(logging.CRITICAL)
 
 note_count = lambda: Message.objects.all().count()
 
+@override_settings(NOTIFY_IN_BACKGROUND=False)
 class NoteTest(TestCase):
 
     def test_send_email(self):
@@ -75,4 +78,50 @@ class NoteTest(TestCase):
             eq (mesg_c, email_count - index )
 
 
-
+@override_settings(NOTIFY_IN_BACKGROUND=False, NOTIFY_CHUNK_SIZE=2)
+class FanOutTest(TestCase):
+
+    def setUp(self):
+        self.author = User.objects.create(email="author@this.edu")
+        self.watchers = []
+        for step in range(5):
+            user = User.objects.create(email="watcher%s@this.edu" % step)
+            # Watching two tags of the post must not duplicate the subscription.
+            user.profile.add_tags("rna-seq, snp")
+            self.watchers.append(user)
+
+    def test_fan_out(self):
+        "Watchers are subscribed and notified in chunks"
+        with self.settings(NOTIFY_IN_BACKGROUND=True):
+            post = Post.objects.create(title="Test", author=self.author, type=Post.QUESTION, tag_val="rna-seq, snp")
+        post.add_tags(post.tag_val)
+
+        before = Message.objects.count()
+        mail.outbox = []
+        notify.fan_out(post.id)
+
+        fanout = FanOut.objects.get(post=post)
+        self.assertEqual(fanout.state, FanOut.DONE)
+        self.assertEqual(fanout.sent, 5)
+        self.assertEqual(Subscription.objects.filter(post=post).exclude(user=self.author).count(), 5)
+        self.assertEqual(Message.objects.count() - before, 5)
+        self.assertEqual(len(mail.outbox), 5)
+
+        # A finished fan out is not repeated.
+        notify.fan_out(post.id)
+        self.assertEqual(Message.objects.count() - before, 5)
+
+    def test_resume(self):
+        "An interrupted fan out notifies the remaining users only"
+        with self.settings(NOTIFY_IN_BACKGROUND=True):
+            post = Post.objects.create(title="Test", author=self.author, type=Post.QUESTION, tag_val="rna-seq, snp")
+        post.add_tags(post.tag_val)
+
+        last = self.watchers[2]
+        FanOut.objects.create(post=post, state=FanOut.FAILED, last_user_id=last.id)
+
+        before = Message.objects.count()
+        notify.fan_out(post.id)
+
+        self.assertEqual(Message.objects.count() - before, 2)
+        self.assertEqual(FanOut.objects.get(post=post).state, FanOut.DONE)
@@ -1,6 +1,7 @@
 from __future__ import print_function, unicode_literals, absolute_import, division
-import logging, datetime, string
-from django.db import models
+import logging, datetime, string, hashlib
+from django.db import models, connection, transaction, IntegrityError
+from django.core.cache import cache
 from django.conf import settings
 from django.contrib import admin
 from django.contrib.sites.models import Site
@@ -14,6 +15,7 @@ from django.core.exceptions import ObjectDoesNotExist
 from biostar import const
 from biostar.apps.util import html
 from biostar.apps import util
+from biostar.apps.posts import tracking, tagindex
 from mptt.models import MPTTModel, TreeForeignKey
 from mptt.admin import MPTTModelAdmin
 # HTML sanitization parameters.
@@ -34,6 +36,46 @@ class Tag(MPTTModel):
     def fixcase(name):
         return name.upper() if len(name) == 1 else name.lower()
 
+    @staticmethod
+    def tree_version():
+        "The version of the tag tree, changes with every saved or deleted tag"
+        version = TagTreeVersion.objects.filter(pk=1).values_list("value", flat=True).first()
+        return version or 1
+
+    @staticmethod
+    def tree_changed(sender, *args, **kwargs):
+        "Moves the cached expansions and trees to a new version"
+        if TagTreeVersion.objects.filter(pk=1).update(value=F("value") + 1):
+            return
+        try:
+            with transaction.atomic():
+                TagTreeVersion.objects.create(pk=1, value=2)
+        except IntegrityError:
+            # Another process has created the row in the meantime.
+            TagTreeVersion.objects.filter(pk=1).update(value=F("value") + 1)
+
+    @staticmethod
+    def expand(names, ancestors=False):
+        "The names of the tags together with the names of their descendants, or of their ancestors"
+        names = sorted(set(names))
+        if not names:
+            return names
+
+        digest = hashlib.md5(",".join(names).encode("utf-8")).hexdigest()
+        key = "tag-%s-%s-%s" % ("up" if ancestors else "down", Tag.tree_version(), digest)
+        found = cache.get(key)
+        if found is None:
+            # The descendants of a tag lie within its lft and rght values.
+            table = connection.ops.quote_name(Tag._meta.db_table)
+            inner, outer = ("tag", "other") if ancestors else ("other", "tag")
+            sql = ("SELECT DISTINCT other.name FROM {0} other JOIN {0} tag ON other.tree_id = tag.tree_id "
+                   "AND {1}.lft BETWEEN {2}.lft AND {2}.rght WHERE tag.name IN ({3})")
+            cursor = connection.cursor()
+            cursor.execute(sql.format(table, inner, outer, ", ".join(["%s"] * len(names))), names)
+            found = sorted(set(names) | set(row[0] for row in cursor.fetchall()))
+            cache.set(key, found, settings.TAG_TREE_TIMEOUT)
+        return found
+
     @staticmethod
     def update_counts(sender, instance, action, pk_set, *args, **kwargs):
         "Applies tag count updates upon post changes"
@@ -53,6 +95,14 @@ class Tag(MPTTModel):
     def __unicode__(self):
         return self.name
 
+class TagTreeVersion(models.Model):
+    """
+    The version of the tag tree in a single row, shared by all processes.
+    Keys the cached tag expansions and the serialized tree.
+    """
+    value = models.IntegerField(default=1)
+
+
 class TagAdmin(MPTTModelAdmin):
     search_fields = ['name', ]
 
@@ -83,8 +133,8 @@ class PostManager(models.Manager):
     def fixcase(self, text):
         return text.upper() if len(text) == 1 else text.lower()
 
-    def tag_search(self, text):
-        "Performs a query by one or more , separated tags"
+    def parse_tags(self, text):
+        "Splits a tag search into the included and the excluded tags"
         include, exclude = [], []
         # Split the given tags on ',' and '+'.
         terms = text.split(',') if ',' in text else text.split('+')
@@ -94,7 +144,21 @@ class PostManager(models.Manager):
                 exclude.append(self.fixcase(term[:-1]))
             else:
                 include.append(self.fixcase(term))
+        return include, exclude
+
+    def tag_search(self, text):
+        "Performs a query by one or more , separated tags, a tag also matches its descendants"
+        include, exclude = self.parse_tags(text)
+        include, exclude = Tag.expand(include), Tag.expand(exclude)
+
+        # The tag index finds the posts that carry the included tags.
+        if include:
+            return tagindex.TagResults(include, exclude)
+
+        return self.tag_query(include, exclude)
 
+    def tag_query(self, include, exclude):
+        "Performs a tag search in the database"
         if include:
             query = self.filter(type__in=Post.TOP_LEVEL, tag_set__name__in=include).exclude(
                 tag_set__name__in=exclude)
@@ -111,11 +175,12 @@ class PostManager(models.Manager):
 
     def get_thread(self, root, user):
         # Populate the object to build a tree that contains all posts in the thread.
+        # The author profiles are shown next to each post.
         is_moderator = user.is_authenticated() and user.is_moderator
         if is_moderator:
-            query = self.filter(root=root).select_related("root", "author", "lastedit_user").order_by("type", "-has_accepted", "-vote_count", "creation_date")
+            query = self.filter(root=root).select_related("root", "author__profile", "lastedit_user").order_by("type", "-has_accepted", "-vote_count", "creation_date")
         else:
-            query = self.filter(root=root).exclude(status=Post.DELETED).select_related("root", "author", "lastedit_user").order_by("type", "-has_accepted", "-vote_count", "creation_date")
+            query = self.filter(root=root).exclude(status=Post.DELETED).select_related("root", "author__profile", "lastedit_user").order_by("type", "-has_accepted", "-vote_count", "creation_date")
 
         return query
 
@@ -344,6 +409,9 @@ class Post(models.Model):
         # Recompute post reply count
         self.update_reply_count()
 
+        # The search index picks up the post.
+        self.changed = True
+
         super(Post, self).save(*args, **kwargs)
 
     def __unicode__(self):
@@ -372,13 +440,9 @@ class Post(models.Model):
         ip2 = '' if ip2.lower() == 'localhost' else ip2
         ip = ip1 or ip2 or '0.0.0.0'
 
-        now = const.now()
-        since = now - datetime.timedelta(minutes=minutes)
-
         # One view per time interval from each IP address.
-        if not PostView.objects.filter(ip=ip, post=post, date__gt=since):
-            PostView.objects.create(ip=ip, post=post, date=now)
-            Post.objects.filter(id=post.id).update(view_count=F('view_count') + 1)
+        # The views are written into the database by a periodic task.
+        tracking.add_view(post_id=post.id, ip=ip, minutes=minutes)
         return post
 
     @staticmethod
@@ -435,6 +499,71 @@ class RelatedPosts(models.Model):
         unique_together = ("post", "similar_post")
 
 
+class SimilarPost(models.Model):
+    """
+    Questions with similar text, computed offline from the titles and bodies.
+    """
+    post = models.ForeignKey(Post, related_name='similar_posts')
+    similar = models.ForeignKey(Post, related_name='+')
+
+    # Cosine similarity of the two questions.
+    score = models.FloatField()
+
+    # When the neighbours of the post were computed.
+    date = models.DateTimeField(db_index=True)
+
+
+class DailyStats(models.Model):
+    """
+    The site statistics of one day, rolled up after the day has ended.
+    The counts are totals up to the end of the day, the new ids were created on the day.
+    """
+    date = models.DateField(unique=True)
+
+    questions = models.IntegerField(default=0)
+    answers = models.IntegerField(default=0)
+    toplevel = models.IntegerField(default=0)
+    comments = models.IntegerField(default=0)
+    votes = models.IntegerField(default=0)
+    users = models.IntegerField(default=0)
+
+    # Comma separated ids.
+    new_posts = models.TextField(default='')
+    new_votes = models.TextField(default='')
+    new_users = models.TextField(default='')
+
+
+class ActivityCount(models.Model):
+    """
+    The number of events of one kind within an hourly or a daily bucket.
+    Maintained by biostar.server.counters, expired buckets are pruned.
+    """
+    key = models.CharField(max_length=255, unique=True)
+    value = models.IntegerField(default=0)
+    expires = models.DateTimeField(db_index=True)
+
+
+class TagEvent(models.Model):
+    """
+    A change of the tags of a top level post. Read by the in-memory tag index
+    of biostar.apps.posts.tagindex, old events are pruned.
+    """
+    post_id = models.IntegerField()
+    added = models.TextField(default="")
+    removed = models.TextField(default="")
+    deleted = models.BooleanField(default=False)
+    date = models.DateTimeField(db_index=True)
+
+
+class TrafficSketch(models.Model):
+    """
+    The HyperLogLog registers of the visitors of one minute as hex digits.
+    Merged and read by biostar.apps.posts.tracking.
+    """
+    minute = models.IntegerField(unique=True)
+    registers = models.TextField()
+
+
 class ReplyToken(models.Model):
     """
     Connects a user and a post to a unique token. Sending back the token identifies
@@ -522,7 +651,7 @@ class PostView(models.Model):
     """
     ip = models.GenericIPAddressField(default='', null=True, blank=True)
     post = models.ForeignKey(Post, related_name="post_views")
-    date = models.DateTimeField(auto_now=True)
+    date = models.DateTimeField(default=now)
 
 
 class Vote(models.Model):
@@ -551,6 +680,34 @@ class SubscriptionManager(models.Manager):
         "Returns all suscriptions for a post"
         return self.filter(post=post.root).select_related("user")
 
+    def subscribe(self, post, user_ids, sub_type, update=False):
+        """
+        Subscribes the users to the thread of the post with a single insert.
+        Existing subscriptions keep their type unless update is set.
+        Returns the number of new subscriptions.
+        """
+        root_id = post.root_id or post.id
+        user_ids = set(user_ids)
+
+        subs = self.filter(post_id=root_id, user_id__in=user_ids)
+        missing = user_ids.difference(subs.values_list("user_id", flat=True))
+
+        if update and len(missing) < len(user_ids):
+            subs.update(type=sub_type)
+
+        if missing:
+            date = const.now()
+            self.bulk_create([Subscription(post_id=root_id, user_id=uid, type=sub_type, date=date) for uid in missing])
+            # The bulk insert does not send signals.
+            Post.objects.filter(pk=root_id).update(subs_count=F('subs_count') + len(missing))
+
+            # The followers of the thread count for the badges of its author.
+            from biostar.apps.badges import triggers
+            author_id = post.author_id if post.id == root_id else post.root.author_id
+            triggers.changed([author_id], triggers.FOLLOWERS)
+
+        return len(missing)
+
 # This contains the notification types.
 from biostar.const import LOCAL_MESSAGE, MESSAGING_TYPE_CHOICES
 
@@ -595,16 +752,10 @@ class Subscription(models.Model):
     def create(sender, instance, created, *args, **kwargs):
         "Creates a subscription of a user to a post"
         user = instance.author
-        root = instance.root
-        if Subscription.objects.filter(post=root, user=user).count() == 0:
-            sub_type = user.profile.message_prefs
-            if sub_type == const.DEFAULT_MESSAGES:
-                sub_type = const.EMAIL_MESSAGE if instance.is_toplevel else const.LOCAL_MESSAGE
-            sub = Subscription(post=root, user=user, type=sub_type)
-            sub.date = datetime.datetime.utcnow().replace(tzinfo=utc)
-            sub.save()
-            # Increase the subscription count of the root.
-            Post.objects.filter(pk=root.id).update(subs_count=F('subs_count') + 1)
+        sub_type = user.profile.message_prefs
+        if sub_type == const.DEFAULT_MESSAGES:
+            sub_type = const.EMAIL_MESSAGE if instance.is_toplevel else const.LOCAL_MESSAGE
+        Subscription.objects.subscribe(instance, [user.id], sub_type)
 
     @staticmethod
     def finalize_delete(sender, instance, *args, **kwargs):
@@ -628,4 +779,8 @@ post_save.connect(Post.check_root, sender=Post)
 post_save.connect(Subscription.create, sender=Post, dispatch_uid="create_subs")
 post_delete.connect(Subscription.finalize_delete, sender=Subscription, dispatch_uid="delete_subs")
 m2m_changed.connect(Tag.update_counts, sender=Post.tag_set.through)
+post_save.connect(Tag.tree_changed, sender=Tag, dispatch_uid="tag-tree")
+post_delete.connect(Tag.tree_changed, sender=Tag, dispatch_uid="tag-tree")
+m2m_changed.connect(tagindex.tags_changed, sender=Post.tag_set.through, dispatch_uid="tag-index")
+post_delete.connect(tagindex.post_deleted, sender=Post, dispatch_uid="tag-index")
 
@@ -0,0 +1,191 @@
+"""
+Similar questions computed offline.
+
+The title and body of each question become a hashed TF-IDF vector, the title counts twice.
+The vectors have unit length, so the cosine similarity of two questions is their dot product
+and the similarities of a chunk of questions to all others come from one sparse matrix product.
+The best matches of each question are written to the SimilarPost table.
+
+An incremental run computes the neighbours of the questions edited since the previous run
+and adds these questions to the neighbours of older questions that they match better.
+The weights drift as questions are added, a full run sets everything straight.
+
+Needs NumPy and SciPy.
+"""
+from __future__ import print_function, unicode_literals, absolute_import, division
+import logging, math, re, time, zlib
+from array import array
+from collections import Counter, defaultdict
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from biostar.const import now
+
+logger = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r"[a-z][a-z0-9_+-]+", re.UNICODE)
+TAG_RE = re.compile(r"<[^>]*>")
+
+
+def features(title, content, hashes):
+    "Counts the hashed words of a question, hashes keeps the hashes of the words seen before"
+    counts = Counter()
+    for text, weight in ((title, 2), (TAG_RE.sub(" ", content or ""), 1)):
+        for word in WORD_RE.findall(text.lower()):
+            key = hashes.get(word)
+            if key is None:
+                key = hashes[word] = zlib.crc32(word.encode("utf-8")) % settings.SIMILAR_FEATURES
+            counts[key] += weight
+    return counts
+
+
+def vectorize(docs):
+    """
+    Turns (id, title, content) rows into a matrix with a unit length TF-IDF row per question.
+    Returns the ids and the matrix.
+    """
+    import numpy as np
+    from scipy import sparse
+
+    ids, indptr, indices, data = array(b"l"), array(b"l", [0]), array(b"l"), array(b"f")
+    hashes = {}
+    for pk, title, content in docs:
+        counts = features(title, content, hashes)
+        ids.append(pk)
+        indices.extend(counts.keys())
+        data.extend(1 + math.log(value) for value in counts.values())
+        indptr.append(len(indices))
+
+    size = len(ids)
+    matrix = sparse.csr_matrix((np.frombuffer(data, dtype=np.float32), np.frombuffer(indices, dtype=np.int64),
+                                np.frombuffer(indptr, dtype=np.int64)), shape=(size, settings.SIMILAR_FEATURES))
+
+    # Words found in too many questions say nothing about them.
+    freq = np.bincount(matrix.indices, minlength=settings.SIMILAR_FEATURES)
+    idf = np.log((1.0 + size) / (1.0 + freq)) + 1
+    idf[freq > max(2, settings.SIMILAR_MAX_DF * size)] = 0
+    matrix.data *= idf[matrix.indices].astype(np.float32)
+    matrix.eliminate_zeros()
+
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    matrix = sparse.diags(1 / norms.astype(np.float32)).dot(matrix).tocsr()
+
+    return np.frombuffer(ids, dtype=np.int64), matrix
+
+
+def products(matrix, rows, min_score):
+    "Yields the rows and their similarities to all questions, one chunk at a time"
+    transposed = matrix.T.tocsc()
+    for start in range(0, len(rows), settings.SIMILAR_CHUNK_SIZE):
+        chunk = rows[start:start + settings.SIMILAR_CHUNK_SIZE]
+        product = matrix[chunk].dot(transposed).tocsr()
+        # Weak matches are dropped for the whole chunk at once.
+        product.data[product.data < min_score] = 0
+        product.eliminate_zeros()
+        yield chunk, product
+
+
+def best(row, cols, scores, limit):
+    "The columns with the highest scores, the row itself is left out"
+    import numpy as np
+
+    keep = cols != row
+    cols, scores = cols[keep], scores[keep]
+    if len(cols) > limit:
+        top = np.argpartition(-scores, limit)[:limit]
+        cols, scores = cols[top], scores[top]
+    order = np.argsort(-scores, kind="mergesort")
+    return cols[order], scores[order]
+
+
+def neighbours(ids, matrix, rows=None, limit=None, min_score=None, matches=False):
+    """
+    Yields each row with its best matches as a list of (id, score).
+    With matches, also yields all questions that match the row: the candidates of an incremental update.
+    """
+    import numpy as np
+
+    limit = limit or settings.SIMILAR_POSTS_LIMIT
+    min_score = settings.SIMILAR_MIN_SCORE if min_score is None else min_score
+    rows = np.arange(len(ids)) if rows is None else rows
+
+    for chunk, product in products(matrix, rows, min_score):
+        for pos, row in enumerate(chunk):
+            start, end = product.indptr[pos], product.indptr[pos + 1]
+            cols, scores = product.indices[start:end], product.data[start:end]
+            top, values = best(row, cols, scores, limit)
+            found = [(int(ids[col]), float(value)) for col, value in zip(top, values)]
+            matched = []
+            if matches:
+                keep = cols != row
+                matched = [(int(ids[col]), float(value)) for col, value in zip(cols[keep], scores[keep])]
+            yield int(ids[row]), found, matched
+
+
+def write(results, date):
+    "Replaces the neighbours of the posts, results maps a post id to a list of (id, score)"
+    from biostar.apps.posts.models import SimilarPost
+
+    pks = list(results)
+    with transaction.atomic():
+        for start in range(0, len(pks), settings.SIMILAR_CHUNK_SIZE):
+            chunk = pks[start:start + settings.SIMILAR_CHUNK_SIZE]
+            SimilarPost.objects.filter(post_id__in=chunk).delete()
+            SimilarPost.objects.bulk_create(
+                SimilarPost(post_id=pk, similar_id=other, score=score, date=date)
+                for pk in chunk for other, score in results[pk])
+
+
+def questions():
+    from biostar.apps.posts.models import Post
+    query = Post.objects.filter(type=Post.QUESTION).exclude(status=Post.DELETED).order_by("id")
+    return query.values_list("id", "title", "content").iterator()
+
+
+def update(full=False):
+    """
+    Computes the neighbours of the questions edited since the previous run, or of all questions.
+    Returns the number of questions that got new neighbours.
+    """
+    import numpy as np
+    from biostar.apps.posts.models import Post, SimilarPost
+
+    started, date = time.time(), now()
+    since = None if full else SimilarPost.objects.aggregate(Max("date"))["date__max"]
+
+    ids, matrix = vectorize(questions())
+    if not len(ids):
+        return 0
+
+    if since is None:
+        rows = None
+    else:
+        edited = Post.objects.filter(type=Post.QUESTION, lastedit_date__gte=since).values_list("id", flat=True)
+        rows = np.flatnonzero(np.in1d(ids, np.array(list(edited), dtype=np.int64)))
+        if not len(rows):
+            return 0
+
+    results, candidates = {}, defaultdict(list)
+    for pk, found, matched in neighbours(ids, matrix, rows=rows, matches=since is not None):
+        results[pk] = found
+        for other, score in matched:
+            candidates[other].append((pk, score))
+
+    # The older questions keep their best matches, the edited questions may rank among them.
+    changed = set(results)
+    others = [pk for pk in candidates if pk not in changed]
+    current = defaultdict(list)
+    for start in range(0, len(others), settings.SIMILAR_CHUNK_SIZE):
+        query = SimilarPost.objects.filter(post_id__in=others[start:start + settings.SIMILAR_CHUNK_SIZE])
+        for pk, other, score in query.values_list("post_id", "similar_id", "score"):
+            if other not in changed:
+                current[pk].append((other, score))
+    for pk in others:
+        merged = sorted(current[pk] + candidates[pk], key=lambda item: -item[1])[:settings.SIMILAR_POSTS_LIMIT]
+        if merged != sorted(current[pk], key=lambda item: -item[1]):
+            results[pk] = merged
+
+    write(results, date)
+    logger.info("%s questions, %s updated in %.1f seconds" % (len(ids), len(results), time.time() - started))
+    return len(results)
@@ -0,0 +1,399 @@
+"""
+In-memory tag index.
+
+Maps each tag name to a compressed bitmap of the top level posts that carry it.
+The ids are split into chunks of 65536, a chunk holds a set of ids when sparse
+and the bits of a Python integer when dense. A tag search becomes a union, a difference
+and a membership test, the database only loads the rows of the requested page.
+
+Each process keeps its own index. Tag changes are stored as TagEvent rows,
+the other processes apply the events they have not seen before the next search.
+An event of a transaction that commits after a later event was read shows up with a
+lower id. Each sync reads the events of the last TAG_INDEX_SYNC_WINDOW seconds again,
+the posts of the events it had not seen are reloaded from the database.
+The index is rebuilt from time to time in a background thread, searches use the
+current index meanwhile.
+"""
+from __future__ import print_function, unicode_literals, absolute_import, division
+import binascii, logging, re, threading, time
+from collections import defaultdict
+from datetime import timedelta
+from operator import itemgetter
+from django.conf import settings
+from django.db.models import Max, Q
+from biostar import const
+
+logger = logging.getLogger(__name__)
+
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+# Chunks with more ids than this are stored as bits.
+DENSE = 4096
+
+ONE_RE = re.compile("1")
+
+# Ids per lookup when the sort fields of the matching posts are loaded.
+ID_CHUNK = 500
+
+
+def to_bits(values):
+    "The bits of the values of a chunk as an integer"
+    data = bytearray(1 << (CHUNK_BITS - 3))
+    for value in values:
+        data[value >> 3] |= 1 << (value & 7)
+    data.reverse()
+    return int(binascii.hexlify(bytes(data)), 16)
+
+
+def from_bits(bits):
+    "The values of a chunk stored as bits, in order"
+    return [match.start() for match in ONE_RE.finditer(bin(bits)[:1:-1])]
+
+
+def pack(chunk):
+    "Stores a chunk in the smaller form"
+    if isinstance(chunk, set):
+        return to_bits(chunk) if len(chunk) > DENSE else chunk
+    return chunk if bin(chunk).count("1") > DENSE else set(from_bits(chunk))
+
+
+class Bitmap(object):
+    "A compressed set of ids"
+
+    __slots__ = ("chunks", )
+
+    def __init__(self, ids=()):
+        groups = defaultdict(set)
+        for pk in ids:
+            groups[pk >> CHUNK_BITS].add(pk & CHUNK_MASK)
+        self.chunks = dict((key, pack(values)) for key, values in groups.items())
+
+    def add(self, pk):
+        key, value = pk >> CHUNK_BITS, pk & CHUNK_MASK
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            self.chunks[key] = set([value])
+        elif isinstance(chunk, set):
+            chunk.add(value)
+            if len(chunk) > DENSE:
+                self.chunks[key] = to_bits(chunk)
+        else:
+            self.chunks[key] = chunk | (1 << value)
+
+    def discard(self, pk):
+        key, value = pk >> CHUNK_BITS, pk & CHUNK_MASK
+        chunk = self.chunks.get(key)
+        if isinstance(chunk, set):
+            chunk.discard(value)
+        elif chunk is not None:
+            chunk &= ~(1 << value)
+            self.chunks[key] = chunk
+        if not chunk:
+            self.chunks.pop(key, None)
+
+    def __contains__(self, pk):
+        chunk = self.chunks.get(pk >> CHUNK_BITS)
+        if isinstance(chunk, set):
+            return pk & CHUNK_MASK in chunk
+        return chunk is not None and bool(chunk >> (pk & CHUNK_MASK) & 1)
+
+    def __len__(self):
+        return sum(len(chunk) if isinstance(chunk, set) else bin(chunk).count("1") for chunk in self.chunks.values())
+
+    def __iter__(self):
+        for key in sorted(self.chunks):
+            chunk, base = self.chunks[key], key << CHUNK_BITS
+            for value in (sorted(chunk) if isinstance(chunk, set) else from_bits(chunk)):
+                yield base | value
+
+    def combine(self, other, keys, op):
+        result = Bitmap()
+        for key in keys:
+            first, second = self.chunks.get(key, set()), other.chunks.get(key, set())
+            if isinstance(first, set) and isinstance(second, set):
+                chunk = op(first, second)
+            else:
+                first = first if not isinstance(first, set) else to_bits(first)
+                second = second if not isinstance(second, set) else to_bits(second)
+                chunk = pack(op(first, second))
+            if chunk:
+                result.chunks[key] = chunk
+        return result
+
+    def __or__(self, other):
+        return self.combine(other, set(self.chunks) | set(other.chunks), lambda a, b: a | b)
+
+    def __and__(self, other):
+        return self.combine(other, set(self.chunks) & set(other.chunks), lambda a, b: a & b)
+
+    def __sub__(self, other):
+        return self.combine(other, set(self.chunks), lambda a, b: a & ~b if isinstance(a, (int, long)) else a - b)
+
+
+def split(text):
+    return [name for name in text.split(",") if name]
+
+
+def generation():
+    "The id of the last recorded event"
+    from biostar.apps.posts.models import TagEvent
+    return TagEvent.objects.aggregate(gen=Max("id"))["gen"] or 0
+
+
+def record(post_id, added, removed):
+    "Records a change of the tags of a post, removed is None when the post is gone"
+    from biostar.apps.posts.models import TagEvent
+    TagEvent.objects.create(post_id=post_id, added=",".join(added), removed=",".join(removed or []),
+                            deleted=removed is None, date=const.now())
+
+
+def prune():
+    "Deletes the events that every index has applied or rebuilt past"
+    from biostar.apps.posts.models import TagEvent
+
+    since = const.now() - timedelta(seconds=2 * settings.TAG_INDEX_REBUILD)
+    TagEvent.objects.filter(date__lt=since).delete()
+
+
+class TagIndex(object):
+    "The bitmaps of the tags of one process"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tags = {}
+        self.gen = None
+        self.built = 0
+        # The dates of the applied events within the sync window, by id.
+        self.seen = {}
+        self.rebuilding = False
+
+    def load(self):
+        "Reads the bitmaps from the database. Returns the bitmaps, the generation and the build time."
+        from biostar.apps.posts.models import Post
+
+        start = time.time()
+        # Changes made during the build are applied again.
+        gen = generation()
+        ids = defaultdict(list)
+        rows = Post.tag_set.through.objects.filter(post__type__in=Post.TOP_LEVEL).values_list("tag__name", "post_id")
+        for name, pk in rows.iterator():
+            ids[name].append(pk)
+        tags = dict((name, Bitmap(values)) for name, values in ids.items())
+        built = time.time()
+        logger.info("indexed %s tags in %.2f seconds" % (len(tags), built - start))
+        return tags, gen, built
+
+    def build(self):
+        self.tags, self.gen, self.built = self.load()
+        self.seen = {}
+
+    def rebuild(self):
+        "Replaces the bitmaps with a fresh build, the searches use the current ones meanwhile"
+        try:
+            tags, gen, built = self.load()
+            with self.lock:
+                self.tags, self.gen, self.built, self.seen = tags, gen, built, {}
+        finally:
+            self.rebuilding = False
+
+    def rebuild_thread(self):
+        from django.db import connection
+        try:
+            self.rebuild()
+        except Exception, exc:
+            # The next attempt waits for another period, the events keep the index current.
+            self.built = time.time()
+            logger.error("tag index rebuild failed: %s" % exc)
+        finally:
+            # The thread has its own connection.
+            connection.close()
+
+    def apply(self, post_id, added, removed):
+        for name in added:
+            self.tags.setdefault(name, Bitmap()).add(post_id)
+        for name in (self.tags if removed is None else removed):
+            if name in self.tags:
+                self.tags[name].discard(post_id)
+
+    def reload(self, post_ids):
+        "Sets the tags of the posts from the database"
+        from biostar.apps.posts.models import Post
+
+        for bitmap in self.tags.values():
+            for pk in post_ids:
+                bitmap.discard(pk)
+        rows = Post.tag_set.through.objects.filter(post_id__in=post_ids, post__type__in=Post.TOP_LEVEL)
+        for name, pk in rows.values_list("tag__name", "post_id"):
+            self.tags.setdefault(name, Bitmap()).add(pk)
+
+    def sync(self):
+        "Applies the changes recorded since the last search"
+        from biostar.apps.posts.models import TagEvent
+
+        if self.gen is None:
+            return self.build()
+
+        if time.time() - self.built > settings.TAG_INDEX_REBUILD and not self.rebuilding:
+            self.rebuilding = True
+            thread = threading.Thread(target=self.rebuild_thread)
+            thread.daemon = True
+            thread.start()
+
+        since = const.now() - timedelta(seconds=settings.TAG_INDEX_SYNC_WINDOW)
+        events = TagEvent.objects.filter(Q(id__gt=self.gen) | Q(date__gte=since)).order_by("id")
+        late = set()
+        for event in events.iterator():
+            if event.id in self.seen:
+                continue
+            if event.id <= self.gen:
+                # Committed after a later event was applied, or already part of the build.
+                late.add(event.post_id)
+            else:
+                self.apply(event.post_id, split(event.added), None if event.deleted else split(event.removed))
+                self.gen = event.id
+            self.seen[event.id] = event.date
+        if late:
+            self.reload(late)
+        self.seen = dict((pk, date) for pk, date in self.seen.items() if date >= since)
+
+    def search(self, include, exclude):
+        "The posts that carry any of the included tags and none of the excluded ones"
+        with self.lock:
+            self.sync()
+            found = Bitmap()
+            for name in include:
+                found = found | self.tags.get(name, Bitmap())
+            for name in exclude:
+                found = found - self.tags.get(name, Bitmap())
+            return found
+
+
+index = TagIndex()
+
+
+def tags_changed(sender, instance, action, reverse, pk_set, *args, **kwargs):
+    "Records the tag changes of the top level posts"
+    from biostar.apps.posts.models import Post, Tag
+
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if reverse:
+        # The posts of a tag were changed.
+        posts = Post.objects.filter(type__in=Post.TOP_LEVEL)
+        posts = posts.filter(pk__in=pk_set) if action != 'pre_clear' else posts.filter(tag_set=instance)
+        changes = [(pk, [instance.name]) for pk in posts.values_list("id", flat=True)]
+    elif instance.type in Post.TOP_LEVEL:
+        tags = Tag.objects.filter(pk__in=pk_set) if action != 'pre_clear' else instance.tag_set.all()
+        changes = [(instance.id, list(tags.values_list("name", flat=True)))]
+    else:
+        changes = []
+
+    for pk, names in changes:
+        if action == 'post_add':
+            record(pk, names, [])
+        else:
+            record(pk, [], names)
+
+
+def post_deleted(sender, instance, *args, **kwargs):
+    if instance.type in sender.TOP_LEVEL:
+        record(instance.id, [], None)
+
+
+class TagResults(object):
+    """
+    The top level posts that match a tag search. Supports the parts of a query set
+    that the post lists use: ordering, filtering, counting and slicing.
+    """
+
+    def __init__(self, include, exclude, ordering=("-lastedit_date", ), filters=None):
+        from biostar.apps.posts.models import Post
+        self.model = Post
+        self.include, self.exclude = include, exclude
+        self.ordering, self.filters = ordering, filters or {}
+        self._ids = self._count = self._sorted = None
+
+    def order_by(self, *fields):
+        return TagResults(self.include, self.exclude, ordering=fields, filters=self.filters)
+
+    def filter(self, **kwargs):
+        return TagResults(self.include, self.exclude, ordering=self.ordering, filters=dict(self.filters, **kwargs))
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            self._ids = index.search(self.include, self.exclude)
+        return self._ids
+
+    def base(self):
+        return self.model.objects.filter(type__in=self.model.TOP_LEVEL, **self.filters)
+
+    def small(self):
+        "Small results are loaded with one lookup by id"
+        return len(self.ids) <= settings.TAG_INDEX_IN_LIMIT
+
+    def rows(self, query):
+        return query.select_related("root", "author", "lastedit_user").prefetch_related("tag_set").defer("content", "html")
+
+    def scan(self, stop):
+        "The first matching ids in order, None when the scan budget runs out before the page is complete"
+        # The bitmap holds top level posts only, the database walks the index of the ordering.
+        query = self.base().order_by(*self.ordering).values_list("id", flat=True)
+        found, size = [], settings.TAG_INDEX_SCAN_CHUNK
+        for start in range(0, settings.TAG_INDEX_SCAN_LIMIT, size):
+            chunk = list(query[start:start + size])
+            found.extend(pk for pk in chunk if pk in self.ids)
+            if len(found) >= stop or len(chunk) < size:
+                return found[:stop]
+        return None
+
+    def sorted_ids(self):
+        "All matching ids in order, the sort fields are loaded by id and sorted here"
+        if self._sorted is None:
+            ids, size = list(self.ids), ID_CHUNK
+            fields = [name.lstrip("-") for name in self.ordering]
+            rows = []
+            for start in range(0, len(ids), size):
+                rows.extend(self.base().filter(pk__in=ids[start:start + size]).values_list("id", *fields))
+            # Sorts are stable, the last field is sorted first.
+            for pos, name in reversed(list(enumerate(self.ordering, 1))):
+                rows.sort(key=itemgetter(pos), reverse=name.startswith("-"))
+            self._sorted = [row[0] for row in rows]
+        return self._sorted
+
+    def count(self):
+        if self._count is None:
+            if not self.filters:
+                self._count = len(self.ids)
+            elif self.small():
+                self._count = self.base().filter(pk__in=list(self.ids)).count()
+            else:
+                self._count = len(self.sorted_ids())
+        return self._count
+
+    __len__ = count
+
+    def exists(self):
+        return bool(self.count())
+
+    def fetch(self, start, stop):
+        "Loads the posts of a slice"
+        if self.small():
+            query = self.base().filter(pk__in=list(self.ids)).order_by(*self.ordering)
+            return list(self.rows(query)[start:stop])
+        page = self.scan(stop) if self._sorted is None else None
+        page = page[start:] if page is not None else self.sorted_ids()[start:stop]
+        posts = self.rows(self.model.objects.all()).in_bulk(page)
+        return [posts[pk] for pk in page if pk in posts]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start = key.start or 0
+            stop = self.count() if key.stop is None else key.stop
+            return self.fetch(start, stop)
+        return self.fetch(key, key + 1)[0]
+
+    def __iter__(self):
+        return iter(self.fetch(0, self.count()))
@@ -5,10 +5,15 @@ These will execute when you run "manage.py test".
 """
 from __future__ import print_function, unicode_literals, absolute_import, division
 
-import logging
+import os, json, logging, tempfile, shutil, time
+from datetime import timedelta
+from django.core.urlresolvers import reverse
 from django.conf import settings
+from biostar import const
+from django.core.cache import get_cache
 from biostar.apps.users.models import User, Profile
-from biostar.apps.posts.models import Post, Subscription, Tag
+from biostar.apps.posts.models import Post, Subscription, Tag, PostView, SimilarPost, TagEvent
+from biostar.apps.posts import tracking, similar, tagindex, models, views
 from biostar.apps.messages.models import Message
 
 from django.test import TestCase
@@ -101,6 +106,110 @@ class PostTest(TestCase):
         subs = Subscription.objects.filter(post=post)
         eq(len(subs), 3)
 
+
+class PostViewTest(TestCase):
+
+    def setUp(self):
+        # The default cache is a dummy cache in development.
+        self.cache = tracking.cache
+        tracking.cache = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='tracking-test')
+        self.spool = tempfile.mkdtemp()
+
+    def tearDown(self):
+        tracking.cache = self.cache
+        shutil.rmtree(self.spool)
+
+    def test_buffered_views(self):
+        "Views are deduplicated and stored in bulk."
+        eq = self.assertEqual
+
+        jane = User.objects.create(email="jane@this.edu")
+        post = Post(title="Hello Posts!", author=jane, type=Post.FORUM, content="Hello")
+        post.save()
+
+        with self.settings(POST_VIEW_SPOOL_DIR=self.spool):
+            with self.assertNumQueries(0):
+                eq(True, tracking.add_view(post_id=post.id, ip="127.0.0.1"))
+                eq(False, tracking.add_view(post_id=post.id, ip="127.0.0.1"))
+                eq(True, tracking.add_view(post_id=post.id, ip="127.0.0.2"))
+
+            eq(2, tracking.flush())
+            eq(0, tracking.flush())
+
+            # The views keep the time they were spooled at.
+            with open(tracking.spool_path(), "a") as fp:
+                fp.write("%s 127.0.0.3 %d\n" % (post.id, time.time() - 3600))
+            eq(1, tracking.flush())
+
+            # The files of a running flush are left alone, those of an unfinished flush are taken over.
+            eq(True, tracking.add_view(post_id=post.id, ip="127.0.0.4"))
+            fnames, views = tracking.collect()
+            eq(1, len(views))
+            eq(0, tracking.flush())
+            with self.settings(POST_VIEW_FLUSH_TIMEOUT=0):
+                eq(1, tracking.flush())
+            eq([], os.listdir(self.spool))
+
+        eq(4, Post.objects.get(pk=post.id).view_count)
+        eq(4, PostView.objects.filter(post=post).count())
+        eq(1, PostView.objects.filter(post=post, date__lt=const.now() - timedelta(minutes=50)).count())
+
+    def test_traffic(self):
+        "The distinct visitors are estimated from the sketches of the last minutes."
+        now = int(time.time() // 60) * 60
+        eq = self.assertEqual
+
+        # Visits older than the window are left out, repeated visits count once.
+        visits = [("10.1.0.1", now - 3660)]
+        for step in range(5000):
+            visits.append(("10.0.%s.%s" % (step // 250, step % 250), now - 60 - step // 100))
+        for step in range(5):
+            visits.extend([("11.0.0.%s" % step, now), ("10.0.0.1", now)])
+
+        # The sketches of separate flushes are merged.
+        tracking.add_visitors(visits[:2000])
+        tracking.add_visitors(visits[2000:])
+
+        # Three standard errors at the default precision.
+        total = tracking.traffic(60, now=now)
+        self.assertTrue(4500 < total < 5500, total)
+        eq(6, tracking.traffic(1, now=now))
+        eq(0, tracking.traffic(60, now=now + 3600))
+
+        # The flush adds the spooled views, of deleted posts as well.
+        with self.settings(POST_VIEW_SPOOL_DIR=self.spool):
+            with open(tracking.spool_path(), "a") as fp:
+                fp.write("0 12.0.0.1 %d\n0 12.0.0.2 %d\n" % (now + 120, now + 120))
+            eq(0, tracking.flush())
+        eq(2, tracking.traffic(1, now=now + 120))
+
+
+class SubscriptionTest(TestCase):
+
+    def test_subscribe(self):
+        "Subscriptions are added in bulk and counted once."
+        eq = self.assertEqual
+
+        jane = User.objects.create(email="jane@this.edu")
+        post = Post(title="Hello Posts!", author=jane, type=Post.FORUM, content="Hello")
+        post.save()
+
+        users = [User.objects.create(email="user%s@this.edu" % step) for step in range(4)]
+        ids = [user.id for user in users]
+
+        # The author is subscribed already, repeated ids are ignored.
+        with self.assertNumQueries(3):
+            eq(4, Subscription.objects.subscribe(post, ids + ids[:2] + [jane.id], const.LOCAL_MESSAGE))
+
+        eq(0, Subscription.objects.subscribe(post, ids, const.EMAIL_MESSAGE))
+        eq(5, Subscription.objects.filter(post=post).count())
+        eq(5, Post.objects.get(pk=post.id).subs_count)
+        eq(0, Subscription.objects.filter(post=post, type=const.EMAIL_MESSAGE, user_id__in=ids).count())
+
+        # Updates change the type of the existing subscriptions.
+        eq(0, Subscription.objects.subscribe(post, ids[:2], const.EMAIL_MESSAGE, update=True))
+        eq(2, Subscription.objects.filter(post=post, type=const.EMAIL_MESSAGE, user_id__in=ids).count())
+
 TEST_CONTENT_EMBEDDING ="""
 <p>Gist links may be formatted</p>
 
@@ -135,4 +244,231 @@ http://test.biostars.org/p/2/</pre>
 <p>versus&nbsp;http://test.biostars.org/p/2/</p>
 
 <p>&nbsp;</p>
-"""
\ No newline at end of file
+"""
+
+
+class SimilarPostTest(TestCase):
+
+    def ask(self, title, content):
+        post = Post(title=title, author=self.jane, type=Post.QUESTION, content=content)
+        post.save()
+        return post
+
+    def neighbours(self, post):
+        return list(SimilarPost.objects.filter(post=post).order_by("-score").values_list("similar_id", flat=True))
+
+    def test_similar(self):
+        "Similar questions are computed in bulk, then for the new questions."
+        eq = self.assertEqual
+
+        self.jane = User.objects.create(email="jane@this.edu")
+        one = self.ask("Aligning reads with bowtie", "The bowtie index build fails")
+        two = self.ask("Bowtie index build error", "Bowtie crashes while building the index")
+        three = self.ask("Differential expression of genes", "How to normalize counts in deseq")
+        self.ask("Hello", "Hello")
+
+        eq(4, similar.update(full=True))
+        eq([two.id], self.neighbours(one))
+        eq([one.id], self.neighbours(two))
+        eq([], self.neighbours(three))
+
+        # Nothing changed since.
+        eq(0, similar.update())
+
+        # The new question is added to the neighbours of the older one.
+        four = self.ask("Normalize counts of deseq", "Expression counts from deseq")
+        eq(2, similar.update())
+        eq([three.id], self.neighbours(four))
+        eq([four.id], self.neighbours(three))
+        eq([two.id], self.neighbours(one))
+
+
+class TagIndexTest(TestCase):
+
+    def setUp(self):
+        self.index = tagindex.index
+        tagindex.index = tagindex.TagIndex()
+
+    def tearDown(self):
+        tagindex.index = self.index
+
+    def test_bitmap(self):
+        "Bitmaps behave as sets of ids."
+        eq = self.assertEqual
+
+        dense = range(10, 20000, 3)
+        sparse = [5, 70000, 70001, 200000]
+        first, second = tagindex.Bitmap(dense + sparse), tagindex.Bitmap(range(0, 70100, 7))
+        eq(list(first), sorted(set(dense + sparse)))
+        eq(len(first), len(set(dense + sparse)))
+        eq(list(first | second), sorted(set(first) | set(second)))
+        eq(list(first & second), sorted(set(first) & set(second)))
+        eq(list(first - second), sorted(set(first) - set(second)))
+
+        first.add(3)
+        first.discard(70000)
+        first.discard(13)
+        eq(True, 3 in first)
+        eq(False, 70000 in first)
+        eq(False, 13 in first)
+        eq(True, 16 in first)
+
+    def test_tag_search(self):
+        "The tag index finds the same posts as the database."
+        eq = self.assertEqual
+
+        jane = User.objects.create(email="jane@this.edu")
+        for step, tags in enumerate(["a1,b1", "b1", "a1,c1", "c1", "a1,b1,c1", "d1"]):
+            post = Post(title="Post %s" % step, author=jane, type=Post.QUESTION, content="Hello")
+            post.save()
+            post.add_tags(tags)
+        Post.objects.create(parent=post, author=jane, type=Post.ANSWER, content="Answer")
+
+        def ids(query):
+            return [post.id for post in query]
+
+        for text in ["a1", "a1+b1", "a1+b1!", "b1,c1", "c1+a1!+b1!", "x1"]:
+            include, exclude = Post.objects.parse_tags(text)
+            expected = Post.objects.tag_query(include, exclude).order_by("-lastedit_date", "-id")
+            found = Post.objects.tag_search(text).order_by("-lastedit_date", "-id")
+            eq(ids(expected), ids(found))
+            self.assertTrue(text == "x1" or found.count())
+            eq(expected.count(), found.count())
+            for limit in (100, 2):
+                # The second limit stops the scan early, the posts are sorted by id lookups.
+                with self.settings(TAG_INDEX_IN_LIMIT=0, TAG_INDEX_SCAN_CHUNK=2, TAG_INDEX_SCAN_LIMIT=limit):
+                    eq(ids(expected[1:3]), ids(found.order_by("-lastedit_date", "-id")[1:3]))
+                    subset = found.filter(title__in=["Post 0", "Post 4"])
+                    eq(ids(expected.filter(title__in=["Post 0", "Post 4"])), ids(subset))
+                    eq(expected.filter(title__in=["Post 0", "Post 4"]).count(), subset.count())
+
+        # Another process catches up with the recorded changes.
+        other = tagindex.TagIndex()
+        other.search(["a1"], [])
+        built = other.built
+        post = Post.objects.get(title="Post 3")
+        post.add_tags("a1")
+        eq(True, post.id in other.search(["a1"], []))
+        Post.objects.get(title="Post 0").delete()
+        eq(3, len(other.search(["a1"], [])))
+        eq(built, other.built)
+
+        # An event that commits after a later one was read is found in the sync window.
+        post = Post.objects.get(title="Post 1")
+        start = tagindex.generation()
+        post.add_tags("a1,b1")
+        hidden = list(TagEvent.objects.filter(id__gt=start))
+        TagEvent.objects.filter(id__gt=start).delete()
+        TagEvent.objects.create(id=hidden[-1].id + 10, post_id=post.id, date=const.now())
+        eq(False, post.id in other.search(["a1"], []))
+        TagEvent.objects.bulk_create(hidden)
+        eq(True, post.id in other.search(["a1"], []))
+
+        # The rebuild keeps the searches on the current bitmaps until it is done.
+        other.rebuild()
+        self.assertTrue(other.built > built)
+        eq(True, post.id in other.search(["a1"], []))
+
+        # Old events are pruned.
+        TagEvent.objects.update(date=const.now() - timedelta(seconds=3 * settings.TAG_INDEX_REBUILD))
+        tagindex.prune()
+        eq(0, TagEvent.objects.count())
+
+
+class TagTreeTest(TestCase):
+
+    def setUp(self):
+        self.cache, self.views_cache, self.index = models.cache, views.cache, tagindex.index
+        models.cache = views.cache = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='tag-tree-test')
+        tagindex.index = tagindex.TagIndex()
+
+    def tearDown(self):
+        models.cache, views.cache, tagindex.index = self.cache, self.views_cache, self.index
+
+    def test_subtree(self):
+        "A tag search matches the descendants of the tags."
+        eq = self.assertEqual
+
+        jane = User.objects.create(email="jane@this.edu")
+        seq = Tag.objects.create(name="sequencing")
+        rna = Tag.objects.create(name="rna-seq", parent=seq)
+        Tag.objects.create(name="scrna-seq", parent=rna)
+        Tag.objects.create(name="assembly")
+
+        posts = {}
+        for name in ["sequencing", "rna-seq", "scrna-seq", "assembly"]:
+            posts[name] = Post(title=name, author=jane, type=Post.QUESTION, content="Hello")
+            posts[name].save()
+            posts[name].add_tags(name)
+
+        def titles(text):
+            return sorted(post.title for post in Post.objects.tag_search(text))
+
+        # The tree version is read each time, the expansion once.
+        with self.assertNumQueries(3):
+            eq(["rna-seq", "scrna-seq", "sequencing"], Tag.expand(["sequencing"]))
+            eq(["rna-seq", "scrna-seq", "sequencing"], Tag.expand(["sequencing"]))
+        eq(["rna-seq", "sequencing"], Tag.expand(["rna-seq"], ancestors=True))
+
+        eq(["rna-seq", "scrna-seq", "sequencing"], titles("sequencing"))
+        eq(["rna-seq", "scrna-seq"], titles("rna-seq"))
+        eq(["assembly", "sequencing"], titles("assembly,sequencing,rna-seq!"))
+        eq(["rna-seq", "scrna-seq"], [post.title for post in Post.objects.tag_query(["rna-seq", "scrna-seq"], [])
+                                      .order_by("title")])
+
+        # A new tag changes the expansions.
+        Tag.objects.create(name="long-reads", parent=seq)
+        eq(["long-reads", "rna-seq", "scrna-seq", "sequencing"], Tag.expand(["sequencing"]))
+
+        # So does a renamed tag, the version is kept in the database.
+        version = Tag.tree_version()
+        rna.name = "rnaseq"
+        rna.save()
+        eq(version + 1, Tag.tree_version())
+        eq(["long-reads", "rnaseq", "scrna-seq", "sequencing"], Tag.expand(["sequencing"]))
+
+    def test_tag_list(self):
+        "The tag tree is serialized once, the tags of a post are marked on each request."
+        eq = self.assertEqual
+
+        jane = User.objects.create(email="jane@this.edu")
+        seq = Tag.objects.create(name="sequencing")
+        rna = Tag.objects.create(name="rna-seq", parent=seq)
+        Tag.objects.create(name="scrna-seq", parent=rna)
+        Tag.objects.create(name="assembly")
+        post = Post(title="Hello", author=jane, type=Post.QUESTION, content="Hello")
+        post.save()
+        post.add_tags("rna-seq")
+
+        def tree(url):
+            nodes = {}
+            response = self.client.get(url)
+            eq("application/json", response["Content-Type"])
+            stack = json.loads(response.content)
+            while stack:
+                node = stack.pop()
+                nodes[node['title']] = node
+                stack.extend(node.get('children', []))
+            return nodes
+
+        nodes = tree("/post/tags/")
+        eq(["assembly", "rna-seq", "scrna-seq", "sequencing"], sorted(nodes))
+        eq(["rna-seq"], [node['title'] for node in nodes["sequencing"]['children']])
+        eq(False, any('selected' in node or 'expanded' in node for node in nodes.values()))
+
+        # The session, the tree version, the post, its tags and their ancestors.
+        with self.assertNumQueries(5):
+            nodes = tree("/post/%s/tags/" % post.id)
+        eq(True, nodes["rna-seq"]['selected'])
+        eq(True, nodes["sequencing"]['expanded'])
+        eq(False, 'expanded' in nodes["rna-seq"] or 'selected' in nodes["scrna-seq"])
+
+        nodes = tree("/post/%s/tags/?href=1" % post.id)
+        eq(True, nodes["rna-seq"]['selected'])
+        eq("/t/scrna-seq/", nodes["scrna-seq"]['href'])
+
+        # A new tag is part of the next tree.
+        Tag.objects.create(name="long-reads", parent=seq)
+        nodes = tree("/post/tags/?href=1")
+        eq(reverse("topic-list", kwargs=dict(topic="long-reads")), nodes["long-reads"]['href'])
+
@@ -0,0 +1,231 @@
+"""
+Buffered post view tracking.
+
+A view is accepted at most once per IP and post within a time window.
+The window is kept in the cache. Accepted views are appended to a spool file
+for each process, then a periodic task aggregates the spool into the database.
+A page view does not write to the database.
+
+The distinct visitors of the last hour are estimated with a HyperLogLog sketch
+for each minute. The flush builds the sketches of the spooled views and merges them
+into the TrafficSketch rows, a read merges the rows of the window.
+The relative standard error is 1.04 / sqrt(2 ** TRAFFIC_PRECISION).
+"""
+from __future__ import print_function, unicode_literals, absolute_import, division
+import os, glob, time, uuid, logging, hashlib, math, struct, binascii
+from collections import defaultdict
+from datetime import datetime
+from django.conf import settings
+from django.core.cache import cache, get_cache
+from django.core.cache.backends.dummy import DummyCache
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.utils.timezone import utc
+
+logger = logging.getLogger(__name__)
+
+# The time window needs a working cache. Development settings use a dummy cache.
+if isinstance(cache, DummyCache):
+    cache = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='post-views')
+
+SPOOL_PATTERN = "views-*.txt"
+
+
+def spool_path():
+    "Each process writes into its own spool file"
+    return os.path.join(settings.POST_VIEW_SPOOL_DIR, "views-%s.txt" % os.getpid())
+
+
+def add_view(post_id, ip, minutes=settings.POST_VIEW_MINUTES):
+    "Records a view unless the same IP has already viewed the post in the time window"
+    key = "view-%s-%s" % (ip, post_id)
+
+    # The add succeeds only when the key is not present.
+    if not cache.add(key, 1, minutes * 60):
+        return False
+
+    line = "%s %s %d\n" % (post_id, ip, time.time())
+
+    try:
+        if not os.path.isdir(settings.POST_VIEW_SPOOL_DIR):
+            os.makedirs(settings.POST_VIEW_SPOOL_DIR)
+        # Short appends to a file opened for appending do not interleave.
+        with open(spool_path(), "a") as fp:
+            fp.write(line.encode("utf-8"))
+    except (IOError, OSError), exc:
+        logger.error("unable to spool view: %s" % exc)
+        return False
+
+    return True
+
+
+def add_visitor(registers, ip):
+    "Adds the IP to the registers of a sketch"
+    precision = settings.TRAFFIC_PRECISION
+    value, = struct.unpack(str(">Q"), hashlib.md5(ip.encode("utf-8")).digest()[:8])
+
+    # The low bits pick the register, the register keeps the longest run of leading zeros of the rest.
+    index, rest = value & ((1 << precision) - 1), value >> precision
+    rank = 64 - precision - rest.bit_length() + 1
+    if registers[index] < rank:
+        registers[index] = rank
+
+
+def merge_sketch(minute, registers):
+    "Merges the registers into the stored sketch of the minute"
+    from biostar.apps.posts.models import TrafficSketch
+
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                row = TrafficSketch.objects.select_for_update().filter(minute=minute).first()
+                if row is None:
+                    TrafficSketch.objects.create(minute=minute, registers=binascii.hexlify(registers))
+                    return
+                stored = bytearray(binascii.unhexlify(row.registers))
+                if len(stored) == len(registers):
+                    registers = bytearray(map(max, stored, registers))
+                TrafficSketch.objects.filter(pk=row.pk).update(registers=binascii.hexlify(registers))
+                return
+        except IntegrityError:
+            # Another flush has created the row, the next attempt merges into it.
+            continue
+
+
+def add_visitors(visits):
+    "Adds the (ip, seconds) visits to the stored sketches of their minutes"
+    from biostar.apps.posts.models import TrafficSketch
+
+    sketches = defaultdict(lambda: bytearray(1 << settings.TRAFFIC_PRECISION))
+    for ip, seconds in visits:
+        add_visitor(sketches[int(seconds // 60)], ip)
+    for minute, registers in sorted(sketches.items()):
+        merge_sketch(minute, registers)
+
+    # The minutes that have left the window are no longer needed.
+    oldest = int(time.time() // 60) - settings.TRAFFIC_MINUTES - 2
+    TrafficSketch.objects.filter(minute__lt=oldest).delete()
+
+
+POWERS = [2.0 ** -value for value in range(65)]
+
+
+def estimate(registers):
+    "The number of distinct values added to the registers"
+    size = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / size)
+    raw = alpha * size * size / sum(POWERS[value] for value in registers)
+    zeros = sum(1 for value in registers if not value)
+    if raw <= 2.5 * size and zeros:
+        # Few values, counting the empty registers is more accurate.
+        return int(round(size * math.log(size / zeros)))
+    return int(round(raw))
+
+
+def traffic(minutes=None, now=None):
+    "The estimated number of distinct IPs that viewed a post in the last minutes"
+    from biostar.apps.posts.models import TrafficSketch
+
+    minutes = minutes or settings.TRAFFIC_MINUTES
+    current = int((now or time.time()) // 60)
+    rows = TrafficSketch.objects.filter(minute__gt=current - minutes, minute__lte=current)
+
+    empty = bytearray(1 << settings.TRAFFIC_PRECISION)
+    sketches = [bytearray(binascii.unhexlify(text)) for text in rows.values_list("registers", flat=True)]
+    sketches = [registers for registers in sketches if len(registers) == len(empty)]
+    if not sketches:
+        return 0
+
+    # The merged sketch keeps the largest value of each register.
+    return estimate(bytearray(map(max, empty, *sketches)))
+
+
+def collect():
+    """
+    Renames the spool files to names of this flush then parses them.
+    Files of a flush that did not finish are taken over after the timeout.
+    """
+    token, now = uuid.uuid4().hex, time.time()
+    fnames = []
+    for fname in glob.glob(os.path.join(settings.POST_VIEW_SPOOL_DIR, SPOOL_PATTERN)) + \
+            glob.glob(os.path.join(settings.POST_VIEW_SPOOL_DIR, "*.flush")):
+        # The writers open the spool for each view and will start a new file.
+        target = "%s.%s.flush" % (fname[:fname.index(".txt") + 4], token)
+        try:
+            if fname.endswith(".flush") and now - os.path.getmtime(fname) < settings.POST_VIEW_FLUSH_TIMEOUT:
+                continue
+            os.rename(fname, target)
+            # The time of the rename marks the claim.
+            os.utime(target, None)
+            fnames.append(target)
+        except OSError, exc:
+            # Another flush has taken the file.
+            logger.error(exc)
+
+    views = []
+    for fname in fnames:
+        try:
+            lines = open(fname).readlines()
+        except IOError, exc:
+            logger.error(exc)
+            continue
+        for line in lines:
+            try:
+                post_id, ip, seconds = line.split()
+                views.append((int(post_id), ip, int(seconds)))
+            except ValueError:
+                logger.error("invalid spool line: %r" % line)
+
+    return fnames, views
+
+
+def flush():
+    "Aggregates the spooled views into the database. Returns the number of views."
+    from biostar.apps.posts.models import Post, PostView
+    from biostar.apps.badges import triggers
+    from biostar.apps.badges.models import VIEWS
+
+    if not os.path.isdir(settings.POST_VIEW_SPOOL_DIR):
+        return 0
+
+    fnames, views = collect()
+
+    # The visitors of the deleted posts count as well.
+    visits = [(ip, seconds) for post_id, ip, seconds in views]
+
+    # Posts may have been deleted since they were viewed.
+    ids = set(post_id for post_id, ip, seconds in views)
+    authors = dict(Post.objects.filter(pk__in=ids).values_list("id", "author_id"))
+    views = [(post_id, ip, seconds) for post_id, ip, seconds in views if post_id in authors]
+
+    deltas = defaultdict(int)
+    for post_id, ip, seconds in views:
+        deltas[post_id] += 1
+
+    # Posts with the same number of new views are updated together.
+    groups = defaultdict(list)
+    for post_id, delta in deltas.items():
+        groups[delta].append(post_id)
+
+    with transaction.atomic():
+        # The views keep the time they were spooled at.
+        rows = [PostView(post_id=post_id, ip=ip, date=datetime.utcfromtimestamp(seconds).replace(tzinfo=utc))
+                for post_id, ip, seconds in views]
+        PostView.objects.bulk_create(rows, batch_size=500)
+        for delta, post_ids in groups.items():
+            Post.objects.filter(pk__in=post_ids).update(view_count=F('view_count') + delta)
+        add_visitors(visits)
+
+        # The files go before the commit, a crash loses the views instead of counting them twice.
+        for fname in fnames:
+            try:
+                os.remove(fname)
+            except OSError, exc:
+                logger.error(exc)
+
+    # The view counts of the badges.
+    triggers.changed([authors[post_id] for post_id in deltas], VIEWS)
+
+    logger.info("flushed %s views on %s posts" % (len(views), len(deltas)))
+
+    return len(views)
@@ -7,7 +7,7 @@ from django.core.urlresolvers import reverse
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Field, Fieldset, Div, Submit, ButtonHolder
 from django.shortcuts import render
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect
 from django.utils.translation import ugettext_lazy as _
 from django.contrib import messages
 from . import auth
@@ -22,10 +22,11 @@ from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 from django.forms.formsets import formset_factory
 from django.forms.models import inlineformset_factory
-from mptt.templatetags.mptt_tags import cache_tree_children
 from biostar.server.ajax import json_response
 from django_select2 import AutoModelSelect2Field, AutoHeavySelect2Widget, AutoModelSelect2TagField
-import logging
+import json, logging, operator
+from django.core.cache import cache
+from django.db.models import Q
 
 logger = logging.getLogger(__name__)
 
@@ -97,6 +98,17 @@ class RelatedPostChoices(AutoModelSelect2Field):
     queryset = Post.objects.filter(type=0)
     search_fields = ['title__icontains', ]
 
+    def get_results(self, request, term, page, context):
+        "Questions are looked up in the title index"
+        from biostar.server import titles
+        from django_select2.views import NO_ERR_RESP
+
+        size = self.max_results or 25
+        rows = titles.search(term, limit=page * size + 1, types=[Post.QUESTION])
+        has_more = len(rows) > page * size
+        rows = rows[(page - 1) * size:page * size]
+        return (NO_ERR_RESP, has_more, [(row['id'], row['title'], {}) for row in rows])
+
 
 class RelatedForm(forms.ModelForm):
     model = RelatedPosts
@@ -427,53 +439,83 @@ class EditPost(LoginRequiredMixin, FormView):
 
 
 
+def tag_tree_json(href):
+    """
+    The tag tree in fancytree json format and the offset of each node in the text,
+    serialized once per tree version.
+    """
+    key = "tag-tree-%s-%s" % (Tag.tree_version(), int(href))
+    found = cache.get(key)
+    if found is None:
+        # Parents come before their children in tree order.
+        nodes, roots = {}, []
+        for pk, name, parent_id in Tag.objects.order_by("tree_id", "lft").values_list("id", "name", "parent_id"):
+            node = nodes[pk] = {'key': pk, 'title': name, 'children': []}
+            if href:
+                node['href'] = reverse("topic-list", kwargs=dict(topic=name))
+            parent = nodes.get(parent_id)
+            if parent:
+                parent['children'].append(node)
+            else:
+                roots.append(node)
+
+        # The offset of a node is just past its opening brace.
+        parts, offsets, size = [], {}, [0]
+
+        def write(text):
+            parts.append(text)
+            size[0] += len(text)
+
+        def dump(node):
+            write("{")
+            offsets[node['key']] = size[0]
+            fields = [('key', node['key']), ('title', node['title'])]
+            if 'href' in node:
+                fields.append(('href', node['href']))
+            write(", ".join("%s: %s" % (json.dumps(name), json.dumps(value)) for name, value in fields))
+            if node['children']:
+                write(', "children": [')
+                for pos, child in enumerate(node['children']):
+                    write(", " if pos else "")
+                    dump(child)
+                write("]")
+            write("}")
+
+        write("[")
+        for pos, node in enumerate(roots):
+            write(", " if pos else "")
+            dump(node)
+        write("]")
+        found = ("".join(parts), offsets)
+        cache.set(key, found, settings.TAG_TREE_TIMEOUT)
+    return found
+
+
 def tag_list(request, pk=None):
     """
     Ajax view which return list of tags in fancytree json format
     :param pk: -  add 'selected' attr to this post tags if passed
     """
-    post_tags = []
+    text, offsets = tag_tree_json(href=bool(request.GET.get('href', False)))
+
     if pk:
         post = Post.objects.get(pk=pk)
-        post_tags = [tag for tag in post.tag_set.all()]
-
-    def recursive_node_to_dict(node):
-
-        def is_active(a):
-            """
-            Return true if any child of node is selected .
-            """
-            for x in a:
-                if 'selected' in x:
-                    return True
-                if 'children' in x:
-                    return is_active(x['children'])
-            return False
-
-
-        result = {
-            'key': node.pk,
-            'title': node.name,
-        }
-        if node in post_tags:
-            result['selected'] = True
-
-
-        children = [recursive_node_to_dict(c) for c in node.get_children()]
-        if children:
-            result['children'] = children
-            # TODO: remove double recursion
-            if is_active(result['children']):
-                result['expanded'] = True
-
-        # Add tags link to json object
-        if request.GET.get('href', False):
-            result['href'] = node.get_absolute_url()
-
-        return result
-
-    root_nodes = cache_tree_children(Tag.objects.all())
-    dicts = []
-    for n in root_nodes:
-        dicts.append(recursive_node_to_dict(n))
-    return json_response(dicts)
+        tags = list(post.tag_set.all())
+
+        # The ancestors of the selected tags are expanded, found from the MPTT fields.
+        marks = dict((tag.pk, '"selected": true, ') for tag in tags)
+        if tags:
+            cond = reduce(operator.or_, (Q(tree_id=tag.tree_id, lft__lt=tag.lft, rght__gt=tag.rght) for tag in tags))
+            for ancestor in Tag.objects.filter(cond).values_list("id", flat=True):
+                marks[ancestor] = marks.get(ancestor, '') + '"expanded": true, '
+
+        # The marks go right after the opening braces of the nodes.
+        places = sorted((offsets[pk], mark) for pk, mark in marks.items() if pk in offsets)
+        parts, last = [], 0
+        for place, mark in places:
+            parts.extend([text[last:place], mark])
+            last = place
+        parts.append(text[last:])
+        text = "".join(parts)
+
+    return HttpResponse(text, content_type="application/json")
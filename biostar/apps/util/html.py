@@ -1,10 +1,15 @@
 import re
+import uuid
 import bleach
+import hashlib
 import logging
 import requests
 
 from django.conf import settings
+from django.core.cache import get_cache
 from django.template import loader, Context
+from django.utils.html import escape
+from django.utils.module_loading import import_by_path
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +39,12 @@ GIST_RE = re.compile(GIST_PATTERN)
 YOUTUBE_RE = re.compile(YOUTUBE_PATTERN)
 TWITTER_RE = re.compile(TWITTER_PATTERN)
 
+# The oEmbed endpoint for tweets.
+TWITTER_OEMBED_URL = "https://api.twitter.com/1/statuses/oembed.json?id=%s"
+
+# The results of oEmbed lookups are kept here.
+embeds = get_cache("embeds")
+
 def clean(text):
     "Sanitize text with no other substitutions"
     html = bleach.clean(text, tags=ALLOWED_TAGS,
@@ -48,32 +59,31 @@ def parse_html(text):
     # This will collect the objects that could be embedded
     embed = []
 
+    # Internal links are collected first then resolved together.
+    links = []
+    prefix = "link-%s-" % uuid.uuid4().hex
+
     def internal_links(attrs, new=False):
         "Matches a user"
-        try:
-            href = attrs['href']
-
-            # Don't resolve links if a user has already
-            # specified a text
-            if attrs['href'] != attrs['_text']:
-                return attrs
-
-            # Try the patterns
-            patt1 = POST_RE1.search(href)
-            patt2 = POST_RE2.search(href)
-            patt = patt1 or patt2
-            if patt:
-                uid = patt.group("uid")
-                attrs['_text'] = Post.objects.get(id=uid).title
+        href = attrs['href']
+
+        # Don't resolve links if a user has already
+        # specified a text
+        if attrs['href'] != attrs['_text']:
+            return attrs
+
+        # Try the post patterns then the user pattern.
+        patt = POST_RE1.search(href) or POST_RE2.search(href)
+        model = Post
+        if not patt:
+            patt = USER_RE.search(href)
+            model = User
 
-            # Try the user patterns
-            patt3 = USER_RE.search(href)
-            if patt3:
-                uid = patt3.group("uid")
-                attrs['_text'] = User.objects.get(id=uid).name
+        if patt:
+            # The text is filled in once all links are known.
+            attrs['_text'] = "%s%d-" % (prefix, len(links))
+            links.append((model, int(patt.group("uid")), href))
 
-        except Exception, exc:
-            logger.error(exc)
         return attrs
 
     def embedder(attrs, new):
@@ -122,8 +132,32 @@ def parse_html(text):
     except Exception, exc:
         logger.error("*** %s" % exc)
 
+    html = resolve_links(html, prefix, links)
+
     return html
 
+def resolve_links(html, prefix, links):
+    "Substitutes the link placeholders with one query for each model"
+    from biostar.apps.users.models import User
+    from biostar.apps.posts.models import Post
+
+    if not links:
+        return html
+
+    found = {}
+    for model, attr in ((Post, "title"), (User, "name")):
+        ids = set(uid for target, uid, href in links if target == model)
+        if ids:
+            objs = model.objects.in_bulk(list(ids))
+            found.update(((model, uid), getattr(obj, attr)) for uid, obj in objs.items())
+
+    def fill(match):
+        model, uid, href = links[int(match.group(1))]
+        # Links to missing objects keep their address.
+        return escape(found.get((model, uid), href))
+
+    return re.sub(r"%s(\d+)-" % prefix, fill, html)
+
 def get_embedded_tweet(tweet_id):
     """
     Get the HTML code with the embedded tweet.
@@ -135,12 +169,34 @@ def get_embedded_tweet(tweet_id):
     tweet_id -- a tweet's numeric id like 2311234267 for the tweet at
     https://twitter.com/Linux/status/2311234267
     """
+    return get_oembed(TWITTER_OEMBED_URL % tweet_id)
+
+def get_oembed(url):
+    """
+    Returns the html of an oEmbed response. The results are kept in the embeds cache,
+    failed lookups are retried after a shorter time.
+    """
+    key = "oembed-%s" % hashlib.md5(url).hexdigest()
+    html = embeds.get(key)
+    if html is not None:
+        return html
+
+    fetcher = import_by_path(settings.OEMBED_FETCHER)
     try:
-        response = requests.get("https://api.twitter.com/1/statuses/oembed.json?id={}".format(
-            tweet_id))
-        return response.json()['html']
-    except:
-        return ''
+        html = fetcher(url, timeout=settings.OEMBED_TIMEOUT)
+        timeout = settings.OEMBED_CACHE_TIMEOUT
+    except Exception, exc:
+        logger.error("oembed lookup failed for %s: %s" % (url, exc))
+        html, timeout = '', settings.OEMBED_RETRY_TIMEOUT
+
+    embeds.set(key, html, timeout)
+    return html
+
+def fetch_oembed(url, timeout):
+    "Fetches an oEmbed response over http"
+    response = requests.get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.json()['html']
 
 def strip_tags(text):
     "Strip html tags from text"
@@ -10,6 +10,8 @@ from django.conf import settings
 from biostar.apps.util import html
 
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.core.cache import get_cache
 
 logging.disable(logging.INFO)
 # The pattern that matches the user link.
@@ -32,6 +34,56 @@ class UtilTest(TestCase):
 
         #print (bleach.DEFAULT_CALLBACKS)
 
+# The urls passed to the fake oEmbed fetcher.
+FETCHED = []
 
+def fake_fetcher(url, timeout):
+    FETCHED.append(url)
+    return '<blockquote class="twitter-tweet">Tweet</blockquote>'
 
 
+class ParseHtmlTest(TestCase):
+
+    def setUp(self):
+        from biostar.apps.users.models import User
+        from biostar.apps.posts.models import Post
+
+        self.embeds = html.embeds
+        html.embeds = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='embeds-test')
+
+        self.user = User.objects.create(email='test@test.com', password='...', name="Jane Doe")
+        title = "Post 1, title needs to be sufficiently long"
+        self.post = Post.objects.create(title=title, content="Lorem ipsum", author=self.user, type=Post.QUESTION)
+
+    def tearDown(self):
+        html.embeds = self.embeds
+
+    def test_internal_links(self):
+        "Links to posts and users are resolved with one query for each model"
+        link = '<p><a href="http://{0}{1}">http://{0}{1}</a></p>'.format
+        domain = settings.SITE_DOMAIN
+        lines = []
+        for step in range(25):
+            lines.append(link(domain, "/p/%s/" % self.post.id))
+            lines.append(link(domain, "/u/%s/" % self.user.id))
+        lines.append(link(domain, "/p/%s/" % (self.post.id + 1000)))
+
+        with self.assertNumQueries(2):
+            text = html.parse_html("\n".join(lines))
+
+        self.assertEqual(text.count(self.post.title), 25)
+        self.assertEqual(text.count(self.user.name), 25)
+        self.assertTrue("/p/%s/</a>" % (self.post.id + 1000) in text)
+
+    @override_settings(OEMBED_FETCHER='biostar.apps.util.tests.fake_fetcher')
+    def test_embeds(self):
+        "Tweets are looked up once"
+        del FETCHED[:]
+        text = "https://twitter.com/Linux/status/2311234267"
+
+        for step in range(2):
+            with self.assertNumQueries(0):
+                result = html.parse_html(text)
+            self.assertTrue("twitter-tweet" in result)
+
+        self.assertEqual(len(FETCHED), 1)
@@ -1,5 +1,9 @@
 from __future__ import absolute_import
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F
+from collections import Counter, defaultdict
+from biostar.const import now
 
 from .celery import app
 
@@ -16,7 +20,7 @@ def init_awards():
     from biostar.apps.badges.award_defs import ALL_AWARDS
 
     for obj in ALL_AWARDS:
-        badge, created = Badge.objects.get_or_create(name=obj.name)
+        badge, created = Badge.objects.get_or_create(name=unicode(obj.name))
 
         # Badge descriptions may change.
         if badge.desc != obj.desc:
@@ -51,56 +55,101 @@ def check_user_profile(ip, user):
 @app.task
 # Tries to award a badge to the user
 def create_user_award(user):
-    from biostar.apps.users.models import User
-    from biostar.apps.posts.models import Post
-    from biostar.apps.badges.models import Badge, Award
-    from biostar.apps.badges.award_defs import ALL_AWARDS
-
+    from biostar.apps.badges import triggers
     logger.info("award check for %s" % user)
+    triggers.award([user.id])
 
-    # Update user status.
-    if (user.status == User.NEW_USER) and (user.score > 10):
-        user.status = User.TRUSTED
-        user.save()
-
-    # Debug only
-    #Award.objects.all().delete()
-
-    # The awards the user has won at this point
-    awards = dict()
-    for award in Award.objects.filter(user=user).select_related('badge'):
-        awards.setdefault(award.badge.name, []).append(award)
-
-    # Shorcut function to get the award count
-    get_award_count = lambda name: len(awards[name]) if name in awards else 0
 
-    for obj in ALL_AWARDS:
+@app.task
+def award_batch(user_ids):
+    "Awards the badges to the users with the ids"
+    from biostar.apps.badges import triggers
+    triggers.award(user_ids)
 
-        # How many times has been awarded
-        seen_count = get_award_count(obj.name)
 
-        # How many times should it been awarded
-        valid_targets = obj.validate(user)
+def chunks(ids, size=500):
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
 
-        # Keep that targets that have not been awarded
-        valid_targets = valid_targets[seen_count:]
 
-        # Some limit on awards
-        valid_targets = valid_targets[:100]
+def award_users(user_ids=None, limit=100):
+    """
+    Awards the badges to the users, all users when user_ids is None.
+    Each badge rule runs as a single query across the users, the results are compared
+    with the existing awards and the missing ones are inserted in bulk.
+    Returns the number of new awards.
+    """
+    from biostar.apps.badges.award_defs import ALL_AWARDS
 
-        # Award the targets
-        for target in valid_targets:
-            # Update the badge counts.
-            badge = Badge.objects.get(name=obj.name)
-            badge.count += 1
-            badge.save()
+    return grant([(obj, user_ids) for obj in ALL_AWARDS], user_ids, limit=limit)
 
-            if isinstance(target, Post):
-                context = '<a href="%s">%s</a>' % (target.get_absolute_url(), target.title)
-            else:
-                context = ""
 
-            date = user.profile.last_login
-            award = Award.objects.create(user=user, badge=badge, date=date, context=context)
-            logger.info("award %s created for %s" % (award.badge.name, user.email))
+def grant(checks, user_ids, limit=100):
+    """
+    Runs the (award definition, user ids) checks and creates the missing awards.
+    The user_ids cover the users of all checks, None for all users.
+    """
+    from biostar.apps.users.models import User
+    from biostar.apps.posts.models import Post
+    from biostar.apps.badges.models import Badge, Award
+    from biostar.apps.badges.award_defs import ALL_AWARDS
+    from biostar.server.models import create_award_messages
+    from biostar.server.context import bump_sidebar
 
+    # Update user status.
+    trusted = User.objects.filter(status=User.NEW_USER, score__gt=10)
+    if user_ids is not None:
+        trusted = trusted.filter(pk__in=user_ids)
+    trusted.update(status=User.TRUSTED)
+
+    badges = dict((badge.name, badge) for badge in Badge.objects.all())
+    if len(badges) < len(ALL_AWARDS):
+        init_awards()
+        badges = dict((badge.name, badge) for badge in Badge.objects.all())
+
+    # How many times each user has won each badge.
+    seen = Award.objects.order_by()
+    if user_ids is not None:
+        seen = seen.filter(user__in=user_ids)
+    seen = seen.values("user", "badge").annotate(total=Count("id"))
+    seen = dict(((row["user"], row["badge"]), row["total"]) for row in seen)
+
+    # The targets that have not been awarded yet, a target keeps its place in the order of the posts.
+    missing = []
+    for obj, ids in checks:
+        badge_id = badges[unicode(obj.name)].id
+        targets = defaultdict(list)
+        for user_id, post_id in obj.validate(ids):
+            targets[user_id].append(post_id)
+        for user_id, post_ids in targets.items():
+            start = seen.get((user_id, badge_id), 0)
+            missing.extend((badge_id, user_id, post_id) for post_id in post_ids[start:start + limit])
+
+    if not missing:
+        return 0
+
+    users, posts = {}, {}
+    for ids in chunks(set(user_id for badge_id, user_id, post_id in missing)):
+        users.update(User.objects.filter(pk__in=ids).select_related("profile").in_bulk(ids))
+    for ids in chunks(set(post_id for badge_id, user_id, post_id in missing if post_id)):
+        posts.update(Post.objects.filter(pk__in=ids).only("id", "title", "type", "root").in_bulk(ids))
+
+    awards = []
+    by_id = dict((badge.id, badge) for badge in badges.values())
+    for badge_id, user_id, post_id in missing:
+        post, user = posts.get(post_id), users[user_id]
+        context = '<a href="%s">%s</a>' % (post.get_absolute_url(), post.title) if post else ""
+        awards.append(Award(user=user, badge=by_id[badge_id], date=user.profile.last_login or now(), context=context))
+
+    with transaction.atomic():
+        Award.objects.bulk_create(awards, batch_size=500)
+        for badge_id, count in Counter(badge_id for badge_id, user_id, post_id in missing).items():
+            Badge.objects.filter(pk=badge_id).update(count=F("count") + count)
+
+        # The bulk insert does not send signals, the winners still get their messages.
+        create_award_messages(awards)
+    bump_sidebar("awards")
+
+    logger.info("created %s awards" % len(awards))
+    return len(awards)
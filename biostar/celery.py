@@ -17,7 +17,7 @@ app.config_from_object(settings.CELERY_CONFIG)
 
 # Discover tasks in applications.
 app.autodiscover_tasks(
-    lambda: ["biostar.mailer", "biostar.awards"]
+    lambda: ["biostar.mailer", "biostar.awards", "biostar.notify"]
 )
 
 
@@ -33,6 +33,30 @@ def call_command(name, *args, **kwargs):
     from django.core.management import call_command
     call_command(name, *args, **kwargs)
 
+@app.task
+def warm_pages():
+    "Stores the first home page in the page cache"
+    from biostar.server import pagecache
+    pagecache.render_home()
+
+@app.task
+def drain_index():
+    "Indexes the queued post and blog post changes"
+    from biostar.server import indexing
+    indexing.drain()
+
+@app.task
+def check_awards():
+    "Checks the badges that depend on the recently changed counters"
+    from biostar.apps.badges import triggers
+    triggers.check()
+
+@app.task
+def similar_posts():
+    "Computes the similar questions of the recently edited questions"
+    from biostar.apps.posts import similar
+    similar.update()
+
 @app.task
 def test(*args, **kwds):
     logger.info("*** executing task %s %s, %s" % (__name__, args, kwds))
\ No newline at end of file
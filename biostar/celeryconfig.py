@@ -1,77 +1,121 @@
-from __future__ import absolute_import
-from datetime import timedelta
-from celery.schedules import crontab
-
-CELERY_RESULT_BACKEND = 'djcelery.backends.database:DatabaseBackend'
-
-BROKER_URL = 'django://'
-
-CELERY_TASK_SERIALIZER = 'pickle'
-
-CELERY_ACCEPT_CONTENT = ['pickle']
-
-CELERYBEAT_SCHEDULE = {
-
-    'prune_data': {
-        'task': 'biostar.celery.call_command',
-        'schedule': timedelta(days=1),
-        'kwargs': dict(name="prune_data")
-    },
-
-    'sitemap': {
-        'task': 'biostar.celery.call_command',
-        'schedule': timedelta(hours=6),
-        'kwargs': dict(name="sitemap")
-    },
-
-    'update_index': {
-        'task': 'biostar.celery.call_command',
-        'schedule': timedelta(minutes=15),
-        'args': ["update_index"],
-        'kwargs': {"age": 1}
-    },
-
-    'awards': {
-        'task': 'biostar.celery.call_command',
-        'schedule': timedelta(hours=3),
-        'args': ["user_crawl"],
-        'kwargs': {"award": True}
-    },
-
-    'hourly_dump': {
-        'task': 'biostar.celery.call_command',
-        'schedule': crontab(minute=10),
-        'args': ["biostar_pg_dump"],
-        'kwargs': {"hourly": True}
-    },
-
-    'daily_dump': {
-        'task': 'biostar.celery.call_command',
-        'schedule': crontab(hour=22),
-        'args': ["biostar_pg_dump"],
-    },
-
-    'hourly_feed': {
-        'task': 'biostar.celery.call_command',
-        'schedule': crontab(minute=10),
-        'args': ["planet"],
-        'kwargs': {"update": 1}
-    },
-
-    'daily_feed': {
-        'task': 'biostar.celery.call_command',
-        'schedule': crontab(hour='*/2', minute=15),
-        'args': ["planet"],
-        'kwargs': {"download": True}
-    },
-
-    'bump': {
-        'task': 'biostar.celery.call_command',
-        'schedule': timedelta(hours=6),
-        'args': ["patch"],
-        'kwargs': {"bump": True}
-    },
-
-}
-
+from __future__ import absolute_import
+from datetime import timedelta
+from celery.schedules import crontab
+
+CELERY_RESULT_BACKEND = 'djcelery.backends.database:DatabaseBackend'
+
+BROKER_URL = 'django://'
+
+CELERY_TASK_SERIALIZER = 'pickle'
+
+CELERY_ACCEPT_CONTENT = ['pickle']
+
+CELERYBEAT_SCHEDULE = {
+
+    'prune_data': {
+        'task': 'biostar.celery.call_command',
+        'schedule': timedelta(days=1),
+        'kwargs': dict(name="prune_data")
+    },
+
+    'sitemap': {
+        'task': 'biostar.celery.call_command',
+        'schedule': timedelta(hours=6),
+        'kwargs': dict(name="sitemap")
+    },
+
+    'flush_views': {
+        'task': 'biostar.celery.call_command',
+        'schedule': timedelta(minutes=1),
+        'args': ["flush_views"],
+    },
+
+    'flush_counters': {
+        'task': 'biostar.celery.call_command',
+        'schedule': timedelta(minutes=1),
+        'args': ["flush_counters"],
+    },
+
+    'resume_fan_outs': {
+        'task': 'biostar.notify.resume_fan_outs',
+        'schedule': timedelta(minutes=10),
+    },
+
+    'drain_index': {
+        'task': 'biostar.celery.drain_index',
+        'schedule': timedelta(minutes=1),
+    },
+
+    'check_awards': {
+        'task': 'biostar.celery.check_awards',
+        'schedule': timedelta(minutes=10),
+    },
+
+    'similar_posts': {
+        'task': 'biostar.celery.similar_posts',
+        'schedule': timedelta(hours=1),
+    },
+
+    'tag_suggest': {
+        'task': 'biostar.celery.call_command',
+        'schedule': timedelta(hours=1),
+        'args': ["tag_suggest"],
+    },
+
+    'tag_suggest_full': {
+        'task': 'biostar.celery.call_command',
+        'schedule': crontab(hour=3, minute=30),
+        'args': ["tag_suggest"],
+        'kwargs': {"full": True}
+    },
+
+    'stats_rollup': {
+        'task': 'biostar.celery.call_command',
+        'schedule': crontab(hour=0, minute=20),
+        'args': ["stats_rollup"],
+    },
+
+    'awards': {
+        'task': 'biostar.celery.call_command',
+        'schedule': timedelta(hours=3),
+        'args': ["user_crawl"],
+        'kwargs': {"award": True}
+    },
+
+    'hourly_dump': {
+        'task': 'biostar.celery.call_command',
+        'schedule': crontab(minute=10),
+        'args': ["biostar_pg_dump"],
+        'kwargs': {"hourly": True}
+    },
+
+    'daily_dump': {
+        'task': 'biostar.celery.call_command',
+        'schedule': crontab(hour=22),
+        'args': ["biostar_pg_dump"],
+    },
+
+    'hourly_feed': {
+        'task': 'biostar.celery.call_command',
+        'schedule': crontab(minute=10),
+        'args': ["planet"],
+        'kwargs': {"update": 1}
+    },
+
+    'daily_feed': {
+        'task': 'biostar.celery.call_command',
+        'schedule': crontab(hour='*/2', minute=15),
+        'args': ["planet"],
+        'kwargs': {"download": True}
+    },
+
+    'bump': {
+        'task': 'biostar.celery.call_command',
+        'schedule': timedelta(hours=6),
+        'args': ["patch"],
+        'kwargs': {"bump": True}
+    },
+
+}
+
 CELERY_TIMEZONE = 'UTC'
\ No newline at end of file
@@ -0,0 +1,176 @@
+"""
+Notifications for new posts.
+
+The fan out runs as a celery task. Tag watchers are subscribed first, then the subscribers
+are processed in chunks ordered by user id. Each chunk creates the messages and reply tokens
+and hands its emails to a separate task. The progress is stored in a FanOut row after each
+chunk, an interrupted fan out continues from the last notified user.
+"""
+from __future__ import absolute_import
+from datetime import timedelta
+from django.conf import settings
+
+from .celery import app
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+# This will be the message body on the site.
+POST_CREATED_TEXT = "messages/post_created.txt"
+POST_CREATED_HTML = "messages/post_created.html"
+POST_CREATED_SHORT = "messages/post_created_short.html"
+
+
+def dispatch(task, *args):
+    "Runs the task in the background or right away, depending on the settings"
+    if settings.NOTIFY_IN_BACKGROUND:
+        return task.delay(*args)
+    return task(*args)
+
+
+def chunks(query, field="id", start=0):
+    "Yields the query in chunks ordered by the field, each chunk is a single query. Works on flat value lists too."
+    last, size = start, settings.NOTIFY_CHUNK_SIZE
+    while True:
+        chunk = list(query.filter(**{"%s__gt" % field: last}).order_by(field)[:size])
+        if not chunk:
+            break
+        yield chunk
+        last = chunk[-1] if isinstance(chunk[-1], (int, long)) else getattr(chunk[-1], field)
+
+
+def subscribe_watchers(post):
+    "Subscribes the users that watch the tags of the post or that want all messages"
+    from django.db.models import Q
+    from biostar.apps.users.models import User
+    from biostar.apps.posts.models import Subscription
+    from biostar.const import ALL_MESSAGES, EMAIL_MESSAGE
+
+    cond = Q(profile__message_prefs=ALL_MESSAGES) | Q(profile__tags__name__in=post.parse_tags())
+
+    # The join over the tags may return the same user more than once.
+    watchers = User.objects.filter(cond).exclude(id=post.author_id).values_list("id", flat=True).distinct()
+
+    for user_ids in chunks(watchers):
+        Subscription.objects.subscribe(post, user_ids, EMAIL_MESSAGE)
+
+
+@app.task
+def fan_out(post_id):
+    "Sends the notifications for a new post"
+    from biostar.apps.posts.models import Post
+    from biostar.apps.messages.models import FanOut
+    from biostar.const import now
+
+    try:
+        post = Post.objects.select_related("author", "root").get(pk=post_id)
+    except Post.DoesNotExist:
+        logger.warning("post %s does not exist" % post_id)
+        return
+
+    fanout, created = FanOut.objects.get_or_create(post=post)
+    if fanout.state == FanOut.DONE:
+        return
+
+    try:
+        notify(fanout, post)
+    except Exception, exc:
+        FanOut.objects.filter(pk=fanout.pk).update(state=FanOut.FAILED, error=unicode(exc), updated=now())
+        logger.error("fan out for post %s failed: %s" % (post_id, exc))
+        raise
+
+
+def notify(fanout, post):
+    "Creates the messages and emails for the subscribers not yet notified"
+    from django.core import mail
+    from django.db import transaction
+    from django.db.models import F
+    from django.contrib.sites.models import Site
+    from biostar.apps.posts.models import Subscription, ReplyToken
+    from biostar.apps.messages.models import Message, MessageBody, FanOut
+    from biostar.apps.util import html, make_uuid
+    from biostar.const import EMAIL_MESSAGE, ALL_MESSAGES, now
+
+    author = post.author
+
+    if post.is_toplevel:
+        subscribe_watchers(post)
+
+    # The templates are rendered once for all subscribers.
+    site = Site.objects.get_current()
+    email_text = html.render(name=POST_CREATED_TEXT, post=post, user=author, site=site)
+    email_html = html.render(name=POST_CREATED_HTML, post=post, user=author, site=site)
+
+    # A resumed fan out keeps its message body.
+    body = fanout.body
+    if not body:
+        content = html.render(name=POST_CREATED_SHORT, post=post, user=author)
+        body = MessageBody.objects.create(author=author, subject=post.root.title,
+                                          text=content, sent_at=post.creation_date)
+        FanOut.objects.filter(pk=fanout.pk).update(body=body)
+
+    from_email = settings.EMAIL_FROM_PATTERN % (author.name, settings.DEFAULT_FROM_EMAIL)
+    from_email = from_email.encode("utf-8")
+    subject = settings.EMAIL_REPLY_SUBJECT % body.subject
+
+    subs = Subscription.objects.get_subs(post).exclude(user=author)
+
+    for chunk in chunks(subs, field="user", start=fanout.last_user_id):
+        messages, tokens, emails = [], [], []
+        for sub in chunk:
+            messages.append(Message(user=sub.user, body=body, sent_at=body.sent_at))
+
+            # Collect a bulk email if the subscription is by email.
+            if sub.type in (EMAIL_MESSAGE, ALL_MESSAGES):
+                token = ReplyToken(user=sub.user, post=post, token=make_uuid(8), date=now())
+                reply_to = settings.EMAIL_REPLY_PATTERN % token.token
+                email = mail.EmailMultiAlternatives(
+                    subject=subject,
+                    body=email_text,
+                    from_email=from_email,
+                    to=[sub.user.email],
+                    headers={'Reply-To': reply_to},
+                )
+                email.attach_alternative(email_html, "text/html")
+                emails.append(email)
+                tokens.append(token)
+
+        # The messages and the progress are stored together.
+        # The email tasks update the same row, hence no save.
+        with transaction.atomic():
+            Message.objects.bulk_create(messages, batch_size=100)
+            ReplyToken.objects.bulk_create(tokens, batch_size=100)
+            FanOut.objects.filter(pk=fanout.pk).update(last_user_id=chunk[-1].user_id, sent=F("sent") + len(messages),
+                                                       updated=now())
+            if emails:
+                dispatch(send_emails, emails, fanout.id)
+
+    FanOut.objects.filter(pk=fanout.pk).update(state=FanOut.DONE, updated=now())
+
+
+@app.task
+def send_emails(emails, fanout_id):
+    "Sends a batch of emails over one connection"
+    from django.core import mail
+    from django.db.models import F
+    from biostar.apps.messages.models import FanOut
+
+    try:
+        conn = mail.get_connection()
+        conn.send_messages(emails)
+    except Exception, exc:
+        logger.error("email error %s" % exc)
+        FanOut.objects.filter(pk=fanout_id).update(failed=F("failed") + len(emails), error=unicode(exc))
+
+
+@app.task
+def resume_fan_outs():
+    "Restarts the fan outs that made no progress for a while"
+    from biostar.apps.messages.models import FanOut
+    from biostar.const import now
+
+    since = now() - timedelta(minutes=settings.NOTIFY_RESUME_MINUTES)
+    for post_id in FanOut.objects.exclude(state=FanOut.DONE).filter(updated__lt=since).values_list("post_id", flat=True):
+        logger.info("resuming fan out for post %s" % post_id)
+        fan_out.delay(post_id)
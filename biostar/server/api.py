@@ -2,8 +2,7 @@ import json
 import logging
 from datetime import datetime, timedelta
 from calendar import timegm
-from os.path import join, normpath, isfile, exists
-from os import makedirs
+from math import sqrt
 
 from django.http import HttpResponse
 from django.contrib.sites.models import get_current_site
@@ -11,7 +10,9 @@ from django.conf import settings
 from django.core.cache import get_cache
 
 from ..apps.users.models import User
-from ..apps.posts.models import Vote, Post, PostView
+from ..apps.posts.models import Vote, Post
+from ..apps.posts import tracking
+from . import stats
 
 
 logger = logging.getLogger(__name__)
@@ -40,20 +41,14 @@ def json_response(f):
 @json_response
 def traffic(request):
     """
-    Traffic as post views in the last 60 min.
+    Traffic as the estimated distinct IPs that viewed a post in the last 60 min.
     """
     now = datetime.now()
-    start = now-timedelta(minutes=60)
-    try:
-        post_views = PostView.objects.filter(date__gt=start).exclude(date__gt=now).distinct(
-            'ip').count()
-    except NotImplementedError:
-        post_views = PostView.objects.filter(date__gt=start).exclude(date__gt=now).count()
-
     data = {
         'date': datetime_to_iso(now),
         'timestamp': datetime_to_unix(now),
-        'post_views_last_60_min': post_views,
+        'post_views_last_60_min': tracking.traffic(60),
+        'relative_error': round(1.04 / sqrt(2 ** settings.TRAFFIC_PRECISION), 4),
     }
     return data
 
@@ -163,8 +158,8 @@ def daily_stats_on_day(request, day):
     """
     date = days_after_day_zero_to_datetime(day)
 
-    # We don't provide stats for today or the future.
-    if not date or date.date() >= datetime.today().date():
+    # We don't provide stats for the days that are not rolled up yet, today or the future.
+    if not date or date.date() > stats.last_day():
         return {}
     return compute_stats(date)
 
@@ -180,115 +175,62 @@ def daily_stats_on_date(request, year, month, day):
     day -- Day, 2 digits.
     """
     date = datetime(int(year), int(month), int(day))
-    # We don't provide stats for today or the future.
-    if date.date() >= datetime.today().date():
+    # We don't provide stats for the days that are not rolled up yet, today or the future.
+    if date.date() > stats.last_day():
         return {}
     return compute_stats(date)
 
 
-## Statistics #####################################################################################
-
-STATS_FOLDER = normpath(join(settings.EXPORT_DIR, 'stats'))
-
-
-def compute_stats(date):
+@json_response
+def daily_stats_in_range(request, start, end):
     """
-    Statistics about this website for the given date.
-    Statistics are stored to a json file for caching purpose.
+    Statistics about this website for each day from start to end, both included.
 
     Parameters:
-    date -- a `datetime`.
+    start -- the first date, as YYYY-MM-DD.
+    end -- the last date, as YYYY-MM-DD.
     """
-
-    start = date.date()
-    end = start + timedelta(days=1)
-
     try:
-        return load_stats_from_file(start)
-    except IOError:  # This will be FileNotFoundError in Python3.
-        logger.info('No stats file for {}.'.format(start))
-
-    query = Post.objects.filter
-
-    questions = query(type=Post.QUESTION, creation_date__lt=end).count()
-    answers = query(type=Post.ANSWER, creation_date__lt=end).count()
-    toplevel = query(type__in=Post.TOP_LEVEL, creation_date__lt=end).exclude(
-        type=Post.BLOG).count()
-    comments = query(type=Post.COMMENT, creation_date__lt=end).count()
-    votes = Vote.objects.filter(date__lt=end).count()
-    users = User.objects.filter(profile__date_joined__lt=end).count()
-
-    new_users = User.objects.filter(profile__date_joined__gte=start, profile__date_joined__lt=end)
-    new_users_ids = [user.id for user in new_users]
-
-    new_posts = Post.objects.filter(creation_date__gte=start, creation_date__lt=end)
-    new_posts_ids = [post.id for post in new_posts]
+        start = datetime.strptime(start, '%Y-%m-%d').date()
+        end = datetime.strptime(end, '%Y-%m-%d').date()
+    except ValueError:
+        return {}
 
-    new_votes = Vote.objects.filter(date__gte=start, date__lt=end)
-    new_votes_ids = [vote.id for vote in new_votes]
+    # We don't provide stats for the days that are not rolled up yet, today or the future.
+    end = min(end, stats.last_day())
+    if end < start or (end - start).days >= settings.STATS_RANGE_LIMIT:
+        return {}
 
-    data = {
-        'date': datetime_to_iso(start),
-        'timestamp': datetime_to_unix(start),
-        'questions': questions,
-        'answers': answers,
-        'toplevel': toplevel,
-        'comments': comments,
-        'votes': votes,
-        'users': users,
-        'new_users': new_users_ids,
-        'new_posts': new_posts_ids,
-        'new_votes': new_votes_ids,
+    return {
+        'start': datetime_to_iso(start),
+        'end': datetime_to_iso(end),
+        'days': [stats_data(day) for day in stats.days(start, end)],
     }
 
-    if not settings.DEBUG:
-        dump_stats_to_file(start, data)
-    return data
-
-
-def load_stats_from_file(date):
-    """
-    Load stats data from a stat file.
-
-    Params:
-    date -- a `datetime` instance.
-    """
-    file_path = _build_stats_file_path(date)
-
-    if not isfile(file_path):
-        raise IOError  # This will be FileNotFoundError in Python3.
-
-    with open(file_path, 'r') as fin:
-        return json.loads(fin.read())
 
+## Statistics #####################################################################################
 
-def dump_stats_to_file(date, data):
+def compute_stats(date):
     """
-    Store stats data to a json file for caching purpose.
+    Statistics about this website for the given date, read from the daily rollup.
 
-    Params:
-    date -- a `datetime` instance.
-    data -- stats data in a dictionary.
+    Parameters:
+    date -- a `datetime`.
     """
-    if not exists(STATS_FOLDER):
-        # Ensure STATS_FOLDER exists.
-        makedirs(STATS_FOLDER)
+    return stats_data(stats.days(date.date(), date.date())[0])
 
-    file_path = _build_stats_file_path(date)
 
-    with open(file_path, 'w') as fout:
-        fout.write(json.dumps(data))
-
-
-def _build_stats_file_path(date):
+def stats_data(day):
     """
-    Build the path of a stat file from a date.
+    The json form of the statistics of a day.
 
     Params:
-    date -- a `datetime` instance.
+    day -- a dictionary from `stats.days`.
     """
-    file_name = '{}-{}-{}.json'.format(date.year, date.month, date.day)
-    return normpath(join(STATS_FOLDER, file_name))
+    data = dict(day)
+    data['date'] = datetime_to_iso(day['date'])
+    data['timestamp'] = datetime_to_unix(day['date'])
+    return data
 
 
 ## Date utils #####################################################################################
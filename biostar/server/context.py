@@ -3,12 +3,15 @@ from django.conf import settings
 from biostar import const, VERSION
 from django.core.cache import cache
 from biostar.apps.users.models import User
-from biostar.apps.posts.models import Post, Vote, PostView
+from biostar.apps.posts.models import Post, Vote
+from biostar.apps.posts import tracking
+from biostar.server import pagecache
 from biostar.apps.badges.models import Award
 
-from datetime import timedelta
 from math import pow, e, log
 from random import random
+from functools import partial
+from collections import Counter
 
 LOG2 = log(2)
 CACHE_TIMEOUT = settings.CACHE_TIMEOUT
@@ -38,21 +41,98 @@ def get_recent_replies():
     return posts
 
 
+def get_marker(user):
+    "The flair shown next to a user name"
+    if user.is_admin:
+        return '&diams;&diams;'
+    if user.is_moderator:
+        return '&diams;'
+    return "&bull;"
+
+
+def user_row(user):
+    return dict(id=user.id, name=user.name, scaled_score=user.scaled_score, marker=get_marker(user),
+                url=user.get_absolute_url())
+
+
+def reply_rows():
+    return [
+        dict(title=post.title, url=post.get_absolute_url(), peek=post.peek(), author=user_row(post.author))
+        for post in get_recent_replies()
+    ]
+
+
+def vote_rows():
+    return [
+        dict(post=dict(title=vote.post.title, url=vote.post.get_absolute_url()))
+        for vote in get_recent_votes()
+    ]
+
+
+def user_rows():
+    return [
+        dict(profile=dict(location=user.profile.location, last_login=user.profile.last_login))
+        for user in get_recent_users()
+    ]
+
+
+def award_rows():
+    return [
+        dict(badge=dict(id=award.badge.id, name=award.badge.name, icon=award.badge.icon), user=user_row(award.user))
+        for award in get_recent_awards()
+    ]
+
+
+# Each sidebar block is built by a function producing plain rows.
+SIDEBAR_BLOCKS = dict(replies=reply_rows, votes=vote_rows, users=user_rows, awards=award_rows)
+
+# Sidebar cache hits and misses in this process.
+SIDEBAR_STATS = Counter()
+
+
+def sidebar_generation(name):
+    "Returns the current generation of a sidebar block"
+    key = "sidebar-gen-%s" % name
+    gen = cache.get(key)
+    if gen is None:
+        gen = 1
+        cache.add(key, gen, None)
+    return gen
+
+
+def bump_sidebar(*names):
+    "Invalidates sidebar blocks by moving them to a new generation"
+    for name in names:
+        key = "sidebar-gen-%s" % name
+        try:
+            cache.incr(key)
+        except ValueError:
+            # The generation is not in the cache yet.
+            cache.add(key, 2, None)
+
+
+def get_sidebar(name):
+    "Returns the rows of a sidebar block from the cache, builds them on a miss"
+    key = "sidebar-%s-%s" % (name, sidebar_generation(name))
+    rows = cache.get(key)
+    if rows is None:
+        SIDEBAR_STATS['miss'] += 1
+        rows = SIDEBAR_BLOCKS[name]()
+        cache.set(key, rows, settings.SIDEBAR_CACHE_TIMEOUT)
+    else:
+        SIDEBAR_STATS['hit'] += 1
+    return rows
+
+
 TRAFFIC_KEY = "traffic"
 
 
 def get_traffic(minutes=60):
-    "Obtains the number of distinct IP numbers "
+    "Obtains the estimated number of distinct IP numbers "
     global TRAFFIC_KEY
     traffic = cache.get(TRAFFIC_KEY)
     if not traffic:
-        recent = const.now() - timedelta(minutes=minutes)
-        try:
-            traffic = PostView.objects.filter(date__gt=recent).distinct('ip').count()
-        except NotImplementedError, exc:
-            traffic = PostView.objects.filter(date__gt=recent).values_list('ip')
-            traffic = [t[0] for t in traffic]
-            traffic = len(set(traffic))
+        traffic = tracking.traffic(minutes)
         cache.set(TRAFFIC_KEY, traffic, CACHE_TIMEOUT)
     return traffic
 
@@ -77,12 +157,14 @@ def shortcuts(request):
         "CATEGORIES": settings.CATEGORIES,
         "BIOSTAR_VERSION": VERSION,
         "TRAFFIC": get_traffic(),
-        'RECENT_REPLIES': get_recent_replies(),
-        'RECENT_VOTES': get_recent_votes(),
-        "RECENT_USERS": get_recent_users(),
-        "RECENT_AWARDS": get_recent_awards(),
+        # Templates call these only when the sidebar is rendered.
+        'RECENT_REPLIES': partial(get_sidebar, "replies"),
+        'RECENT_VOTES': partial(get_sidebar, "votes"),
+        "RECENT_USERS": partial(get_sidebar, "users"),
+        "RECENT_AWARDS": partial(get_sidebar, "awards"),
         'USE_COMPRESSOR': settings.USE_COMPRESSOR,
-        'COUNTS': request.session.get(settings.SESSION_KEY, {}),
+        # Pages stored in the page cache are shared by all visitors.
+        'COUNTS': {} if pagecache.counts_hidden(request) else request.session.get(settings.SESSION_KEY, {}),
         'SITE_ADMINS': settings.ADMINS,
         'TOP_BANNER': settings.TOP_BANNER,
         'BANNER_TRIGGER': banner_trigger(request),
@@ -0,0 +1,223 @@
+"""
+Time bucketed activity counters.
+
+Every event increments one hourly and one daily bucket, stored as rows of the
+ActivityCount table so that all processes and the celery workers share them.
+The number of events since a given time is the sum of the few buckets
+that cover the interval: hourly buckets at the edges, daily buckets in between.
+
+The events are appended to a spool file for each process, a periodic task sums
+the spool by bucket and applies the sums, the requests do not update the bucket rows.
+"""
+from __future__ import print_function, unicode_literals, absolute_import, division
+import os, glob, time, uuid, logging, calendar, urllib
+from collections import defaultdict
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+from biostar import const
+
+logger = logging.getLogger(__name__)
+
+HOUR, DAY = 60 * 60, 24 * 60 * 60
+
+# How long the buckets are kept. Hourly buckets are only needed for the edges of an interval.
+TIMEOUTS = {HOUR: 2 * DAY + HOUR, DAY: settings.COUNTER_RETENTION_DAYS * DAY}
+
+
+def aware(date):
+    "Imported data may carry naive dates"
+    return date if timezone.is_aware(date) else timezone.make_aware(date, timezone.utc)
+
+
+def bucket(date, size):
+    "The index of the bucket that contains the date"
+    return calendar.timegm(date.utctimetuple()) // size
+
+
+def make_key(kind, name, size, index):
+    name = urllib.quote(unicode(name).encode("utf-8"))
+    return "counter-%s-%s-%s-%s" % (kind, name, size, index)
+
+
+def expires(size, index):
+    "The time after which the bucket is no longer needed"
+    end = datetime.utcfromtimestamp((index + 1) * size).replace(tzinfo=timezone.utc)
+    return end + timedelta(seconds=TIMEOUTS[size])
+
+
+def spool_path():
+    "Each process writes into its own spool file"
+    return os.path.join(settings.COUNTER_SPOOL_DIR, "counters-%s.txt" % os.getpid())
+
+
+def incr(kind, name, date=None, delta=1):
+    "Records events into the buckets that contain the date, the buckets are updated by the next flush"
+    date = aware(date) if date else const.now()
+
+    # Events older than the retention period are never counted.
+    if date < const.now() - timedelta(days=settings.COUNTER_RETENTION_DAYS):
+        return
+
+    lines = ["%s %s\n" % (make_key(kind, name, size, bucket(date, size)), delta) for size in TIMEOUTS]
+    try:
+        if not os.path.isdir(settings.COUNTER_SPOOL_DIR):
+            os.makedirs(settings.COUNTER_SPOOL_DIR)
+        with open(spool_path(), "a") as fp:
+            fp.write("".join(lines).encode("utf-8"))
+    except (IOError, OSError), exc:
+        logger.error("unable to spool counter: %s" % exc)
+
+
+def add(key, delta):
+    "Adds the delta to the bucket"
+    from biostar.apps.posts.models import ActivityCount
+
+    if ActivityCount.objects.filter(key=key).update(value=F("value") + delta):
+        return
+    try:
+        with transaction.atomic():
+            # The key ends with the size and the index of the bucket.
+            size, index = map(int, key.rsplit("-", 2)[1:])
+            ActivityCount.objects.create(key=key, value=delta, expires=expires(size, index))
+    except IntegrityError:
+        # Another process has created the bucket in the meantime.
+        ActivityCount.objects.filter(key=key).update(value=F("value") + delta)
+
+
+def collect():
+    """
+    Renames the spool files to names of this flush then parses them.
+    Files of a flush that did not finish are taken over after the timeout.
+    Returns the files and the (key, delta) events.
+    """
+    token, now = uuid.uuid4().hex, time.time()
+    fnames = []
+    for fname in glob.glob(os.path.join(settings.COUNTER_SPOOL_DIR, "counters-*.txt")) + \
+            glob.glob(os.path.join(settings.COUNTER_SPOOL_DIR, "*.flush")):
+        target = "%s.%s.flush" % (fname[:fname.index(".txt") + 4], token)
+        try:
+            if fname.endswith(".flush") and now - os.path.getmtime(fname) < settings.COUNTER_FLUSH_TIMEOUT:
+                continue
+            os.rename(fname, target)
+            # The time of the rename marks the claim.
+            os.utime(target, None)
+            fnames.append(target)
+        except OSError, exc:
+            # Another flush has taken the file.
+            logger.error(exc)
+
+    events = []
+    for fname in fnames:
+        try:
+            lines = open(fname).readlines()
+        except IOError, exc:
+            logger.error(exc)
+            continue
+        for line in lines:
+            try:
+                key, delta = line.split()
+                events.append((key, int(delta)))
+            except ValueError:
+                logger.error("invalid spool line: %r" % line)
+
+    return fnames, events
+
+
+def flush():
+    "Applies the spooled events to the buckets. Returns the number of events."
+    if not os.path.isdir(settings.COUNTER_SPOOL_DIR):
+        return 0
+
+    fnames, events = collect()
+
+    # Each bucket is updated once with the sum of its events.
+    sums = defaultdict(int)
+    for key, delta in events:
+        sums[key] += delta
+
+    with transaction.atomic():
+        for key, delta in sorted(sums.items()):
+            if delta:
+                add(key, delta)
+
+        # The files go before the commit, a crash loses the events instead of counting them twice.
+        for fname in fnames:
+            try:
+                os.remove(fname)
+            except OSError, exc:
+                logger.error(exc)
+
+    logger.info("flushed %s counter events into %s buckets" % (len(events), len(sums)))
+    return len(events)
+
+
+def count_post(post, delta):
+    """
+    Adds an open top level post to the new posts, the unanswered questions and its tags,
+    a delta of -1 takes it off when it is closed, deleted or removed.
+    """
+    from biostar.apps.posts.models import Post
+
+    if not post.is_toplevel:
+        return
+
+    date = post.creation_date
+    incr("type", "latest", date=date, delta=delta)
+    if post.type == Post.QUESTION and post.reply_count == 0:
+        incr("type", "open", date=date, delta=delta)
+    # A removed post loses the tags that no other post carries before the delete signals.
+    for name in post.parse_tags():
+        incr("tag", name, date=date, delta=delta)
+
+
+def prune():
+    "Deletes the expired buckets"
+    from biostar.apps.posts.models import ActivityCount
+
+    query = ActivityCount.objects.filter(expires__lt=const.now())
+    logger.info("deleting %s counter buckets" % query.count())
+    query.delete()
+
+
+def spans(since, now):
+    "The buckets that cover the interval between two dates"
+    start = max(aware(since), now - timedelta(days=settings.COUNTER_RETENTION_DAYS))
+    first, last = bucket(start, HOUR), bucket(now, HOUR)
+    hours = DAY // HOUR
+    result = []
+    while first <= last:
+        if first % hours == 0 and first + hours - 1 <= last:
+            result.append((DAY, first // hours))
+            first += hours
+        else:
+            result.append((HOUR, first))
+            first += 1
+    return result
+
+
+def counts_since(counters, since):
+    """
+    Sums the buckets since a given time.
+
+    The counters parameter maps a label to a (kind, name) pair.
+    Returns a dictionary keyed by the same labels.
+    """
+    from biostar.apps.posts.models import ActivityCount
+
+    covered = spans(since, const.now())
+    keys = dict()
+    for label, (kind, name) in counters.items():
+        keys[label] = [make_key(kind, name, size, index) for size, index in covered]
+
+    # Most buckets do not exist, the query stays within the parameter limits of SQLite.
+    wanted, values = [key for group in keys.values() for key in group], dict()
+    for start in range(0, len(wanted), 500):
+        values.update(ActivityCount.objects.filter(key__in=wanted[start:start + 500]).values_list("key", "value"))
+
+    counts = dict()
+    for label, group in keys.items():
+        counts[label] = max(0, sum(values.get(key, 0) for key in group))
+    return counts
@@ -0,0 +1,255 @@
+"""
+Search backend that keeps the index in the site database.
+
+SQLite stores the documents in a table with an FTS5 index kept in sync by triggers.
+PostgreSQL stores a weighted tsvector next to each document with a GIN index on it.
+Phrases match adjacent words from PostgreSQL 9.6 on, older servers match the words of the phrase.
+
+The documents are written with the connection of the site, a post and its index entry
+are saved in the same transaction. The index is shared by all processes.
+The posts migrations create the tables of the site index.
+
+Queries are conjunctions of words and phrases with optional exclusions,
+that is what AutoQuery produces from the search box.
+"""
+from __future__ import print_function, unicode_literals, absolute_import, division
+import logging, re
+from django.db import connection
+from django.db.models.loading import get_model
+from django.utils.encoding import force_text
+from haystack.backends import BaseEngine, BaseSearchBackend, BaseSearchQuery, log_query
+from haystack.models import SearchResult
+from haystack.utils import get_identifier
+
+logger = logging.getLogger(__name__)
+
+# Marks the matching words in the highlighted text.
+HIGHLIGHT_START, HIGHLIGHT_END = '<span class="highlighted">', '</span>'
+
+# The words and phrases of a query, optionally prefixed by NOT.
+TOKEN_RE = re.compile(r'(NOT\s+)?(?:"([^"]*)"|([\w-]+))', re.UNICODE)
+
+# Characters that are not part of a word.
+CLEAN_RE = re.compile(r'[^\w\s-]', re.UNICODE)
+
+# The tables of other indexes, like the one of the search benchmark.
+SQLITE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, ident VARCHAR(255) UNIQUE,
+       django_ct VARCHAR(100), django_id VARCHAR(100), title TEXT, author TEXT, text TEXT)""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(title, author, text,
+       content='{table}', content_rowid='id', tokenize='porter unicode61')""",
+    """CREATE TRIGGER IF NOT EXISTS {table}_ai AFTER INSERT ON {table} BEGIN
+       INSERT INTO {table}_fts(rowid, title, author, text) VALUES (new.id, new.title, new.author, new.text); END""",
+    """CREATE TRIGGER IF NOT EXISTS {table}_ad AFTER DELETE ON {table} BEGIN
+       INSERT INTO {table}_fts({table}_fts, rowid, title, author, text)
+       VALUES ('delete', old.id, old.title, old.author, old.text); END""",
+]
+
+POSTGRES_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS {table} (id SERIAL PRIMARY KEY, ident VARCHAR(255) UNIQUE,
+       django_ct VARCHAR(100), django_id VARCHAR(100), title TEXT, author TEXT, text TEXT, vector TSVECTOR)""",
+]
+
+# Servers before 9.5 have no CREATE INDEX IF NOT EXISTS.
+POSTGRES_INDEX = "CREATE INDEX {table}_vector ON {table} USING GIN (vector)"
+
+# The title weighs more than the author and the text.
+POSTGRES_VECTOR = ("setweight(to_tsvector('english', %s), 'A') || setweight(to_tsvector('english', %s), 'C') || "
+                   "setweight(to_tsvector('english', %s), 'B')")
+
+
+# Options of ts_headline, values with spaces are quoted.
+POSTGRES_HEADLINE = 'StartSel="%s", StopSel=%s, MaxFragments=2' % (HIGHLIGHT_START.replace('"', '""'), HIGHLIGHT_END)
+
+
+def create_tables(table):
+    "Creates the tables of an index other than the site index"
+    cursor = connection.cursor()
+    for sql in (POSTGRES_SCHEMA if connection.vendor == 'postgresql' else SQLITE_SCHEMA):
+        cursor.execute(sql.format(table=table))
+    if connection.vendor == 'postgresql':
+        cursor.execute("SELECT 1 FROM pg_class WHERE relname = %s", ["%s_vector" % table])
+        if not cursor.fetchone():
+            cursor.execute(POSTGRES_INDEX.format(table=table))
+
+
+def parse(query_string):
+    "Splits the query into the included and the excluded words and phrases"
+    include, exclude = [], []
+    for negate, phrase, word in TOKEN_RE.findall(query_string):
+        term = " ".join((phrase or word).split())
+        if term and term not in ("AND", "OR", "NOT"):
+            (exclude if negate else include).append(term)
+    return include, exclude
+
+
+class DatabaseSearchBackend(BaseSearchBackend):
+    # Saves update the index right away.
+    realtime = True
+
+    def __init__(self, connection_alias, **connection_options):
+        super(DatabaseSearchBackend, self).__init__(connection_alias, **connection_options)
+        self.table = connection_options.get('TABLE', 'search_doc')
+
+    @property
+    def vendor(self):
+        return connection.vendor
+
+    @property
+    def tsquery(self):
+        "The function that turns a phrase into a query"
+        return "phraseto_tsquery" if connection.pg_version >= 90600 else "plainto_tsquery"
+
+    def execute(self, sql, params=()):
+        cursor = connection.cursor()
+        cursor.execute(sql.format(table=self.table), params)
+        return cursor
+
+    def update(self, index, iterable, commit=True):
+        content_field = index.get_content_field()
+        for obj in iterable:
+            doc = index.full_prepare(obj)
+            values = [doc['id'], doc['django_ct'], doc['django_id'], force_text(doc.get('title') or ''),
+                      force_text(doc.get('author') or ''), force_text(doc.get(content_field) or '')]
+            self.execute("DELETE FROM {table} WHERE ident = %s", [doc['id']])
+            if self.vendor == 'postgresql':
+                self.execute("INSERT INTO {table} (ident, django_ct, django_id, title, author, text, vector) "
+                             "VALUES (%s, %s, %s, %s, %s, %s, " + POSTGRES_VECTOR + ")", values + values[3:])
+            else:
+                self.execute("INSERT INTO {table} (ident, django_ct, django_id, title, author, text) "
+                             "VALUES (%s, %s, %s, %s, %s, %s)", values)
+
+    def remove(self, obj_or_string, commit=True):
+        self.execute("DELETE FROM {table} WHERE ident = %s", [get_identifier(obj_or_string)])
+
+    def clear(self, models=[], commit=True):
+        if models:
+            labels = ["%s.%s" % (model._meta.app_label, model._meta.module_name) for model in models]
+            self.execute("DELETE FROM {table} WHERE django_ct IN (%s)" % ", ".join(["%s"] * len(labels)), labels)
+        else:
+            self.execute("DELETE FROM {table}")
+
+    def model_choices(self, models=None):
+        if models:
+            return sorted("%s.%s" % (model._meta.app_label, model._meta.module_name) for model in models)
+        return self.build_models_list()
+
+    def match(self, include, exclude, any_term=False):
+        "Returns the condition and the parameters that match the terms"
+        if self.vendor == 'postgresql':
+            joiner, term = " || " if any_term else " && ", "%s('english', %%s)" % self.tsquery
+            query = joiner.join([term] * len(include))
+            query += "".join([" && !! " + term] * len(exclude))
+            return "d.vector @@ (%s)" % query, include + exclude
+
+        quote = lambda term: '"%s"' % term.replace('"', '""')
+        query = (" OR " if any_term else " AND ").join(quote(term) for term in include)
+        if exclude:
+            query = "(%s) NOT (%s)" % (query, " OR ".join(quote(term) for term in exclude))
+        return "{table}_fts MATCH %s", [query]
+
+    def run(self, include, exclude, start_offset=0, end_offset=None, highlight=False, models=None,
+            exclude_ident=None, any_term=False, result_class=None):
+        "Runs the query, the best matches come first"
+        if not include:
+            return dict(results=[], hits=0)
+
+        cond, params = self.match(include, exclude, any_term=any_term)
+
+        choices = self.model_choices(models)
+        if choices:
+            cond += " AND d.django_ct IN (%s)" % ", ".join(["%s"] * len(choices))
+            params += choices
+        if exclude_ident:
+            cond += " AND d.ident != %s"
+            params.append(exclude_ident)
+
+        if self.vendor == 'postgresql':
+            source = "{table} d"
+            query = " || ".join(["%s('english', %%s)" % self.tsquery] * len(include))
+            score = "ts_rank_cd(d.vector, %s)" % query
+            score_params = list(include)
+            order = "score DESC"
+            if highlight:
+                marked = "ts_headline('english', d.text, %s, %%s)" % query
+                score_params += list(include) + [POSTGRES_HEADLINE]
+            else:
+                marked = "''"
+        else:
+            source = "{table}_fts JOIN {table} d ON d.id = {table}_fts.rowid"
+            score, score_params, order = "bm25({table}_fts, 10.0, 1.0, 1.0)", [], "score"
+            if highlight:
+                marked = "snippet({table}_fts, 2, %s, %s, '...', 32)"
+                score_params += [HIGHLIGHT_START, HIGHLIGHT_END]
+            else:
+                marked = "''"
+
+        hits = self.execute("SELECT COUNT(*) FROM %s WHERE %s" % (source, cond), params).fetchone()[0]
+
+        limit = (end_offset - start_offset) if end_offset is not None else -1
+        if self.vendor == 'postgresql' and limit < 0:
+            limit = None
+        sql = ("SELECT d.django_ct, d.django_id, d.title, d.author, d.text, %s AS score, %s AS marked FROM %s "
+               "WHERE %s ORDER BY %s LIMIT %%s OFFSET %%s" % (score, marked, source, cond, order))
+        # The parameters of the select list come before the ones of the condition.
+        rows = self.execute(sql, score_params + params + [limit, start_offset]).fetchall()
+
+        result_class = result_class or SearchResult
+        results = []
+        for django_ct, django_id, title, author, text, score, marked in rows:
+            app_label, model_name = django_ct.split(".")
+            if not get_model(app_label, model_name):
+                continue
+            fields = dict(title=title, author=author, content=text)
+            if highlight:
+                fields['highlighted'] = [marked]
+            results.append(result_class(app_label, model_name, django_id, score, **fields))
+
+        return dict(results=results, hits=hits)
+
+    @log_query
+    def search(self, query_string, start_offset=0, end_offset=None, highlight=False, models=None,
+               result_class=None, narrow_queries=None, **kwargs):
+        include, exclude = parse(force_text(query_string))
+
+        # Narrowing queries are added to the query.
+        for narrow in narrow_queries or []:
+            more, less = parse(force_text(narrow))
+            include, exclude = include + more, exclude + less
+
+        return self.run(include, exclude, start_offset=start_offset, end_offset=end_offset, highlight=highlight,
+                        models=models, result_class=result_class)
+
+    def more_like_this(self, model_instance, additional_query_string=None, start_offset=0, end_offset=None,
+                       models=None, result_class=None, **kwargs):
+        "Documents that share words with the title of the instance"
+        title = getattr(model_instance, "title", "") or ""
+        words = []
+        for word in re.findall(r"\w{4,}", title.lower(), re.UNICODE):
+            if word not in words:
+                words.append(word)
+        return self.run(words[:12], [], start_offset=start_offset, end_offset=end_offset, models=models,
+                        exclude_ident=get_identifier(model_instance), any_term=True, result_class=result_class)
+
+
+class DatabaseSearchQuery(BaseSearchQuery):
+
+    def clean(self, query_fragment):
+        if not isinstance(query_fragment, basestring):
+            return query_fragment
+        return " ".join(CLEAN_RE.sub(" ", query_fragment).split())
+
+    def matching_all_fragment(self):
+        return ''
+
+    def build_query_fragment(self, field, filter_type, value):
+        # All fields are searched as text.
+        if hasattr(value, 'input_type_name'):
+            return value.prepare(self)
+        value = self.clean(force_text(value))
+        return self.build_exact_query(value) if filter_type == 'exact' else value
+
+
+class DatabaseEngine(BaseEngine):
+    backend = DatabaseSearchBackend
+    query = DatabaseSearchQuery
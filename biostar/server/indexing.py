@@ -0,0 +1,292 @@
+"""
+Near real time search indexing.
+
+Saved posts carry the changed flag, the flag is the queue for post updates.
+Deleted posts and blog posts are appended to a spool file for each process.
+A save schedules a drain task after a short delay, saves within the delay share one task.
+The drain updates only the queued documents in small batches.
+
+The drain also refreshes the titles of the posts in the title autocomplete index.
+
+Each drain handles a limited number of documents. A larger backlog is left to the
+next drain that is scheduled right away, the web processes never wait on the index.
+
+The web processes and the workers share the spool directory, it also holds the flags
+of the queue and the outcome of the last drain.
+"""
+from __future__ import print_function, unicode_literals, absolute_import, division
+import os, glob, time, json, logging
+from django.conf import settings
+from biostar.server import searchcache
+
+logger = logging.getLogger(__name__)
+
+SPOOL_PATTERN = "index-*.txt"
+
+# Created with the oldest change that is not yet indexed, its time is the start of the lag.
+PENDING_FLAG = "pending.flag"
+
+# Exists while a drain is scheduled.
+SCHEDULED_FLAG = "scheduled.flag"
+
+# The outcome of the last drain.
+STATS_FILE = "stats.json"
+
+
+def spool_path():
+    return os.path.join(settings.INDEX_SPOOL_DIR, "index-%s.txt" % os.getpid())
+
+
+def label_of(model):
+    return "%s.%s" % (model._meta.app_label, model._meta.module_name)
+
+
+def flag_path(name):
+    return os.path.join(settings.INDEX_SPOOL_DIR, name)
+
+
+def add_flag(name, stale=None):
+    "Creates the flag unless it exists. A flag older than stale seconds is replaced. Returns True when created."
+    path = flag_path(name)
+    try:
+        if stale is not None and time.time() - os.path.getmtime(path) > stale:
+            os.remove(path)
+    except OSError:
+        pass
+    try:
+        if not os.path.isdir(settings.INDEX_SPOOL_DIR):
+            os.makedirs(settings.INDEX_SPOOL_DIR)
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except OSError:
+        return False
+
+
+def remove_flag(name):
+    try:
+        os.remove(flag_path(name))
+    except OSError:
+        pass
+
+
+def mark_pending(since=None):
+    "Starts the lag unless it has started already, the flag keeps the earliest time"
+    add_flag(PENDING_FLAG)
+    try:
+        if since and os.path.getmtime(flag_path(PENDING_FLAG)) > since:
+            os.utime(flag_path(PENDING_FLAG), (since, since))
+    except OSError, exc:
+        logger.error(exc)
+
+
+def lag():
+    "The seconds that the oldest pending change has been waiting"
+    try:
+        return max(0.0, time.time() - os.path.getmtime(flag_path(PENDING_FLAG)))
+    except OSError:
+        return 0.0
+
+
+def stats():
+    "The updated, removed and remaining documents and the lag of the last drain"
+    try:
+        with open(flag_path(STATS_FILE)) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return dict(updated=0, removed=0, left=0, lag=0.0)
+
+
+def schedule(delay=None):
+    "Schedules a drain unless one is scheduled already"
+    from biostar.celery import drain_index
+
+    delay = settings.INDEX_QUEUE_DELAY if delay is None else delay
+    if add_flag(SCHEDULED_FLAG, stale=delay + 60):
+        drain_index.apply_async(countdown=delay)
+
+
+def realtime():
+    "Backends that live in the site database are updated in the transaction of the change"
+    from haystack import connections
+    return getattr(connections['default'].get_backend(), "realtime", False)
+
+
+def post_changed(post=None):
+    "Called after a post has been saved, the post carries the changed flag"
+    from biostar.apps.posts.models import Post
+
+    if post is not None and realtime():
+        # The title index is not part of the transaction, the flag stays set for the drain.
+        index_posts([post.id], titles=False)
+
+    mark_pending()
+    schedule()
+
+
+def enqueue(model, pk):
+    "Queues a document that cannot be found from the changed flag"
+    from biostar.apps.posts.models import Post
+
+    if realtime():
+        if model == Post:
+            # The title index is updated by the drain.
+            index_posts([pk], titles=False)
+        else:
+            refresh(model, list(model.objects.filter(pk=pk)), [pk])
+            return
+
+    line = "%s %s %d\n" % (label_of(model), pk, time.time())
+    try:
+        if not os.path.isdir(settings.INDEX_SPOOL_DIR):
+            os.makedirs(settings.INDEX_SPOOL_DIR)
+        with open(spool_path(), "a") as fp:
+            fp.write(line.encode("utf-8"))
+    except (IOError, OSError), exc:
+        logger.error("unable to spool index change: %s" % exc)
+        return
+    mark_pending()
+    schedule()
+
+
+def collect():
+    "Moves the spool files aside then parses them. Returns the files and the queued ids for each model label."
+    stamp = int(time.time())
+    for fname in glob.glob(os.path.join(settings.INDEX_SPOOL_DIR, SPOOL_PATTERN)):
+        try:
+            os.rename(fname, "%s.%s.drain" % (fname, stamp))
+        except OSError, exc:
+            logger.error(exc)
+
+    fnames = glob.glob(os.path.join(settings.INDEX_SPOOL_DIR, "*.drain"))
+
+    queued = {}
+    for fname in fnames:
+        for line in open(fname):
+            try:
+                label, pk, seconds = line.split()
+                queued.setdefault(label, set()).add(int(pk))
+            except ValueError:
+                logger.error("invalid spool line: %r" % line)
+
+    return fnames, queued
+
+
+def get_index(model):
+    from haystack import connections
+    return connections['default'].get_unified_index().get_index(model)
+
+
+def refresh(model, objs, ids):
+    "Updates the objects in the index and removes the other ids. Returns the counts."
+    index = get_index(model)
+    backend = index._get_backend(None)
+
+    if objs:
+        backend.update(index, objs)
+
+    found = set(obj.pk for obj in objs)
+    gone = [pk for pk in ids if pk not in found]
+    for pk in gone:
+        backend.remove("%s.%s" % (label_of(model), pk))
+
+    return len(objs), len(gone)
+
+
+def index_posts(ids, titles=True):
+    "Indexes the posts with the ids, and their titles unless told otherwise. Returns the updated and removed counts."
+    from biostar.apps.posts.models import Post
+    from biostar.server import titles as title_index
+
+    posts = list(Post.objects.filter(pk__in=ids).select_related("author"))
+
+    # Comments are removed like deleted posts, an answer may have been moved to a comment.
+    keep = [post for post in posts if post.type != Post.COMMENT and post.status != Post.DELETED]
+
+    counts = refresh(Post, keep, ids)
+    if titles:
+        try:
+            title_index.refresh(posts, ids)
+        except Exception, exc:
+            # The search index must not wait for the title index.
+            logger.error("title index error: %s" % exc)
+    return counts
+
+
+def drain_posts(limit):
+    "Indexes the posts with the changed flag. Returns the updated, removed and remaining counts."
+    from biostar.apps.posts.models import Post
+
+    updated = removed = 0
+    size = settings.INDEX_BATCH_SIZE
+    while updated + removed < limit:
+        ids = list(Post.objects.filter(changed=True).order_by("id").values_list("id", flat=True)[:size])
+        if not ids:
+            break
+
+        # Clearing the flags first lets the saves that happen meanwhile queue the post again.
+        Post.objects.filter(pk__in=ids).update(changed=False)
+        try:
+            up, rem = index_posts(ids)
+        except Exception:
+            Post.objects.filter(pk__in=ids).update(changed=True)
+            raise
+        updated += up
+        removed += rem
+
+    left = Post.objects.filter(changed=True).count()
+    return updated, removed, left
+
+
+def drain(limit=None):
+    "Indexes the queued changes. Returns the number of documents that were updated or removed."
+    from biostar.apps.posts.models import Post
+    from biostar.apps.planet.models import BlogPost
+
+    limit = limit or settings.INDEX_QUEUE_LIMIT
+    started = time.time()
+    waited = lag()
+
+    # Changes made from now on are waiting for the next drain.
+    remove_flag(PENDING_FLAG)
+    remove_flag(SCHEDULED_FLAG)
+
+    # Spooled documents are indexed from their current state.
+    fnames, queued = collect()
+    updated = removed = 0
+    for model in (Post, BlogPost):
+        ids = sorted(queued.get(label_of(model), []))
+        for start in range(0, len(ids), settings.INDEX_BATCH_SIZE):
+            batch = ids[start:start + settings.INDEX_BATCH_SIZE]
+            if model == Post:
+                up, rem = index_posts(batch)
+            else:
+                up, rem = refresh(model, list(model.objects.filter(pk__in=batch)), batch)
+            updated += up
+            removed += rem
+
+    for fname in fnames:
+        os.remove(fname)
+
+    up, rem, left = drain_posts(limit - updated - removed)
+    updated += up
+    removed += rem
+
+    if updated or removed:
+        searchcache.index_changed()
+
+    try:
+        if not os.path.isdir(settings.INDEX_SPOOL_DIR):
+            os.makedirs(settings.INDEX_SPOOL_DIR)
+        with open(flag_path(STATS_FILE), "w") as fp:
+            json.dump(dict(updated=updated, removed=removed, left=left, lag=waited), fp)
+    except (IOError, OSError), exc:
+        logger.error("unable to store the index stats: %s" % exc)
+    logger.info("indexed %s documents, removed %s, lag %.1f seconds" % (updated, removed, waited))
+
+    if left:
+        # Too many changes for one drain, the next one starts right away.
+        logger.warning("index backlog of %s posts" % left)
+        mark_pending(since=started)
+        schedule(delay=0)
+
+    return updated + removed
@@ -0,0 +1,238 @@
+"""
+Rebuilds the search index in parallel.
+
+The posts are split by id range into shards that are written by a pool of processes.
+The shards are merged into a fresh index directory that replaces the live index
+with an atomic rename of a symbolic link. Searches use the old index until the swap,
+the old index is removed by the next rebuild.
+The title autocomplete index is rebuilt as well.
+"""
+from __future__ import print_function, unicode_literals, absolute_import, division
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from errno import ENOSYS, EINVAL
+import ctypes, logging, multiprocessing, os, re, shutil, time
+
+logger = logging.getLogger("command")
+
+# Posts are loaded from the database in chunks of this size.
+CHUNK_SIZE = 500
+
+# The arguments of renameat2 that swap two paths.
+AT_FDCWD, RENAME_EXCHANGE = -100, 2
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the search index in parallel then swaps it into place'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', dest='workers', type=int, default=multiprocessing.cpu_count(),
+                    help='the number of indexing processes, 0 indexes in this process'),
+        make_option('--shards', dest='shards', type=int, default=0,
+                    help='the number of post shards, by default one for each worker'),
+    )
+
+    def handle(self, *args, **options):
+        build(workers=options['workers'], shards=options['shards'])
+
+
+def index_path():
+    from haystack import connections
+    return connections.connections_info['default']['PATH']
+
+
+def shard_ranges(ids, count):
+    "Splits the sorted ids into ranges with about the same number of ids"
+    size = max(1, -(-len(ids) // max(count, 1)))
+    return [(ids[start], ids[min(start + size, len(ids)) - 1]) for start in range(0, len(ids), size)]
+
+
+def open_shard(path):
+    "Creates an empty index with the schema of the live index"
+    from haystack.backends.whoosh_backend import WhooshSearchBackend
+
+    backend = WhooshSearchBackend('default', PATH=path)
+    backend.setup()
+    return backend
+
+
+def write_docs(backend, index, objs, writer):
+    count = 0
+    for obj in objs:
+        doc = index.full_prepare(obj)
+        for key in doc:
+            doc[key] = backend._from_python(doc[key])
+        doc.pop('boost', None)
+        writer.add_document(**doc)
+        count += 1
+    return count
+
+
+def build_shard(job):
+    "Indexes the posts in the id range, or the blog posts, into its own directory"
+    from biostar.apps.posts.models import Post
+    from biostar.apps.planet.models import BlogPost
+    from biostar.server import indexing
+
+    name, path, lo, hi = job
+    started = time.time()
+
+    backend = open_shard(path)
+    writer = backend.index.writer()
+    try:
+        if lo is None:
+            index = indexing.get_index(BlogPost)
+            count = write_docs(backend, index, index.index_queryset().iterator(), writer)
+        else:
+            index = indexing.get_index(Post)
+            query = index.index_queryset().filter(id__gte=lo, id__lte=hi).select_related("author").order_by("id")
+            count, last = 0, lo - 1
+            while True:
+                posts = list(query.filter(id__gt=last)[:CHUNK_SIZE])
+                if not posts:
+                    break
+                count += write_docs(backend, index, posts, writer)
+                last = posts[-1].id
+        writer.commit(optimize=True)
+    except Exception:
+        writer.cancel()
+        raise
+
+    return name, path, count, time.time() - started
+
+
+def exchange(first, second):
+    "Swaps two paths in one step where the system can, returns False otherwise"
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        renameat2 = libc.renameat2
+    except (OSError, AttributeError):
+        return False
+    if renameat2(AT_FDCWD, first.encode("utf-8"), AT_FDCWD, second.encode("utf-8"), RENAME_EXCHANGE):
+        errno = ctypes.get_errno()
+        if errno in (ENOSYS, EINVAL):
+            # The kernel or the file system does not support the exchange.
+            return False
+        raise OSError(errno, os.strerror(errno), first)
+    return True
+
+
+def swap(target, fresh):
+    "Points the target at the fresh directory. Returns the directory that was replaced."
+    parent = os.path.dirname(target)
+    link = os.path.join(parent, ".%s.link" % os.path.basename(fresh))
+    os.symlink(os.path.basename(fresh), link)
+
+    if os.path.islink(target):
+        # Renaming over a link is atomic.
+        old = os.path.join(parent, os.readlink(target))
+        os.rename(link, target)
+    elif os.path.isdir(target):
+        # The first swap replaces the directory with the link, the directory is kept as the previous generation.
+        old = "%s.old" % fresh
+        if exchange(link, target):
+            os.rename(link, old)
+        else:
+            os.rename(target, old)
+            os.rename(link, target)
+    else:
+        old = None
+        os.rename(link, target)
+    return old
+
+
+def prune(target, keep):
+    "Removes the generations of the index other than the kept ones"
+    pattern = re.compile(r"^%s\.\d+(\.old)?$" % re.escape(os.path.basename(target)))
+    parent = os.path.dirname(target)
+    for name in os.listdir(parent):
+        path = os.path.join(parent, name)
+        if pattern.match(name) and path not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def build_database():
+    "A search index in the site database is rebuilt in place, in one transaction"
+    from django.db import transaction
+    from biostar.apps.posts.models import Post
+    from biostar.apps.planet.models import BlogPost
+    from biostar.server import indexing
+
+    total = 0
+    with transaction.atomic():
+        for model in (Post, BlogPost):
+            index = indexing.get_index(model)
+            backend = index._get_backend(None)
+            backend.clear(models=[model])
+            query = index.index_queryset()
+            if model == Post:
+                query = query.select_related("author")
+            for start in range(0, query.count(), CHUNK_SIZE):
+                objs = list(query.order_by("id")[start:start + CHUNK_SIZE])
+                backend.update(index, objs)
+                total += len(objs)
+    logger.info("indexed %s docs" % total)
+    return total
+
+
+def build(workers, shards=0):
+    "Rebuilds the search index. Returns the number of documents."
+    from django.db import connection
+    from biostar.apps.posts.models import Post
+    from biostar.server import indexing, searchcache
+    from biostar.server.management.commands import title_index
+    from biostar.const import now
+
+    started, since = time.time(), now()
+
+    if indexing.realtime():
+        total = build_database()
+        title_index.rebuild()
+        return total
+
+    target = index_path()
+    fresh = "%s.%d" % (target, started * 1000)
+    shard_dir = "%s.shards" % fresh
+
+    ids = list(indexing.get_index(Post).index_queryset().order_by("id").values_list("id", flat=True))
+    jobs = [("blogs", os.path.join(shard_dir, "blogs"), None, None)]
+    for lo, hi in shard_ranges(ids, shards or workers or 1):
+        jobs.append(("posts %s-%s" % (lo, hi), os.path.join(shard_dir, "%s-%s" % (lo, hi)), lo, hi))
+
+    try:
+        if workers:
+            # The workers must not share the database connection of this process.
+            connection.close()
+            pool = multiprocessing.Pool(workers)
+            results = pool.map(build_shard, jobs)
+            pool.close()
+            pool.join()
+        else:
+            results = map(build_shard, jobs)
+
+        for name, path, count, elapsed in results:
+            logger.info("%s: %s docs in %.1f seconds, %.0f docs/sec" % (name, count, elapsed, count / max(elapsed, 0.001)))
+
+        # The shards are merged into a single index.
+        backend = open_shard(fresh)
+        writer = backend.index.writer()
+        for name, path, count, elapsed in results:
+            writer.add_reader(open_shard(path).index.reader())
+        writer.commit(optimize=True)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+    # The previous generation stays until the next rebuild, open searchers keep reading it.
+    old = swap(target, fresh)
+    prune(target, keep=[fresh, old])
+    searchcache.index_changed()
+    title_index.rebuild()
+
+    # Edits made during the rebuild may have been drained into the old index.
+    Post.objects.filter(lastedit_date__gte=since).update(changed=True)
+    indexing.post_changed()
+
+    total = sum(result[2] for result in results)
+    elapsed = time.time() - started
+    logger.info("indexed %s docs in %.1f seconds, %.0f docs/sec" % (total, elapsed, total / max(elapsed, 0.001)))
+    return total
@@ -0,0 +1,16 @@
+"""
+Stores the spooled activity counter events in the database.
+"""
+from django.core.management.base import BaseCommand
+import logging
+
+logger = logging.getLogger("command")
+
+
+class Command(BaseCommand):
+    help = 'Stores the spooled activity counter events in the database'
+
+    def handle(self, *args, **options):
+        from biostar.server import counters
+        count = counters.flush()
+        logger.info("stored %s counter events" % count)
@@ -0,0 +1,16 @@
+"""
+Stores the spooled post views in the database.
+"""
+from django.core.management.base import BaseCommand
+import logging
+
+logger = logging.getLogger("command")
+
+
+class Command(BaseCommand):
+    help = 'Stores the spooled post views in the database'
+
+    def handle(self, *args, **options):
+        from biostar.apps.posts import tracking
+        count = tracking.flush()
+        logger.info("stored %s post views" % count)
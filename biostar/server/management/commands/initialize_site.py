@@ -20,11 +20,14 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         from biostar import awards
+        from biostar.server.management.commands import title_index
         init_admin()
         init_domain()
         init_social_providers()
         init_flatpages()
         awards.init_awards()
+        # Creates the title autocomplete index, with the posts of a loaded site.
+        title_index.rebuild()
 
 def init_flatpages():
     # list for the flatpages
@@ -28,6 +28,8 @@ def main(days=1, weeks=10):
     from biostar.apps.posts.models import PostView, ReplyToken
     from biostar.apps.messages.models import Message
     from biostar.apps.users.models import User
+    from biostar.apps.posts import tagindex
+    from biostar.server import counters
     from django.db.models import Count
 
     # Reduce post views.
@@ -50,6 +52,12 @@ def main(days=1, weeks=10):
     logger.info(msg)
     query.delete()
 
+    # Remove the expired activity counters.
+    counters.prune()
+
+    # Remove the tag index events that every process has applied.
+    tagindex.prune()
+
     # Get rid of too many messages
     MAX_MSG = 100
     users = User.objects.annotate(total=Count("recipients")).filter(total__gt=MAX_MSG)[:100]
@@ -0,0 +1,84 @@
+"""
+Compares the Whoosh index with the index in the database.
+"""
+from django.core.management.base import BaseCommand
+from optparse import make_option
+import logging, shutil, tempfile, time
+
+from biostar.server.management.commands.search_latency import QUERIES
+
+logger = logging.getLogger("command")
+
+
+class Command(BaseCommand):
+    help = 'Indexes the posts with Whoosh and with the database, then times the same queries on both'
+    args = "[query query ...]"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', dest='repeat', type=int, default=20,
+                    help='how many times each query runs'),
+    )
+
+    def handle(self, *args, **options):
+        benchmark(args or QUERIES, repeat=options['repeat'])
+
+
+def measure(name, info, queries, repeat):
+    from django.db import transaction
+    from haystack import connections
+    from haystack.query import SearchQuerySet, AutoQuery
+    from biostar.apps.posts.models import Post
+    from biostar.apps.planet.models import BlogPost
+    from biostar.server import indexing
+    from biostar.server.searchers import percentiles
+
+    connections.connections_info['default'] = info
+    connections.reload('default')
+
+    start, total = time.time(), 0
+    with transaction.atomic():
+        for model in (Post, BlogPost):
+            index = indexing.get_index(model)
+            backend = index._get_backend(None)
+            backend.clear(models=[model])
+            objs = list(index.index_queryset())
+            backend.update(index, objs)
+            total += len(objs)
+    elapsed = time.time() - start
+    logger.info("%s: indexed %s docs in %.2f seconds, %.0f docs/sec" % (name, total, elapsed, total / max(elapsed, 0.001)))
+
+    times, hits = [], {}
+    for step in range(repeat):
+        for query in queries:
+            begin = time.time()
+            found = SearchQuerySet().filter(content=AutoQuery(query)).highlight()
+            rows = list(found[:20])
+            times.append((time.time() - begin) * 1000)
+            hits[query] = (len(found), len(rows))
+
+    p50, p90, p99 = percentiles(times)
+    logger.info("%s: %s searches, p50=%.1fms p90=%.1fms p99=%.1fms" % (name, len(times), p50, p90, p99))
+    for query in queries:
+        logger.info("%s: %r %s hits" % (name, query, hits[query][0]))
+
+
+def benchmark(queries, repeat):
+    from django.db import connection
+    from haystack import connections
+    from biostar.server import dbsearch
+
+    default = connections.connections_info['default']
+    temp = tempfile.mkdtemp()
+    try:
+        measure("whoosh", dict(ENGINE='haystack.backends.whoosh_backend.WhooshEngine', PATH=temp),
+                queries, repeat)
+        # The benchmark does not touch the index of the site.
+        dbsearch.create_tables('search_bench')
+        measure(connection.vendor, dict(ENGINE='biostar.server.dbsearch.DatabaseEngine', TABLE='search_bench'),
+                queries, repeat)
+    finally:
+        connection.cursor().execute("DROP TABLE IF EXISTS search_bench_fts")
+        connection.cursor().execute("DROP TABLE IF EXISTS search_bench")
+        connections.connections_info['default'] = default
+        connections.reload('default')
+        shutil.rmtree(temp)
@@ -0,0 +1,43 @@
+"""
+Measures the search latency with cold and warm searchers.
+"""
+from django.core.management.base import BaseCommand
+from optparse import make_option
+import logging
+
+logger = logging.getLogger("command")
+
+QUERIES = ["bowtie", "rna-seq", "differential expression", "vcf", "samtools view", "blast", "gene ontology"]
+
+
+class Command(BaseCommand):
+    help = 'Measures the search latency with cold and warm searchers'
+    args = "[query query ...]"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', dest='repeat', type=int, default=20,
+                    help='how many times each query runs'),
+    )
+
+    def handle(self, *args, **options):
+        measure(args or QUERIES, repeat=options['repeat'])
+
+
+def measure(queries, repeat):
+    from haystack import connections
+    from haystack.query import SearchQuerySet, AutoQuery
+    from biostar.server import searchers
+
+    backend = connections['default'].get_backend()
+    for kind in searchers.SEARCH_LATENCY.values():
+        kind.clear()
+
+    for step in range(repeat):
+        for query in queries:
+            # Every other round starts without open searchers.
+            if step % 2 == 0 and hasattr(getattr(backend, "index", None), "pool"):
+                backend.index.pool.clear()
+            list(SearchQuerySet().filter(content=AutoQuery(query))[:20])
+
+    for kind, (count, p50, p90, p99) in sorted(searchers.latency_percentiles().items()):
+        logger.info("%s: %s searches, p50=%.1fms p90=%.1fms p99=%.1fms" % (kind, count, p50, p90, p99))
@@ -0,0 +1,50 @@
+"""
+Computes the similar questions.
+"""
+from django.core.management.base import BaseCommand
+from optparse import make_option
+import logging, random, time
+
+logger = logging.getLogger("command")
+
+
+class Command(BaseCommand):
+    help = 'Computes the similar questions of the questions edited since the previous run'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--full', dest='full', action='store_true', default=False,
+                    help='computes the similar questions of all questions'),
+        make_option('--benchmark', dest='benchmark', type=int, default=0,
+                    help='measures the computation on this many synthetic questions, nothing is stored'),
+    )
+
+    def handle(self, *args, **options):
+        from biostar.apps.posts import similar
+
+        if options['benchmark']:
+            benchmark(options['benchmark'])
+        else:
+            similar.update(full=options['full'])
+
+
+def benchmark(size):
+    from biostar.apps.posts import similar
+
+    # Word frequencies of natural text fall off with their rank.
+    rand = random.Random(0)
+    vocabulary = ["w%s" % index for index in range(50000)]
+
+    def text(count):
+        return " ".join(vocabulary[int(rand.paretovariate(0.7) - 1) % len(vocabulary)] for i in range(count))
+
+    start = time.time()
+    docs = [(pk, text(8), text(80)) for pk in range(1, size + 1)]
+    logger.info("generated %s questions in %.1f seconds" % (size, time.time() - start))
+
+    start = time.time()
+    ids, matrix = similar.vectorize(docs)
+    logger.info("vectorized in %.1f seconds, %s nonzero values" % (time.time() - start, matrix.nnz))
+
+    start = time.time()
+    found = sum(len(best) for pk, best, matched in similar.neighbours(ids, matrix))
+    logger.info("%s neighbours in %.1f seconds" % (found, time.time() - start))
@@ -0,0 +1,24 @@
+"""
+Rolls up the daily site statistics.
+"""
+from django.core.management.base import BaseCommand
+from optparse import make_option
+import logging, time
+
+logger = logging.getLogger("command")
+
+
+class Command(BaseCommand):
+    help = 'Stores the statistics of the days that ended since the last rollup'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--full', dest='full', action='store_true', default=False,
+                    help='rolls up all days again'),
+    )
+
+    def handle(self, *args, **options):
+        from biostar.server import stats
+
+        start = time.time()
+        count = stats.rollup(full=options['full'])
+        logger.info("rolled up %s days in %.1f seconds" % (count, time.time() - start))
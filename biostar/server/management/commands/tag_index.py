@@ -0,0 +1,60 @@
+"""
+Benchmarks the tag index against the database query.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+import logging, time
+
+logger = logging.getLogger("command")
+
+
+class Command(BaseCommand):
+    help = 'Compares tag searches with the tag index and with the database'
+    args = "[tags tags ...]"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', dest='repeat', type=int, default=10,
+                    help='how many times each search runs'),
+    )
+
+    def handle(self, *args, **options):
+        benchmark(args, repeat=options['repeat'])
+
+
+def measure(query, repeat):
+    "Counts the posts and loads the first page, returns the best time in milliseconds"
+    from django.conf import settings
+
+    best = None
+    for step in range(repeat):
+        start = time.time()
+        query.count()
+        list(query[:settings.PAGINATE_BY])
+        elapsed = (time.time() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark(searches, repeat):
+    from biostar.apps.posts.models import Post, Tag
+    from biostar.apps.posts import tagindex
+
+    if not searches:
+        # The most used tags, alone and combined.
+        names = list(Tag.objects.order_by("-count").values_list("name", flat=True)[:20])
+        searches = names[:3] + ["+".join(names[:3]), "%s+%s!" % (names[0], names[1]), names[-1]]
+
+    start = time.time()
+    tagindex.index.build()
+    logger.info("index built in %.1fms" % ((time.time() - start) * 1000))
+
+    for text in searches:
+        # Both searches match the descendants of the tags.
+        include, exclude = Post.objects.parse_tags(text)
+        include, exclude = Tag.expand(include), Tag.expand(exclude)
+        database = Post.objects.tag_query(include, exclude).order_by("-lastedit_date")
+        indexed = Post.objects.tag_search(text).order_by("-lastedit_date")
+        if database.count() != indexed.count():
+            raise CommandError("%s: the database finds %s posts, the index %s" % (text, database.count(), indexed.count()))
+        logger.info("%s: %s posts, database %.1fms, index %.1fms" % (
+            text, indexed.count(), measure(database, repeat), measure(indexed, repeat)))
@@ -0,0 +1,50 @@
+"""
+Counts the tags used together and benchmarks the tag suggestions.
+"""
+from django.core.management.base import BaseCommand
+from optparse import make_option
+import logging, random, time
+
+logger = logging.getLogger("command")
+
+
+class Command(BaseCommand):
+    help = 'Counts the tags used together on the posts added since the previous run'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--full', dest='full', action='store_true', default=False,
+                    help='counts the tags of all posts'),
+        make_option('--benchmark', dest='benchmark', type=int, default=0,
+                    help='measures this many suggestions for random prefixes'),
+    )
+
+    def handle(self, *args, **options):
+        from biostar.server import tagsuggest
+
+        if options['benchmark']:
+            benchmark(options['benchmark'])
+        else:
+            tagsuggest.build(full=options['full'])
+
+
+def benchmark(lookups):
+    from biostar.server import tagsuggest
+    from biostar.server.searchers import percentiles
+
+    start = time.time()
+    tagsuggest.suggest("")
+    logger.info("loaded %s tags in %.1fms" % (len(tagsuggest.suggestions.trie.counts), (time.time() - start) * 1000))
+
+    rand = random.Random(0)
+    names = list(tagsuggest.suggestions.trie.counts)
+    times = []
+    for step in range(lookups):
+        name = rand.choice(names)
+        chosen = rand.sample(names, rand.randint(0, 2))
+        prefix = name[:rand.randint(0, min(3, len(name)))]
+        start = time.time()
+        tagsuggest.suggest(prefix, chosen=chosen)
+        times.append((time.time() - start) * 1000)
+
+    p50, p90, p99 = percentiles(times)
+    logger.info("%s suggestions: p50=%.3fms p90=%.3fms p99=%.3fms" % (lookups, p50, p90, p99))
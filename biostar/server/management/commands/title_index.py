@@ -0,0 +1,83 @@
+"""
+Rebuilds and benchmarks the title autocomplete index.
+"""
+from django.core.management.base import BaseCommand
+from optparse import make_option
+import logging, os, random, tempfile, time
+
+logger = logging.getLogger("command")
+
+# Words for the synthetic titles of the benchmark.
+WORDS = """
+alignment annotation assembly bam bed bioconductor blast bowtie bwa chip chromosome coverage deseq2 differential
+expression fasta fastq gene genome gtf illumina mapping methylation mutation ncbi pipeline primer python quality
+reads reference rna samtools sequence snp transcript trimming variant vcf
+""".split()
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds or benchmarks the title autocomplete index'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rebuild', dest='rebuild', action='store_true', default=False,
+                    help='rebuilds the index from the database'),
+        make_option('--benchmark', dest='benchmark', type=int, default=0,
+                    help='measures the lookups on a synthetic index with this many titles'),
+    )
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            rebuild()
+        if options['benchmark']:
+            benchmark(options['benchmark'])
+
+
+def rebuild():
+    from biostar.apps.posts.models import Post
+    from biostar.server import titles
+
+    posts = Post.objects.filter(type__in=Post.TOP_LEVEL).exclude(status=Post.DELETED).select_related("author")
+    count = titles.rebuild(posts.iterator())
+    logger.info("indexed %s titles" % count)
+
+
+def benchmark(size, lookups=2000):
+    from biostar.server import titles
+    from biostar.server.searchers import percentiles
+
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        rand = random.Random(0)
+        docs = []
+        for pk in range(1, size + 1):
+            title = " ".join(rand.choice(WORDS) for i in range(rand.randint(4, 10)))
+            docs.append((pk, 0, pk, title, "/p/%s/" % pk, "user%s" % (pk % 100)))
+
+        start = time.time()
+        conn = titles.connect(path)
+        for index in range(0, size, 1000):
+            titles.add_docs(conn, docs[index:index + 1000])
+        logger.info("indexed %s titles in %.1f seconds" % (size, time.time() - start))
+
+        # Queries of one or two words, the last one partially typed.
+        queries = []
+        for i in range(lookups):
+            query = [rand.choice(WORDS) for j in range(rand.randint(1, 2))]
+            query[-1] = query[-1][:rand.randint(1, len(query[-1]))]
+            queries.append(" ".join(query))
+
+        times = []
+        for query in queries:
+            start = time.time()
+            titles.search(query, limit=20, path=path)
+            times.append((time.time() - start) * 1000)
+
+        p50, p90, p99 = percentiles(times)
+        logger.info("%s lookups: p50=%.2fms p90=%.2fms p99=%.2fms" % (lookups, p50, p90, p99))
+    finally:
+        titles.connect(path).close()
+        del titles.local.conns[path]
+        for name in (path, path + "-wal", path + "-shm"):
+            if os.path.exists(name):
+                os.remove(name)
@@ -18,28 +18,90 @@ class Command(BaseCommand):
 
     option_list = BaseCommand.option_list + (
         make_option('--award', dest='award', action='store_true', default=False,
-                    help='goes over the users and attempts to create awards'),
+                    help='awards the badges to the next users of each partition'),
+        make_option('--partitions', dest='partitions', type=int, default=None,
+                    help='splits the user ids into this many ranges'),
+        make_option('--partition', dest='partition', type=int, default=None,
+                    help='crawls only this partition, numbered from 0'),
     )
 
     def handle(self, *args, **options):
 
         if options['award']:
-            crawl_awards()
+            partitions = options['partitions'] or settings.USER_CRAWL_PARTITIONS
+            selected = None if options['partition'] is None else [options['partition']]
+            crawl_awards(partitions, selected=selected)
 
-def crawl_awards():
+def bounds(partitions):
+    "Splits the user ids into ranges of equal width, a range is (first, last) inclusive"
     from biostar.apps.users.models import User
-    from biostar.awards import create_user_award
-    import random
+    from django.db.models import Min, Max
 
-    ids = [ u[0] for u in User.objects.all().values_list("id") ]
+    limits = User.objects.aggregate(first=Min("id"), last=Max("id"))
+    first, last = limits["first"] or 0, limits["last"] or 0
+    width = (last - first) // partitions + 1
+    return [(first + step * width, min(last, first + (step + 1) * width - 1)) for step in range(partitions)]
 
-    random.shuffle(ids)
 
-    ids = ids[:100]
+def checkpoint_path(partition, partitions):
+    return os.path.join(settings.USER_CRAWL_DIR, "award-%s-of-%s.txt" % (partition, partitions))
 
-    for pk  in ids:
-        user = User.objects.get(pk=pk)
-        #logger.info("%s: %s" % (user.id, user.name))
-        create_user_award.delay(user=user)
 
+def load_checkpoint(partition, partitions):
+    "The last id crawled in the partition, None when the partition starts over"
+    try:
+        with open(checkpoint_path(partition, partitions)) as fp:
+            return int(fp.read().strip() or 0) or None
+    except (IOError, ValueError):
+        return None
 
+
+def save_checkpoint(partition, partitions, last):
+    if not os.path.isdir(settings.USER_CRAWL_DIR):
+        os.makedirs(settings.USER_CRAWL_DIR)
+    path = checkpoint_path(partition, partitions)
+    temp = "%s.%s" % (path, os.getpid())
+    with open(temp, "w") as fp:
+        fp.write("%s\n" % (last or 0))
+    os.rename(temp, path)
+
+
+def crawl_awards(partitions, selected=None, limit=None, batch=None):
+    """
+    Sends the next users of each partition to the award tasks, in the order of the ids.
+    Each partition continues after its checkpoint and starts over once all of its users were sent.
+    Returns the number of users that were sent.
+    """
+    from biostar.apps.users.models import User
+    from biostar.awards import award_batch
+
+    limit = limit or settings.USER_CRAWL_LIMIT
+    batch = batch or settings.USER_CRAWL_BATCH
+    ranges = bounds(partitions)
+    selected = range(partitions) if selected is None else selected
+
+    sent = 0
+    for partition in selected:
+        first, last = ranges[partition]
+        start = load_checkpoint(partition, partitions) or first - 1
+        ids = User.objects.filter(id__gt=start, id__lte=last).order_by("id").values_list("id", flat=True)
+
+        chunk, count, last_id = [], 0, start
+        for pk in ids[:limit].iterator():
+            chunk.append(pk)
+            if len(chunk) == batch:
+                award_batch.delay(chunk)
+                chunk = []
+            count, last_id = count + 1, pk
+        if chunk:
+            award_batch.delay(chunk)
+
+        # A partition that has no more users starts over with the next run.
+        done = count < limit or last_id >= last
+        save_checkpoint(partition, partitions, None if done else last_id)
+        sent += count
+
+        logger.info("partition %s of %s: sent %s users up to id %s%s" % (
+            partition, partitions, count, last_id, ", starting over" if done else ""))
+
+    return sent
@@ -8,12 +8,11 @@ from django.utils.translation import ugettext_lazy as _
 from biostar.apps.users.models import User, Profile
 from biostar import const
 from django.core.cache import cache
-from biostar.apps.posts.models import Post, Vote
+from biostar.apps.posts.models import Tag
 from biostar.apps.messages.models import Message
-from biostar.apps.planet.models import BlogPost
-
-from collections import defaultdict
-from biostar.awards import create_user_award, check_user_profile
+from biostar.server import counters
+from biostar.awards import check_user_profile
+from biostar.server.context import bump_sidebar
 
 logger = logging.getLogger(__name__)
 
@@ -110,35 +109,25 @@ def get_counts(request, weeks=settings.COUNT_INTERVAL_WEEKS):
     else:
         since = now - timedelta(weeks=weeks)
 
-    # This fetches the posts since last login.
-    posts = Post.objects.filter(type__in=Post.TOP_LEVEL, status=Post.OPEN, creation_date__gt=since).order_by(
-        '-id').only("id").prefetch_related("tag_set")
-    posts = posts[:200]
-    counts = defaultdict(int)
-
-    # How many news posts.
-    counts['latest'] = len(posts)
+    # Only the categories shown in the navigation bar are counted per tag.
+    targets = dict((word.lower(), ("tag", Tag.fixcase(word))) for word in settings.CATEGORIES)
 
-    # Produce counts per tag.
-    for post in posts:
-        for tag in post.tag_set.all():
-            counts[tag.name] += 1
+    # How many new posts, unanswered questions and planet posts.
+    targets['latest'] = ("type", "latest")
+    targets['open'] = ("type", "open")
+    targets['planet'] = ("type", "planet")
 
-    # Fill in the unanswered counts.
-    counts['open'] = Post.objects.filter(type=Post.QUESTION, reply_count=0, status=Post.OPEN,
-                                         creation_date__gt=since).count()
+    # Compute a few more counts for the user.
+    if user.is_authenticated():
+        # These are the new votes since the last login.
+        targets['votes'] = ("votes", user.id)
 
-    # How many new planet posts
-    counts['planet'] = BlogPost.objects.filter(insert_date__gt=since).count()
+    counts = counters.counts_since(targets, since)
 
-    # Compute a few more counts for the user.
     if user.is_authenticated():
-        # These are the new messages since the last login.
+        # These are the new messages since the last login that are still unread.
         counts['messages'] = Message.objects.filter(user=user, unread=True, sent_at__gt=since).count()
 
-        # These are the new votes since the last login.
-        counts['votes'] = Vote.objects.filter(post__author=user, date__gt=since).count()
-
     return counts
 
 
@@ -188,15 +177,15 @@ class Visit(object):
                 # Set the last login time.
                 Profile.objects.filter(user_id=user.id).update(last_login=const.now())
 
+                # The recent users in the sidebar have changed.
+                bump_sidebar("users")
+
                 # Compute the counts.
                 counts = get_counts(request)
 
                 # Store the counts in the session for later use.
                 session[SESSION_KEY] = counts
 
-                # Create user awards if possible.
-                create_user_award.delay(user=user)
-
                 # check user and fill in details
                 check_user_profile.delay(ip=get_ip(request), user=user)
 
@@ -7,127 +7,62 @@ Only signals and connections between models are specfied here.
 from __future__ import print_function, unicode_literals, absolute_import, division
 import logging, datetime
 from django.db.models import signals, Q
+from django.template import loader, Context
 from django.utils.translation import ugettext_lazy as _
 from allauth.account.signals import user_signed_up
 from allauth.socialaccount.signals import social_account_added
 
-from biostar.apps.posts.models import Post, Subscription, ReplyToken
+from biostar.apps.posts.models import Post, Vote, Tag, Subscription, ReplyToken
+from biostar.apps.users.models import Profile
 from biostar.apps.messages.models import Message, MessageBody
 from biostar.apps.badges.models import Award
+from biostar.apps.planet.models import BlogPost
 from biostar.server.orcid import hook_social_account_added
+from biostar.server.context import bump_sidebar
+from biostar.server import pagecache
+from biostar.server import counters
+from biostar.server import indexing
+from biostar import notify
 
-from biostar.apps.util import html, make_uuid
+from biostar.apps.util import html
 
-from django.core import mail
 from django.conf import settings
 from biostar.const import *
-from django.contrib.sites.models import Site
 
 logger = logging.getLogger(__name__)
 
-# This will be the message body on the site.
-POST_CREATED_TEXT = "messages/post_created.txt"
-POST_CREATED_HTML = "messages/post_created.html"
-POST_CREATED_SHORT = "messages/post_created_short.html"
-
 AWARD_CREATED_HTML_TEMPLATE = "messages/award_created.html"
 
-# This will be the message body in an email.
 
 def post_create_messages(sender, instance, created, *args, **kwargs):
     "The actions to undertake when creating a new post"
-    from biostar.apps.users.models import User
-
-    post = instance
     if created:
-        # The user sending the notifications.
-        author = instance.author
-
-        # Insert email subscriptions to users that watch these posts
-        if post.is_toplevel:
-            cond1 = Q(profile__message_prefs=ALL_MESSAGES)
-            cond2 = Q(profile__tags__name__in=post.parse_tags())
-            cond = cond1 | cond2
-            for watcher in User.objects.filter(cond).exclude(id=author.id):
-                sub, flag = Subscription.objects.get_or_create(post=post, user=watcher, type=EMAIL_MESSAGE)
-
-        # Get all subscriptions for the post.
-        subs = Subscription.objects.get_subs(post).exclude(user=author)
-
-        # Generate the message from the template.
-        content = html.render(name=POST_CREATED_SHORT, post=post, user=author)
-
-        # Generate the email message body.
-        site = Site.objects.get_current()
-        email_text = html.render(name=POST_CREATED_TEXT, post=post, user=author, site=site)
-
-        # Generate the html message
-        email_html = html.render(name=POST_CREATED_HTML, post=post, user=author, site=site)
-
-        # Create the message body.
-        body = MessageBody.objects.create(author=author, subject=post.root.title,
-                                          text=content, sent_at=post.creation_date)
-
-        # Collects the emails for bulk sending.
-        emails, tokens = [], []
-
-        # This generator will produce the messages.
-        def messages():
-            for sub in subs:
-                message = Message(user=sub.user, body=body, sent_at=body.sent_at)
-
-                # collect to a bulk email if the subscription is by email:
-                if sub.type in (EMAIL_MESSAGE, ALL_MESSAGES):
-                    try:
-                        token = ReplyToken(user=sub.user, post=post, token=make_uuid(8), date=now())
-                        from_email = settings.EMAIL_FROM_PATTERN % (author.name, settings.DEFAULT_FROM_EMAIL)
-                        from_email = from_email.encode("utf-8")
-                        reply_to = settings.EMAIL_REPLY_PATTERN % token.token
-                        subject = settings.EMAIL_REPLY_SUBJECT % body.subject
-                        # create the email message
-                        email = mail.EmailMultiAlternatives(
-                            subject=subject,
-                            body=email_text,
-                            from_email=from_email,
-                            to=[sub.user.email],
-                            headers={'Reply-To': reply_to},
-                        )
-                        email.attach_alternative(email_html, "text/html")
-                        emails.append(email)
-                        tokens.append(token)
-                    except Exception, exc:
-                        # This here can crash the post submission hence the catchall
-                        logger.error(exc)
-
-                yield message
-
-        # Bulk insert of all messages. Bypasses the Django ORM!
-        Message.objects.bulk_create(messages(), batch_size=100)
-        ReplyToken.objects.bulk_create(tokens, batch_size=100)
-
-        try:
-            # Bulk sending email messages.
-            conn = mail.get_connection()
-            conn.send_messages(emails)
-        except Exception, exc:
-            logger.error("email error %s" % exc)
+        # The notifications are sent by a background task.
+        notify.dispatch(notify.fan_out, instance.id)
 
 
-def award_create_messages(sender, instance, created, *args, **kwargs):
-    "The actions to undertake when creating a new post"
-    award = instance
+def create_award_messages(awards):
+    "Sends the winners of the awards their messages with a few bulk inserts"
+    # The template is loaded once for all messages.
+    template = loader.get_template(AWARD_CREATED_HTML_TEMPLATE)
+    stamp, subjects, bodies = now(), set(), []
+    for award in awards:
+        content = template.render(Context(dict(award=award, user=award.user)))
+        subject = unicode(_("Congratulations: you won %s") % award.badge.name)[:MessageBody.MAX_SIZE]
+        subjects.add(subject)
+        bodies.append(MessageBody(author_id=award.user_id, subject=subject, text=content, sent_at=stamp))
+    MessageBody.objects.bulk_create(bodies, batch_size=500)
 
-    if created:
-        # The user sending the notifications.
-        user = award.user
-        # Generate the message from the template.
-        content = html.render(name=AWARD_CREATED_HTML_TEMPLATE, award=award, user=user)
+    # The bulk insert does not return the ids. Each new body goes to its author.
+    query = MessageBody.objects.filter(sent_at=stamp, subject__in=subjects, messages=None)
+    messages = [Message(user_id=author_id, body_id=pk, sent_at=stamp) for pk, author_id in query.values_list("id", "author")]
+    Message.objects.bulk_create(messages, batch_size=500)
 
-        subject = _("Congratulations: you won %s") % award.badge.name
 
-        # Create the message body.
-        body = MessageBody.objects.create(author=user, subject=subject, text=content)
-        message = Message.objects.create(user=user, body=body, sent_at=body.sent_at)
+def award_create_messages(sender, instance, created, *args, **kwargs):
+    "The actions to undertake when creating a new award"
+    if created:
+        create_award_messages([instance])
 
 # Creates a message to everyone involved
 signals.post_save.connect(post_create_messages, sender=Post, dispatch_uid="post-create-messages")
@@ -136,6 +71,132 @@ signals.post_save.connect(post_create_messages, sender=Post, dispatch_uid="post-
 signals.post_save.connect(award_create_messages, sender=Award, dispatch_uid="award-create-messages")
 
 
+def sidebar_changed(sender, instance, *args, **kwargs):
+    "Moves the affected sidebar blocks to a new generation"
+    if sender == Post:
+        # Vote rows carry the post titles.
+        bump_sidebar("replies", "votes")
+    elif sender == Vote:
+        bump_sidebar("votes")
+    elif sender == Award:
+        bump_sidebar("awards")
+    elif sender == Profile:
+        bump_sidebar("users")
+
+for model in (Post, Vote, Award, Profile):
+    signals.post_save.connect(sidebar_changed, sender=model, dispatch_uid="sidebar-save-%s" % model.__name__)
+    signals.post_delete.connect(sidebar_changed, sender=model, dispatch_uid="sidebar-delete-%s" % model.__name__)
+
+
+def page_changed(sender, instance, *args, **kwargs):
+    "Purges the cached pages that show the post"
+    try:
+        post = instance.post if sender == Vote else instance
+    except Post.DoesNotExist:
+        # The votes are deleted along with the post.
+        return
+    pagecache.purge_post(post)
+
+for model in (Post, Vote):
+    signals.post_save.connect(page_changed, sender=model, dispatch_uid="page-save-%s" % model.__name__)
+    signals.post_delete.connect(page_changed, sender=model, dispatch_uid="page-delete-%s" % model.__name__)
+
+
+def page_tags_changed(sender, instance, action, reverse, pk_set, *args, **kwargs):
+    "Purges the lists of the tags that a post joins or leaves, the post saves purge only its current tags"
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if reverse:
+        # The posts of a tag were changed.
+        names = [instance.name]
+    elif action == 'pre_clear':
+        names = instance.tag_set.values_list("name", flat=True)
+    else:
+        names = Tag.objects.filter(pk__in=pk_set).values_list("name", flat=True)
+    pagecache.purge_tags(list(names))
+
+signals.m2m_changed.connect(page_tags_changed, sender=Post.tag_set.through, dispatch_uid="page-tags")
+
+
+def index_saved(sender, instance, *args, **kwargs):
+    "Queues the document for the search index"
+    if sender == Post:
+        # Saved posts carry the changed flag.
+        indexing.post_changed(instance)
+    else:
+        indexing.enqueue(sender, instance.pk)
+
+
+def index_deleted(sender, instance, *args, **kwargs):
+    indexing.enqueue(sender, instance.pk)
+
+for model in (Post, BlogPost):
+    signals.post_save.connect(index_saved, sender=model, dispatch_uid="index-save-%s" % model.__name__)
+    signals.post_delete.connect(index_deleted, sender=model, dispatch_uid="index-delete-%s" % model.__name__)
+
+
+def post_counters(sender, instance, created, *args, **kwargs):
+    "Counts new top level posts and unanswered questions"
+    post = instance
+    if not created:
+        return
+
+    if post.is_toplevel and post.status == Post.OPEN:
+        counters.incr("type", "latest", date=post.creation_date)
+        if post.type == Post.QUESTION:
+            counters.incr("type", "open", date=post.creation_date)
+
+    if post.type == Post.ANSWER and post.root.type == Post.QUESTION and post.root.status == Post.OPEN:
+        # The first answer takes the question off the unanswered list.
+        if Post.objects.filter(pk=post.root_id, reply_count=1).exists():
+            counters.incr("type", "open", date=post.root.creation_date, delta=-1)
+
+
+def post_removed(sender, instance, *args, **kwargs):
+    "Takes a removed open post off the counts, its tags are removed along with it"
+    if instance.status == Post.OPEN:
+        counters.count_post(instance, -1)
+
+
+def tag_counters(sender, instance, action, pk_set, *args, **kwargs):
+    "Counts new top level posts per tag"
+    post = instance
+    if not post.is_toplevel or post.status != Post.OPEN:
+        return
+
+    if action == 'post_add':
+        names, delta = Tag.objects.filter(pk__in=pk_set).values_list("name", flat=True), 1
+    elif action == 'post_remove':
+        names, delta = Tag.objects.filter(pk__in=pk_set).values_list("name", flat=True), -1
+    elif action == 'pre_clear':
+        names, delta = post.tag_set.values_list("name", flat=True), -1
+    else:
+        return
+
+    for name in names:
+        counters.incr("tag", name, date=post.creation_date, delta=delta)
+
+
+def vote_counters(sender, instance, created, *args, **kwargs):
+    "Counts the votes received by each author"
+    if created:
+        counters.incr("votes", instance.post.author_id, date=instance.date)
+
+
+def blog_counters(sender, instance, created, *args, **kwargs):
+    "Counts the new planet posts"
+    if created:
+        counters.incr("type", "planet", date=instance.insert_date)
+
+# Maintains the activity counters shown in the navigation bar.
+signals.post_save.connect(post_counters, sender=Post, dispatch_uid="post-counters")
+signals.pre_delete.connect(post_removed, sender=Post, dispatch_uid="post-removed")
+signals.m2m_changed.connect(tag_counters, sender=Post.tag_set.through, dispatch_uid="tag-counters")
+signals.post_save.connect(vote_counters, sender=Vote, dispatch_uid="vote-counters")
+signals.post_save.connect(blog_counters, sender=BlogPost, dispatch_uid="blog-counters")
+
+
 def disconnect_all():
     signals.post_save.disconnect(post_create_messages, sender=Post, dispatch_uid="post-create-messages")
     signals.post_save.disconnect(award_create_messages, sender=Award, dispatch_uid="award-create-messages")
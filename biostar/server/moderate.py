@@ -7,6 +7,7 @@ from biostar.apps.posts.auth import post_permissions
 from biostar.apps.users.models import User
 from biostar.apps.users.auth import user_permissions
 from biostar.apps.util import html
+from biostar.server import pagecache, indexing, counters
 from django.conf import settings
 from django.views.generic import FormView
 from django.shortcuts import render
@@ -171,9 +172,18 @@ class PostModeration(LoginRequiredMixin, FormView):
         return render(request, self.template_name, context)
 
     def post(self, request, *args, **kwargs):
+        post = self.get_obj()
+        response = self.moderate(request, post)
+
+        # The actions update the posts without sending signals.
+        pagecache.purge_post(post)
+        indexing.post_changed(post)
+
+        return response
+
+    def moderate(self, request, post):
         user = request.user
 
-        post = self.get_obj()
         post = post_permissions(request, post)
 
         # The default return url
@@ -206,14 +216,14 @@ class PostModeration(LoginRequiredMixin, FormView):
         if action == MOVE_TO_ANSWER and post.type == Post.COMMENT:
             # This is a valid action only for comments.
             messages.success(request, _("Moved post to answer"))
-            query.update(type=Post.ANSWER, parent=post.root)
+            query.update(type=Post.ANSWER, parent=post.root, changed=True)
             root.update(reply_count=F("reply_count") + 1)
             return response
 
         if action == MOVE_TO_COMMENT and post.type == Post.ANSWER:
             # This is a valid action only for answers.
             messages.success(request, _("Moved post to answer"))
-            query.update(type=Post.COMMENT, parent=post.root)
+            query.update(type=Post.COMMENT, parent=post.root, changed=True)
             root.update(reply_count=F("reply_count") - 1)
             return response
 
@@ -223,10 +233,16 @@ class PostModeration(LoginRequiredMixin, FormView):
             return response
 
         if action == OPEN:
+            if post.status != Post.OPEN:
+                counters.count_post(post, 1)
             query.update(status=Post.OPEN)
             messages.success(request, _("Opened post: %s") % post.title)
             return response
 
+        # Closed and deleted posts are not counted as new posts.
+        if action in (CLOSE_OFFTOPIC, DUPLICATE) and post.status == Post.OPEN:
+            counters.count_post(post, -1)
+
         if action in CLOSE_OFFTOPIC:
             query.update(status=Post.CLOSED)
             messages.success(request, _("Closed post: %s") % post.title)
@@ -264,7 +280,9 @@ class PostModeration(LoginRequiredMixin, FormView):
 
             if delete_only:
                 # Deleted posts can be undeleted by re-opening them.
-                query.update(status=Post.DELETED)
+                if post.status == Post.OPEN:
+                    counters.count_post(post, -1)
+                query.update(status=Post.DELETED, changed=True)
                 messages.success(request, _("Deleted post: %s") % post.title)
                 response = HttpResponseRedirect(post.root.get_absolute_url())
             else:
@@ -390,7 +408,10 @@ class UserModeration(LoginRequiredMixin, FormView):
             Vote.objects.filter(author=target).delete()
 
             # Mark all posts as deleted.
-            Post.objects.filter(author=target).update(status=Post.DELETED)
+            for post in Post.objects.filter(author=target, type__in=Post.TOP_LEVEL, status=Post.OPEN):
+                counters.count_post(post, -1)
+            Post.objects.filter(author=target).update(status=Post.DELETED, changed=True)
+            indexing.post_changed()
 
             # Destroy posts with no votes.
             query = Post.objects.filter(author=target, vote_count__lt=2)
@@ -0,0 +1,224 @@
+"""
+Full page cache for anonymous readers.
+
+Post lists and threads are stored under the path and the normalized sort, limit and page.
+Each page belongs to one or more scopes: a thread, a topic or the tags of a multi-tag topic.
+The keys carry the generation numbers of the scopes and writes move the affected scopes
+to a new generation. The old pages expire unused. Cached pages show no session counts.
+
+The cache is opt-in, see PAGE_CACHE_ENABLED in the settings.
+"""
+from __future__ import print_function, unicode_literals, absolute_import, division
+import hashlib, logging, urllib
+from collections import Counter
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+
+from biostar import const
+
+logger = logging.getLogger(__name__)
+
+# Parameters that select a page. Requests with other parameters are not cached.
+PAGE_PARAMS = set(("sort", "limit", "page"))
+
+# Stands in for the CSRF token of the visitor inside the cached page.
+CSRF_SLOT = b"--csrf-token-slot--"
+
+# The home page is stored under this topic.
+HOME = "latest"
+
+# Page cache hits and misses for each page in this process.
+PAGE_STATS = Counter()
+
+
+def post_scope(pk):
+    return "post-%s" % pk
+
+
+def topic_scope(topic):
+    topic = (topic or HOME).lower().encode("utf-8")
+    return "topic-%s" % urllib.quote(topic)
+
+
+def generation(scope):
+    "The current generation of a scope"
+    key = "pagegen-%s" % scope
+    gen = cache.get(key)
+    if gen is None:
+        gen = 1
+        cache.add(key, gen, None)
+    return gen
+
+
+def bump(*scopes):
+    "Moves the scopes to a new generation"
+    for scope in scopes:
+        key = "pagegen-%s" % scope
+        try:
+            cache.incr(key)
+        except ValueError:
+            # The generation is not in the cache yet.
+            cache.add(key, 2, None)
+
+
+def page_label(request):
+    "The path with the normalized parameters. Returns None for requests that may not be cached."
+    params = request.GET
+
+    if set(params) - PAGE_PARAMS:
+        return None
+
+    sort = params.get("sort", const.POST_SORT_DEFAULT)
+    limit = params.get("limit", const.POST_LIMIT_DEFAULT)
+    page = params.get("page", "1")
+
+    # Invalid values produce a warning on the page.
+    if sort not in const.POST_SORT_MAP or limit not in const.POST_LIMIT_MAP or not page.isdigit():
+        return None
+
+    return "%s?sort=%s&limit=%s&page=%d" % (request.path, sort, limit, int(page))
+
+
+def csrf_token(request):
+    "The CSRF token of the visitor. Asking for it makes sure that the visitor gets the cookie."
+    return (get_token(request) or "").encode("ascii")
+
+
+def counts_hidden(request):
+    "True for the requests that render a page for the cache"
+    return getattr(request, "page_cache", False)
+
+
+def cacheable(request):
+    if not settings.PAGE_CACHE_ENABLED:
+        return False
+    if request.method != "GET" or request.user.is_authenticated():
+        return False
+    # Pending messages would be shown on the page.
+    return not len(messages.get_messages(request))
+
+
+def purge_post(post):
+    "Purges the thread of the post and the lists that show the thread"
+    from biostar.apps.posts.models import Post, Tag
+    from biostar.server.views import POST_TYPES
+
+    if not settings.PAGE_CACHE_ENABLED:
+        return
+
+    try:
+        root = post.root or post
+    except Post.DoesNotExist:
+        # The whole thread has been removed.
+        root = post
+
+    scopes = [post_scope(root.id), topic_scope(HOME)]
+    if root.type == Post.QUESTION:
+        scopes.append(topic_scope("open"))
+    scopes.extend(topic_scope(name) for name, value in POST_TYPES.items() if value == root.type)
+    # The topics of the parent tags list the post as well.
+    scopes.extend(topic_scope(name) for name in Tag.expand(root.parse_tags(), ancestors=True))
+    bump(*scopes)
+
+    if settings.PAGE_CACHE_WARM_HOME:
+        warm_home()
+
+
+def purge_tags(names):
+    "Purges the lists of the tags and of their parent tags, a post was added to or removed from the tags"
+    from biostar.apps.posts.models import Tag
+
+    if not settings.PAGE_CACHE_ENABLED:
+        return
+
+    bump(*[topic_scope(name) for name in Tag.expand(names, ancestors=True)])
+
+
+def warm_home():
+    "Schedules a render of the first home page. Purges in quick succession share one render."
+    from biostar.celery import warm_pages
+
+    delay = settings.PAGE_CACHE_WARM_DELAY
+    if cache.add("page-warm", 1, delay):
+        warm_pages.apply_async(countdown=delay)
+
+
+def render_home():
+    "Renders the first home page for an anonymous visitor, this stores it in the cache"
+    from django.contrib.auth.models import AnonymousUser
+    from django.core.urlresolvers import reverse, resolve
+    from django.test.client import RequestFactory
+    from django.utils.importlib import import_module
+
+    path = reverse("home")
+    request = RequestFactory(HTTP_HOST=settings.SITE_DOMAIN or "localhost").get(path)
+    request.session = import_module(settings.SESSION_ENGINE).SessionStore()
+    request.user = AnonymousUser()
+    request.user.is_moderator = request.user.is_admin = False
+
+    # The token slot stands in for the token of the visitors.
+    request.META["CSRF_COOKIE"] = CSRF_SLOT
+
+    match = resolve(path)
+    response = match.func(request, *match.args, **match.kwargs)
+    if response.status_code != 200:
+        logger.error("page warming got status %s" % response.status_code)
+
+
+def hit_rates():
+    "Returns the pages with their hits, misses and hit rate"
+    labels = set(label for label, outcome in PAGE_STATS)
+    rates = []
+    for label in sorted(labels):
+        hits, misses = PAGE_STATS[(label, "hit")], PAGE_STATS[(label, "miss")]
+        rates.append((label, hits, misses, hits / float(hits + misses)))
+    return rates
+
+
+class PageCacheMixin(object):
+    """
+    Serves anonymous requests from the page cache.
+    Views return the scopes of the page from page_scopes.
+    """
+
+    def page_scopes(self):
+        return []
+
+    def page_hit(self, request):
+        "Called when the page was served from the cache"
+        pass
+
+    def dispatch(self, request, *args, **kwargs):
+        label = page_label(request) if cacheable(request) else None
+        scopes = label and self.page_scopes()
+        if not scopes:
+            return super(PageCacheMixin, self).dispatch(request, *args, **kwargs)
+
+        gens = "-".join("%s-%s" % (scope, generation(scope)) for scope in scopes)
+        key = "page-%s-%s" % (hashlib.md5(gens.encode("utf-8")).hexdigest(), hashlib.md5(label.encode("utf-8")).hexdigest())
+
+        content = cache.get(key)
+        if content is not None:
+            PAGE_STATS[(label, "hit")] += 1
+            self.page_hit(request)
+            return HttpResponse(content.replace(CSRF_SLOT, csrf_token(request)))
+
+        PAGE_STATS[(label, "miss")] += 1
+        request.page_cache = True
+        response = super(PageCacheMixin, self).dispatch(request, *args, **kwargs)
+        if response.status_code != 200:
+            return response
+
+        if hasattr(response, "render"):
+            response.render()
+
+        # The token of this visitor must not be shown to the next one.
+        content, token = response.content, csrf_token(request)
+        if token:
+            content = content.replace(token, CSRF_SLOT)
+        cache.set(key, content, settings.PAGE_CACHE_TIMEOUT)
+
+        return response
@@ -2,7 +2,6 @@ __author__ = 'ialbert'
 from django.views.generic import DetailView, ListView, TemplateView, RedirectView, View
 from haystack.views import SearchView
 from haystack.forms import SearchForm
-from haystack.query import SearchQuerySet, AutoQuery
 from haystack.utils import Highlighter
 
 from django.conf import settings
@@ -13,6 +12,8 @@ from django.contrib.sitemaps import FlatPageSitemap, GenericSitemap
 from django.utils.translation import ugettext_lazy as _
 from biostar.apps.posts.models import Post, Tag
 from biostar.apps.planet.models import BlogPost
+from biostar.server import titles, searchcache, tagsuggest
+from django.utils.html import escape
 import logging
 
 logger = logging.getLogger(__name__)
@@ -62,13 +63,8 @@ class Search(BaseListMixin):
         if not self.q:
             return []
 
-        content = AutoQuery(self.q)
-        query = SearchQuerySet().filter(content=content).highlight()[:50]
-        for row in query:
-            context = join_highlights(row)
-            context = context or slow_highlight(query=self.q, text=row.content)
-            row.context = context
-        return query
+        # The pages of a query share the cached results.
+        return searchcache.search(self.q)
 
     def get_context_data(self, **kwargs):
         context = super(Search, self).get_context_data(**kwargs)
@@ -77,43 +73,49 @@ class Search(BaseListMixin):
 
 
 def suggest_tags(request):
-    "Returns suggested tags"
+    "Returns the tags that complete a partial tag name, ranked by the tags already chosen"
+    q = request.GET.get('q', '')
+    chosen = [name.strip() for name in request.GET.get('chosen', '').split(',') if name.strip()]
 
-    tags = Tag.objects.all().order_by('-count')[:10]
+    data = tagsuggest.suggest(q, chosen=chosen)
 
-    data = settings.POST_TAG_LIST + [t.name for t in tags]
-    data = filter(None, data)
+    # The site wide tags are offered before anything is typed.
+    if not q and not chosen:
+        data = filter(None, settings.POST_TAG_LIST) + [name for name in data if name not in settings.POST_TAG_LIST]
 
     return json_response(data)
 
 
+def highlight_title(title, query):
+    "Escapes the title and marks the words that start with a query word"
+    prefixes = titles.words(query)
+    parts, last = [], 0
+    for match in titles.WORD_RE.finditer(title):
+        word = match.group(0)
+        if any(word.lower().startswith(prefix) for prefix in prefixes):
+            parts.append(escape(title[last:match.start()]))
+            parts.append("<b>%s</b>" % escape(word))
+            last = match.end()
+    parts.append(escape(title[last:]))
+    return "".join(parts)
+
+
 #@ajax_error_wrapper
 def search_title(request):
-    "Handles title searches"
+    "Handles title searches from the autocomplete index"
     q = request.GET.get('q', '')
 
-    content = AutoQuery(q)
-    results = SearchQuerySet().filter(content=content).highlight()[:50]
+    try:
+        limit = min(int(request.GET.get('page_limit', 20)), 50)
+    except ValueError:
+        limit = 20
 
     items = []
-    for row in results:
-        try:
-            ob = row.object
-
-            # Why can this happen?
-            if not ob:
-                continue
-            context = join_highlights(row)
-            context = context or slow_highlight(query=q, text=row.content)
-            text = "%s" % row.title
-            items.append(
-                dict(id=ob.get_absolute_url(), text=text, context=context, author=row.author,
-                     url=ob.get_absolute_url()),
-            )
-        except Exception, exc:
-            logger.error(content)
-            logger.error(exc)
-            pass
+    for row in titles.search(q, limit=limit):
+        items.append(
+            dict(id=row['url'], text=highlight_title(row['title'], q), context='', author=escape(row['author']),
+                 url=row['url']),
+        )
 
     payload = dict(items=items)
     return json_response(payload)
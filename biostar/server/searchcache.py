@@ -0,0 +1,132 @@
+"""
+Search result cache.
+
+The results of a query are stored under the normalized query and the generation of the index.
+A row carries everything the result page shows: the title, url, author and the highlighted context.
+The generation is read from the index on disk, every process sees an index update right away.
+Backends that live in the site database are always current and their results are not cached.
+
+The popular queries are counted in each process and merged into the cache from time to time.
+After an index update they are searched again when the cache is shared by the processes.
+"""
+from __future__ import print_function, unicode_literals, absolute_import, division
+import hashlib, logging, threading
+from collections import Counter
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+logger = logging.getLogger(__name__)
+
+POPULAR_KEY = "search-popular"
+
+# Queries of this process that are not yet merged into the cache.
+QUERY_COUNTS = Counter()
+lock = threading.Lock()
+
+
+def normalize(q):
+    return " ".join(q.lower().split())
+
+
+def generation():
+    "Identifies the current state of the index, None when the results may not be cached"
+    from haystack import connections
+
+    backend = connections['default'].get_backend()
+    return backend.generation() if hasattr(backend, "generation") else None
+
+
+def shared():
+    "Warmed results reach the other processes only through a shared cache"
+    return not isinstance(cache, (LocMemCache, DummyCache))
+
+
+def make_key(q, gen):
+    return "search-%s" % hashlib.md5(("%s %s" % (gen, q)).encode("utf-8")).hexdigest()
+
+
+def highlight(row, q):
+    "The highlights of the backend or, when missing, a highlight of the content"
+    from biostar.server.search import join_highlights, slow_highlight
+    return join_highlights(row) or slow_highlight(query=q, text=row.content)
+
+
+def run_search(q):
+    "Searches the index, the result rows are dictionaries"
+    from haystack.query import SearchQuerySet, AutoQuery
+
+    found = list(SearchQuerySet().filter(content=AutoQuery(q)).highlight()[:settings.SEARCH_CACHE_RESULTS])
+
+    # The objects of each model are loaded with one query.
+    objects = {}
+    for model in set(row.model for row in found):
+        pks = [int(row.pk) for row in found if row.model == model]
+        objects[model] = model.objects.in_bulk(pks)
+
+    rows = []
+    for row in found:
+        obj = objects[row.model].get(int(row.pk))
+        # The index may still list removed objects.
+        if not obj:
+            continue
+        title = obj.get_title() if callable(obj.get_title) else obj.get_title
+        rows.append(dict(pk=obj.pk, title=title, url=obj.get_absolute_url(), author=row.author,
+                         context=highlight(row, q)))
+    return rows
+
+
+def search(q):
+    "Returns the cached results of the query"
+    q = normalize(q)
+    if not q:
+        return []
+
+    count(q)
+
+    gen = generation()
+    if gen is None:
+        return run_search(q)
+
+    key = make_key(q, gen)
+    rows = cache.get(key)
+    if rows is None:
+        rows = run_search(q)
+        cache.set(key, rows, settings.SEARCH_CACHE_TIMEOUT)
+    return rows
+
+
+def count(q):
+    with lock:
+        QUERY_COUNTS[q] += 1
+        if sum(QUERY_COUNTS.values()) < settings.SEARCH_POPULAR_FLUSH:
+            return
+        counts = dict(QUERY_COUNTS)
+        QUERY_COUNTS.clear()
+    merge(counts)
+
+
+def merge(counts):
+    "Adds the counts to the popular queries in the cache. Concurrent merges may lose counts."
+    popular = Counter(cache.get(POPULAR_KEY) or {})
+    popular.update(counts)
+    popular = dict(popular.most_common(settings.SEARCH_WARM_QUERIES * 5))
+    cache.set(POPULAR_KEY, popular, None)
+
+
+def popular(limit):
+    popular = Counter(cache.get(POPULAR_KEY) or {})
+    return [q for q, value in popular.most_common(limit)]
+
+
+def index_changed():
+    "Searches the popular queries again in the new generation of the index"
+    gen = generation()
+    if gen is None or not shared():
+        return
+    for q in popular(settings.SEARCH_WARM_QUERIES):
+        try:
+            cache.set(make_key(q, gen), run_search(q), settings.SEARCH_CACHE_TIMEOUT)
+        except Exception, exc:
+            logger.error("unable to warm search %r: %s" % (q, exc))
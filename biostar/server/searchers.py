@@ -0,0 +1,153 @@
+"""
+Whoosh search backend with a pool of open searchers.
+
+The stock backend opens a new searcher, and with it every segment of the index, for each query.
+This backend keeps the searchers of each process open across requests. A searcher is handed
+to one thread at a time. The pool is emptied when the index moves to a new generation
+or when a rebuild swaps in a new index directory.
+
+The search latencies are recorded separately for cold queries, that had to open a searcher,
+and warm queries, that reused one.
+"""
+from __future__ import print_function, unicode_literals, absolute_import, division
+import logging, os, threading, time
+from collections import deque
+from django.conf import settings
+from haystack.backends.whoosh_backend import WhooshEngine, WhooshSearchBackend
+
+logger = logging.getLogger(__name__)
+
+# The most recent search latencies in seconds.
+SEARCH_LATENCY = dict(cold=deque(maxlen=1000), warm=deque(maxlen=1000))
+
+# Tracks whether the search of the current thread opened a searcher.
+local = threading.local()
+
+
+def percentiles(values, points=(50, 90, 99)):
+    values = sorted(values)
+    return [values[min(len(values) - 1, len(values) * point // 100)] for point in points]
+
+
+def latency_percentiles():
+    "Returns the number of searches and the 50th, 90th and 99th percentile in milliseconds for cold and warm searches"
+    stats = {}
+    for kind, values in SEARCH_LATENCY.items():
+        values = list(values)
+        points = [value * 1000 for value in percentiles(values)] if values else [0, 0, 0]
+        stats[kind] = [len(values)] + points
+    return stats
+
+
+class SearcherPool(object):
+    "Holds the idle searchers of the current generation"
+
+    def __init__(self, index, size):
+        self.index = index
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = []
+        self.key = None
+        self.pid = None
+
+    def current_key(self):
+        # A rebuild replaces the directory behind the path, its generations start over.
+        return os.path.realpath(self.index.storage.folder), self.index.latest_generation()
+
+    def checkout(self):
+        key = self.current_key()
+        stale = []
+        with self.lock:
+            if self.pid != os.getpid():
+                # The searchers of the parent process may not be shared.
+                self.idle, self.pid = [], os.getpid()
+            if key != self.key:
+                stale, self.idle, self.key = self.idle, [], key
+            searcher = self.idle.pop() if self.idle else None
+
+        for old in stale:
+            old.close()
+
+        if searcher is None:
+            local.cold = True
+            searcher = self.index.searcher()
+
+        return PooledSearcher(self, searcher, key)
+
+    def checkin(self, searcher, key):
+        with self.lock:
+            if key == self.key and self.pid == os.getpid() and len(self.idle) < self.size:
+                self.idle.append(searcher)
+                return
+        searcher.close()
+
+    def clear(self):
+        with self.lock:
+            stale, self.idle = self.idle, []
+        for searcher in stale:
+            searcher.close()
+
+
+class PooledSearcher(object):
+    "Returns the searcher to the pool when closed"
+
+    def __init__(self, pool, searcher, key):
+        self.pool, self.searcher, self.key = pool, searcher, key
+
+    def close(self):
+        if self.searcher:
+            self.pool.checkin(self.searcher, self.key)
+            self.searcher = None
+
+    def __getattr__(self, name):
+        return getattr(self.searcher, name)
+
+
+class PooledIndex(object):
+    "Stands in for the Whoosh index of the backend, the searchers come from the pool"
+
+    def __init__(self, index, size):
+        self.pool = SearcherPool(index, size)
+
+    def refresh(self):
+        # The pool checks the generation for every searcher.
+        return self
+
+    def searcher(self, **kwargs):
+        return self.pool.checkout()
+
+    def doc_count(self):
+        searcher = self.searcher()
+        try:
+            return searcher.doc_count()
+        finally:
+            searcher.close()
+
+    def __getattr__(self, name):
+        return getattr(self.pool.index, name)
+
+
+class PooledWhooshSearchBackend(WhooshSearchBackend):
+
+    def setup(self):
+        super(PooledWhooshSearchBackend, self).setup()
+        self.index = PooledIndex(self.index, settings.SEARCH_POOL_SIZE)
+
+    def generation(self):
+        "The directory and the generation of the index, the same in every process"
+        if not self.setup_complete:
+            self.setup()
+        return "%s:%s" % self.index.pool.current_key()
+
+    def search(self, query_string, *args, **kwargs):
+        local.cold = False
+        start = time.time()
+        try:
+            return super(PooledWhooshSearchBackend, self).search(query_string, *args, **kwargs)
+        finally:
+            kind = "cold" if local.cold else "warm"
+            SEARCH_LATENCY[kind].append(time.time() - start)
+
+
+class PooledWhooshEngine(WhooshEngine):
+    backend = PooledWhooshSearchBackend
@@ -0,0 +1,160 @@
+"""
+Daily site statistics.
+
+The posts, votes and users created since the last rolled up day are read in one pass
+and counted by day, one row is stored for each day that has ended. The days follow
+the time zone of the site, the rows are added in order and carry the running totals.
+"""
+from __future__ import print_function, unicode_literals, absolute_import, division
+import logging
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from django.db import transaction, IntegrityError
+from django.db.models import Min
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+COUNTS = ("questions", "answers", "toplevel", "comments", "votes", "users")
+
+
+def midnight(day):
+    "The start of the day in the time zone of the site"
+    return timezone.make_aware(datetime.combine(day, time.min), timezone.get_current_timezone())
+
+
+def local_day(date):
+    return timezone.localtime(date).date() if timezone.is_aware(date) else date.date()
+
+
+def today():
+    return timezone.localtime(timezone.now()).date()
+
+
+def first_day():
+    "The day of the oldest post, vote or user, None for an empty site"
+    from biostar.apps.posts.models import Post, Vote
+    from biostar.apps.users.models import Profile
+
+    dates = [
+        Post.objects.aggregate(first=Min("creation_date"))["first"],
+        Vote.objects.aggregate(first=Min("date"))["first"],
+        Profile.objects.aggregate(first=Min("date_joined"))["first"],
+    ]
+    dates = [local_day(date) for date in dates if date]
+    return min(dates) if dates else None
+
+
+def rollup(full=False):
+    "Stores the statistics of the days that ended since the last rollup. Returns the number of days."
+    from biostar.apps.posts.models import Post, Vote, DailyStats
+    from biostar.apps.users.models import Profile
+
+    if full:
+        DailyStats.objects.all().delete()
+
+    last = DailyStats.objects.order_by("-date").first()
+    if last:
+        start = last.date + timedelta(days=1)
+        totals = dict((name, getattr(last, name)) for name in COUNTS)
+    else:
+        start = first_day()
+        totals = dict((name, 0) for name in COUNTS)
+
+    end = today()
+    if not start or start >= end:
+        return 0
+
+    begin, stop = midnight(start), midnight(end)
+    counts, ids = defaultdict(lambda: defaultdict(int)), defaultdict(lambda: defaultdict(list))
+
+    posts = Post.objects.filter(creation_date__gte=begin, creation_date__lt=stop).order_by("id")
+    for pk, kind, date in posts.values_list("id", "type", "creation_date").iterator():
+        day = local_day(date)
+        ids[day]["new_posts"].append(pk)
+        if kind == Post.QUESTION:
+            counts[day]["questions"] += 1
+        elif kind == Post.ANSWER:
+            counts[day]["answers"] += 1
+        elif kind == Post.COMMENT:
+            counts[day]["comments"] += 1
+        if kind in Post.TOP_LEVEL and kind != Post.BLOG:
+            counts[day]["toplevel"] += 1
+
+    votes = Vote.objects.filter(date__gte=begin, date__lt=stop).order_by("id")
+    for pk, date in votes.values_list("id", "date").iterator():
+        day = local_day(date)
+        ids[day]["new_votes"].append(pk)
+        counts[day]["votes"] += 1
+
+    users = Profile.objects.filter(date_joined__gte=begin, date_joined__lt=stop).order_by("user")
+    for pk, date in users.values_list("user_id", "date_joined").iterator():
+        day = local_day(date)
+        ids[day]["new_users"].append(pk)
+        counts[day]["users"] += 1
+
+    rows, day = [], start
+    while day < end:
+        for name in COUNTS:
+            totals[name] += counts[day][name]
+        joined = dict((name, ",".join(map(str, ids[day][name]))) for name in ("new_posts", "new_votes", "new_users"))
+        rows.append(DailyStats(date=day, **dict(totals, **joined)))
+        day += timedelta(days=1)
+
+    try:
+        with transaction.atomic():
+            DailyStats.objects.bulk_create(rows, batch_size=500)
+    except IntegrityError:
+        # Another process has stored these days.
+        return 0
+
+    logger.info("rolled up %s days from %s" % (len(rows), start))
+    return len(rows)
+
+
+def last_day():
+    """
+    The last day with statistics, the days after it wait for the stats_rollup task.
+    Before the first rollup all days up to yesterday have zero counts.
+    """
+    from biostar.apps.posts.models import DailyStats
+
+    yesterday = today() - timedelta(days=1)
+    last = DailyStats.objects.order_by("-date").values_list("date", flat=True).first()
+    return min(last, yesterday) if last else yesterday
+
+
+def split(text):
+    return [int(pk) for pk in text.split(",") if pk]
+
+
+def days(start, end):
+    """
+    The statistics of the days from start to end, both included, as a list of dictionaries.
+    The days before the site existed have zero counts, the days after the last rollup carry its totals.
+    """
+    from biostar.apps.posts.models import DailyStats
+
+    rows = DailyStats.objects.filter(date__gte=start, date__lte=end)
+    rows = dict((row.date, row) for row in rows)
+
+    # The totals carry over to the days that have no row.
+    previous = None
+    if start not in rows:
+        previous = DailyStats.objects.filter(date__lt=start).order_by("-date").first()
+
+    result, day = [], start
+    while day <= end:
+        row = rows.get(day)
+        if row:
+            previous = row
+            data = dict((name, getattr(row, name)) for name in COUNTS)
+            data.update(new_posts=split(row.new_posts), new_votes=split(row.new_votes), new_users=split(row.new_users))
+        else:
+            data = dict((name, getattr(previous, name) if previous else 0) for name in COUNTS)
+            data.update(new_posts=[], new_votes=[], new_users=[])
+        data["date"] = day
+        result.append(data)
+        day += timedelta(days=1)
+
+    return result
@@ -0,0 +1,201 @@
+"""
+Tag suggestions.
+
+Completes a partially typed tag name from a prefix trie of the tag names, the more used tags come first.
+Tags that were used together with the already chosen tags rank above all others.
+
+A batch job counts the tags that appear together on the same posts and publishes the counts to a file.
+Each process loads the file when it changes and updates its trie in place, only the tags with
+new counts are touched.
+"""
+from __future__ import print_function, unicode_literals, absolute_import, division
+import heapq, json, logging, os, threading, time
+from collections import Counter, defaultdict
+from itertools import groupby, permutations
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Node(object):
+    __slots__ = ("children", "names", "best")
+
+    def __init__(self):
+        self.children, self.names, self.best = {}, [], []
+
+
+class TagTrie(object):
+    "Prefix trie of the tag names, each node keeps the best completions in its subtree"
+
+    def __init__(self, size):
+        self.size = size
+        self.root = Node()
+        self.counts = {}
+
+    def rank(self, name):
+        return -self.counts[name], name
+
+    def path(self, name, create=False):
+        node, nodes = self.root, [self.root]
+        for char in name.lower():
+            child = node.children.get(char)
+            if child is None:
+                if not create:
+                    return []
+                child = node.children[char] = Node()
+            node = child
+            nodes.append(node)
+        return nodes
+
+    def collect(self, node):
+        "The best completions in the subtree of the node"
+        names, stack = [], [node]
+        while stack:
+            node = stack.pop()
+            names.extend(node.names)
+            stack.extend(node.children.values())
+        return heapq.nsmallest(self.size, names, key=self.rank)
+
+    def update(self, name, count):
+        old = self.counts.get(name)
+        self.counts[name] = count
+        nodes = self.path(name, create=True)
+        if old is None:
+            nodes[-1].names.append(name)
+
+        for node in nodes:
+            if name in node.best and old is not None and count < old and len(node.best) == self.size:
+                # Another tag of the subtree may now rank above this one.
+                node.best = self.collect(node)
+                continue
+            if name not in node.best:
+                if len(node.best) == self.size and self.rank(name) > self.rank(node.best[-1]):
+                    continue
+                node.best.append(name)
+            node.best.sort(key=self.rank)
+            del node.best[self.size:]
+
+    def remove(self, name):
+        nodes = self.path(name)
+        if name not in self.counts or not nodes:
+            return
+        del self.counts[name]
+        nodes[-1].names.remove(name)
+        for node in nodes:
+            if name in node.best:
+                node.best = self.collect(node)
+
+    def complete(self, prefix):
+        nodes = self.path(prefix)
+        return nodes[-1].best if nodes else []
+
+
+class Suggestions(object):
+    "The trie and the co-occurring tags of one process"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.trie = TagTrie(settings.TAG_SUGGEST_CANDIDATES)
+        self.related = {}
+        self.mtime = None
+        self.checked = 0
+
+    def load(self, counts, related):
+        for name in set(self.trie.counts) - set(counts):
+            self.trie.remove(name)
+        for name, count in counts.items():
+            if self.trie.counts.get(name) != count:
+                self.trie.update(name, count)
+        self.related = related
+
+    def refresh(self):
+        "Loads the published counts when they changed"
+        from biostar.apps.posts.models import Tag
+
+        now = time.time()
+        if now - self.checked < settings.TAG_SUGGEST_CHECK:
+            return
+        self.checked = now
+
+        path = settings.TAG_SUGGEST_PATH
+        mtime = os.path.getmtime(path) if os.path.exists(path) else 0
+        if mtime == self.mtime:
+            return
+
+        if mtime:
+            with open(path) as stream:
+                data = json.load(stream)
+            self.load(data["counts"], data["related"])
+        else:
+            # The batch job has not run yet.
+            self.load(dict(Tag.objects.values_list("name", "count")), {})
+        self.mtime = mtime
+
+    def suggest(self, prefix, chosen=(), limit=None):
+        "Ranked completions of the prefix, the chosen tags are left out"
+        limit = limit or settings.TAG_SUGGEST_LIMIT
+        prefix, chosen = prefix.strip().lower(), set(chosen)
+
+        with self.lock:
+            self.refresh()
+
+            # Tags that were used together with the chosen ones.
+            boost = Counter()
+            for name in chosen:
+                for other, count in self.related.get(name, []):
+                    if other.lower().startswith(prefix):
+                        boost[other] += count
+
+            counts = self.trie.counts
+            names = (set(self.trie.complete(prefix)) | set(boost)) - chosen
+            return sorted(names, key=lambda name: (-boost[name], -counts.get(name, 0), name))[:limit]
+
+
+suggestions = Suggestions()
+
+
+def suggest(prefix, chosen=(), limit=None):
+    return suggestions.suggest(prefix, chosen=chosen, limit=limit)
+
+
+def write_json(path, data):
+    "Replaces the file in one step, readers never see a partial file"
+    temp = "%s.%s" % (path, os.getpid())
+    with open(temp, "w") as stream:
+        json.dump(data, stream)
+    os.rename(temp, path)
+
+
+def build(full=False):
+    """
+    Counts the tags that appear together on the top level posts and publishes the counts.
+    Only the posts added since the previous run are counted, unless full is set.
+    Returns the number of posts that were counted.
+    """
+    from biostar.apps.posts.models import Post, Tag
+
+    state_path = settings.TAG_SUGGEST_PATH + ".state"
+    last, pairs = 0, defaultdict(Counter)
+    if not full and os.path.exists(state_path):
+        with open(state_path) as stream:
+            state = json.load(stream)
+        last = state["last"]
+        for name, others in state["pairs"].items():
+            pairs[name].update(others)
+
+    rows = Post.tag_set.through.objects.filter(post__gt=last, post__type__in=Post.TOP_LEVEL)
+    rows = rows.order_by("post").values_list("post", "tag__name")
+    posts = 0
+    for pk, group in groupby(rows.iterator(), key=lambda row: row[0]):
+        for first, second in permutations(set(name for pk, name in group), 2):
+            pairs[first][second] += 1
+        last, posts = pk, posts + 1
+
+    related = {}
+    for name, others in pairs.items():
+        related[name] = sorted(others.items(), key=lambda item: (-item[1], item[0]))[:settings.TAG_SUGGEST_RELATED]
+
+    write_json(state_path, dict(last=last, pairs=pairs))
+    write_json(settings.TAG_SUGGEST_PATH, dict(counts=dict(Tag.objects.values_list("name", "count")), related=related))
+    logger.info("counted the tags of %s posts" % posts)
+    return posts
@@ -2,7 +2,8 @@ from django import template
 from django.conf import settings
 from django.template import Context, Template
 from django.template.defaultfilters import stringfilter
-from django.core.context_processors import csrf
+from django.core.cache import cache
+from django.utils.safestring import mark_safe
 from biostar.apps.posts.models import Post, Tag
 from biostar.apps.messages.models import Message
 import random, hashlib, urllib
@@ -12,6 +13,7 @@ from django import template
 from django.core.urlresolvers import reverse
 from biostar import const
 from biostar.server.views import LATEST
+from biostar.server.context import get_marker
 
 register = template.Library()
 
@@ -256,25 +258,63 @@ def post_count_box(post, context='', topic=''):
     return dict(post=post, context=context, topic=topic)
 
 @register.inclusion_tag('server_tags/post_actions.html')
-def post_actions(post, user, label="COMMENT"):
+def post_actions(post, user, label="COMMENT", slot=None):
     "Renders post actions"
-    return dict(post=post, user=user, label=label)
+    return dict(post=post, user=user, label=label, slot=slot)
 
 
 @register.inclusion_tag('server_tags/user_link.html')
 def userlink(user):
     "Renders the flair"
-    marker = "&bull;"
-    if user.is_admin:
-        marker = '&diams;&diams;'
-    elif user.is_moderator:
-        marker = '&diams;'
-    return {'user': user, 'marker': marker}
+    return {'user': user, 'marker': get_marker(user)}
 
 # this contains the body of each comment
 COMMENT_TEMPLATE = 'server_tags/comment_body.html'
 COMMENT_BODY = template.loader.get_template(COMMENT_TEMPLATE)
 
+# The cached comment fragments leave these slots for the parts that depend on the user.
+COMMENT_SLOT = dict(
+    upvote=mark_safe("<!--slot-upvote-->"),
+    edit_start=mark_safe("<!--slot-edit-->"),
+    edit_end=mark_safe("<!--/slot-edit-->"),
+)
+
+
+def comment_key(post):
+    "The fragment changes when the comment is edited, voted, bookmarked or moderated"
+    return "comment-%s-%s-%s-%s-%s" % (
+        post.id, post.lastedit_date.strftime("%Y%m%d%H%M%S%f"), post.vote_count, post.book_count, post.status)
+
+
+def comment_fragments(comments):
+    "Returns the cached fragments for the comments, renders the missing ones"
+    keys = dict((post.id, comment_key(post)) for post in comments)
+    cached = cache.get_many(keys.values())
+
+    fragments, missing = {}, {}
+    for post in comments:
+        key = keys[post.id]
+        if key in cached:
+            fragments[post.id] = cached[key]
+        else:
+            cont = Context({"post": post, "slot": COMMENT_SLOT})
+            fragments[post.id] = missing[key] = COMMENT_BODY.render(cont)
+
+    if missing:
+        cache.set_many(missing, settings.COMMENT_CACHE_TIMEOUT)
+
+    return fragments
+
+
+def fill_slots(html, post):
+    "Fills in the vote state and the edit links for the current user"
+    html = html.replace(COMMENT_SLOT['upvote'], on(post.has_upvote), 1)
+    head, sep, rest = html.partition(COMMENT_SLOT['edit_start'])
+    if sep:
+        body, sep, tail = rest.partition(COMMENT_SLOT['edit_end'])
+        html = head + (body if post.is_editable else '') + tail
+    return html
+
 
 @register.simple_tag
 def render_comments(request, post, tree):
@@ -291,21 +331,26 @@ def render_comments(request, post, tree):
 
 def traverse_comments(request, post, tree):
     "Traverses the tree and generates the page"
-    global COMMENT_BODY
-
-    def traverse(node):
-        data = ['<div class="indent">']
-        cont = Context({"post": node, 'user': request.user, 'request': request})
-        cont.update(csrf(request))
-        html = COMMENT_BODY.render(cont)
-        data.append(html)
-        for child in tree.get(node.id, []):
-            data.append(traverse(child))
-        data.append("</div>")
-        return '\n'.join(data)
-
-    # this collects the comments for the post
-    coll = []
-    for node in tree[post.id]:
-        coll.append(traverse(node))
-    return '\n'.join(coll)
+
+    # Collect the comments below the post.
+    comments, stack = [], list(tree[post.id])
+    while stack:
+        node = stack.pop()
+        comments.append(node)
+        stack.extend(tree.get(node.id, []))
+
+    fragments = comment_fragments(comments)
+
+    # Depth first walk. A None on the stack closes the enclosing comment.
+    data, stack = [], list(reversed(tree[post.id]))
+    while stack:
+        node = stack.pop()
+        if node is None:
+            data.append("</div>")
+            continue
+        data.append('<div class="indent">')
+        data.append(fill_slots(fragments[node.id], node))
+        stack.append(None)
+        stack.extend(reversed(tree.get(node.id, [])))
+
+    return '\n'.join(data)
@@ -6,7 +6,8 @@ from django.test import TestCase
 from django.core.urlresolvers import reverse
 from django.test.utils import override_settings
 
-from biostar.apps.posts.models import Post, Vote
+from biostar.apps.posts.models import Post, Vote, DailyStats
+from biostar.server import stats
 from biostar.apps.users.models import User
 
 
@@ -63,6 +64,9 @@ class ApiStatsTest2(TestCase):
         self.post = self.create_post(self.user, Post.QUESTION, days=3)
         Vote.objects.create(author=self.user, post=self.post, type=Vote.UP)
 
+        # The stats_rollup task stores the days that have ended.
+        stats.rollup()
+
     def create_post(self, user, post_type, days=3):
         # Create a post.
         title = "Post 1, title needs to be sufficiently long"
@@ -136,6 +140,7 @@ class ApiStatsTest3(TestCase):
         self.question = self.create_post(Post.QUESTION)
         self.answer = self.create_post(Post.ANSWER, self.question)
         self.comment = self.create_post(Post.COMMENT, self.question)
+        stats.rollup()
 
     def create_post(self, post_type, parent=None, days=3):
         # Create a post.
@@ -179,4 +184,68 @@ class ApiStatsTest3(TestCase):
         r = self.client.get(reverse('api-stats-on-day', kwargs={'day': 3}))
         content_day = json.loads(r.content)
 
-        self.assertEqual(content_day, content_date)
\ No newline at end of file
+        self.assertEqual(content_day, content_date)
+
+class ApiStatsRangeTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='test@test.com', password='...')
+        self.user.profile.date_joined = datetime.today() - timedelta(days=4)
+        self.user.profile.save()
+
+        self.posts = []
+        for post_type, days in [(Post.QUESTION, 4), (Post.QUESTION, 2), (Post.ANSWER, 2)]:
+            post = Post(title="Post 1, title needs to be sufficiently long", content="Lorem ipsum",
+                        tag_val='tag_val', author=self.user, type=post_type,
+                        parent=self.posts[0] if post_type == Post.ANSWER else None)
+            post.creation_date = datetime.today() - timedelta(days=days)
+            post.save()
+            self.posts.append(post)
+        stats.rollup()
+
+    def range(self, start, end):
+        r = self.client.get(reverse('api-stats-in-range', kwargs={
+            'start': start.strftime('%Y-%m-%d'), 'end': end.strftime('%Y-%m-%d')}))
+        return json.loads(r.content) if r.status_code == 200 else None
+
+    def test_range(self):
+        """
+        A range returns the days of the per-day endpoints in one response.
+        """
+        first = datetime.today() - timedelta(days=6)
+        content = self.range(first, datetime.today() + timedelta(days=3))
+
+        # The range stops at yesterday.
+        days = content['days']
+        self.assertEqual(6, len(days))
+        self.assertEqual([0, 0, 1, 1, 2, 2], [day['questions'] for day in days])
+        self.assertEqual([0, 0, 0, 0, 1, 1], [day['answers'] for day in days])
+        self.assertEqual([self.posts[1].id, self.posts[2].id], days[4]['new_posts'])
+
+        for day in days:
+            date = datetime.strptime(day['date'][:10], '%Y-%m-%d')
+            r = self.client.get(reverse('api-stats-on-date', kwargs={
+                'year': date.year, 'month': str(date.month).zfill(2), 'day': str(date.day).zfill(2)}))
+            self.assertEqual(day, json.loads(r.content))
+
+        # The session, the last rolled up day, the rows and the totals before them.
+        with self.assertNumQueries(4):
+            self.assertEqual(content, self.range(first, datetime.today()))
+
+        self.assertEqual(None, self.range(datetime.today(), first))
+
+    def test_pending_days(self):
+        """
+        The days that are not rolled up yet are not shown, the requests do not roll them up.
+        """
+        DailyStats.objects.filter(date=stats.last_day()).delete()
+        first = datetime.today() - timedelta(days=6)
+        self.assertEqual(5, len(self.range(first, datetime.today())['days']))
+        self.assertEqual(5, len(self.range(first, datetime.today())['days']))
+
+        yesterday = datetime.today() - timedelta(days=1)
+        r = self.client.get(reverse('api-stats-on-date', kwargs={
+            'year': yesterday.year, 'month': str(yesterday.month).zfill(2), 'day': str(yesterday.day).zfill(2)}))
+        self.assertEqual({}, json.loads(r.content))
+
+        stats.rollup()
+        self.assertEqual(6, len(self.range(first, datetime.today())['days']))
@@ -1,5 +1,7 @@
 from datetime import datetime
 import json
+import shutil
+import tempfile
 import logging
 
 from django.test import TestCase
@@ -7,6 +9,7 @@ from django.core.urlresolvers import reverse
 
 from ..api import datetime_to_iso, datetime_to_unix
 from biostar.apps.posts.models import Post
+from biostar.apps.posts import tracking
 from biostar.apps.users.models import User
 
 
@@ -18,6 +21,13 @@ class ApiTrafficTest(TestCase):
     def setUp(self):
         # Disable haystack logger (testing will raise errors on more_like_this field in templates).
         haystack_logger.setLevel(logging.CRITICAL)
+        self.spool = tempfile.mkdtemp()
+        self.override = self.settings(POST_VIEW_SPOOL_DIR=self.spool)
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.spool)
 
     def test_no_traffic(self):
         """
@@ -40,9 +50,13 @@ class ApiTrafficTest(TestCase):
         # Create a post.
         post = self.create_a_post(user)
 
-        # Create a post-view.
+        # Create a post-view. Forget the views of earlier tests.
+        tracking.cache.clear()
         self.client.get(reverse('post-details', kwargs={'pk': post.pk}))
 
+        # Store the spooled views.
+        tracking.flush()
+
         # Check traffic.
         r = self.client.get(reverse('api-traffic'))
         now = datetime.now()
@@ -0,0 +1,54 @@
+import logging, os, shutil, tempfile
+
+from django.test import TestCase
+from haystack import connections
+from haystack.query import SearchQuerySet
+
+from biostar.server.management.commands import build_index
+from biostar.apps.posts.models import Post
+from biostar.apps.users.models import User
+
+logging.disable(logging.WARNING)
+
+
+class BuildIndexTest(TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.target = os.path.join(self.temp, "whoosh_index")
+        self.info = connections.connections_info['default']
+        connections.connections_info['default'] = dict(self.info, PATH=self.target)
+        connections.reload('default')
+
+        self.user = User.objects.create(email='test@test.com', password='...')
+        for step in range(5):
+            Post.objects.create(title="Aligning reads %s" % step, content="Lorem ipsum", author=self.user,
+                                type=Post.QUESTION)
+
+    def tearDown(self):
+        connections.connections_info['default'] = self.info
+        connections.reload('default')
+        shutil.rmtree(self.temp, ignore_errors=True)
+
+    def test_shard_ranges(self):
+        self.assertEqual(build_index.shard_ranges([1, 2, 3, 5, 8], 2), [(1, 3), (5, 8)])
+        self.assertEqual(build_index.shard_ranges([1], 4), [(1, 1)])
+        self.assertEqual(build_index.shard_ranges([], 4), [])
+
+    def test_build(self):
+        "The shards are merged and swapped into place"
+        os.makedirs(self.target)
+        self.assertEqual(build_index.build(workers=0), 5)
+        self.assertTrue(os.path.islink(self.target))
+        self.assertEqual(SearchQuerySet().models(Post).filter(content="aligning").count(), 5)
+
+        # The first swap keeps the directory that it replaced.
+        first = os.readlink(self.target)
+        self.assertEqual(sorted(os.listdir(self.temp)), sorted(["whoosh_index", first, first + ".old"]))
+
+        # The next rebuild replaces the link and keeps only the previous index.
+        Post.objects.create(title="Calling variants", content="Lorem ipsum", author=self.user, type=Post.QUESTION)
+        self.assertEqual(build_index.build(workers=0, shards=3), 6)
+        self.assertNotEqual(os.readlink(self.target), first)
+        self.assertEqual(sorted(os.listdir(self.temp)), sorted(["whoosh_index", first, os.readlink(self.target)]))
+        self.assertEqual(SearchQuerySet().models(Post).filter(content="aligning").count(), 5)
+        self.assertEqual(SearchQuerySet().models(Post).filter(content="variants").count(), 1)
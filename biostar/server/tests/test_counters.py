@@ -0,0 +1,108 @@
+import logging, glob, os, shutil, tempfile
+from datetime import timedelta
+
+from django.test import TestCase
+from django.test.client import Client, RequestFactory
+from django.core.urlresolvers import reverse
+
+from biostar import const
+from biostar.server import counters
+from biostar.server.middleware import get_counts
+from biostar.apps.posts.models import Post, Vote, ActivityCount
+from biostar.apps.users.models import User
+from biostar.apps.messages.models import Message, MessageBody
+
+
+logging.disable(logging.WARNING)
+
+
+class CountersTest(TestCase):
+    def setUp(self):
+        self.spool = tempfile.mkdtemp()
+        self.override = self.settings(COUNTER_SPOOL_DIR=self.spool)
+        self.override.enable()
+        self.user = User.objects.create(email='test@test.com', password='...')
+        self.since = const.now() - timedelta(hours=1)
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.spool)
+
+    def counts(self, targets):
+        counters.flush()
+        return counters.counts_since(targets, self.since)
+
+    def test_spans(self):
+        "Full days are covered by a single bucket"
+        now = const.now()
+        spans = counters.spans(now - timedelta(days=10), now)
+        days = [span for span in spans if span[0] == counters.DAY]
+        self.assertTrue(len(days) >= 9)
+        self.assertTrue(len(spans) <= 9 + 2 * 24)
+
+    def test_post_counts(self):
+        "New posts, tags, answers and votes update the buckets"
+        title = "Post 1, title needs to be sufficiently long"
+        post = Post.objects.create(title=title, content="Lorem ipsum", author=self.user, type=Post.QUESTION)
+        post.add_tags("rna-seq, snp")
+
+        targets = dict(latest=("type", "latest"), open=("type", "open"), snp=("tag", "snp"),
+                       votes=("votes", self.user.id))
+        # The events wait in the spool until the flush.
+        self.assertEqual(counters.counts_since(targets, self.since), dict(latest=0, open=0, snp=0, votes=0))
+        self.assertEqual(dict(latest=1, open=1, snp=1, votes=0), self.counts(targets))
+        self.assertEqual([], glob.glob(os.path.join(self.spool, "*")))
+
+        other = User.objects.create(email='other@test.com', password='...')
+        Post.objects.create(content="An answer", author=other, type=Post.ANSWER, parent=post)
+        Vote.objects.create(author=other, post=post, type=Vote.UP)
+
+        self.assertEqual(dict(latest=1, open=0, snp=1, votes=1), self.counts(targets))
+
+    def test_post_status(self):
+        "Closed, reopened and removed posts update the counts"
+        targets = dict(latest=("type", "latest"), open=("type", "open"), snp=("tag", "snp"))
+        moderator = User.objects.create(email='mod@test.com', type=User.MODERATOR)
+        moderator.set_password("password")
+        moderator.save()
+        client = Client()
+        client.login(username=moderator.email, password="password")
+
+        title = "Post 1, title needs to be sufficiently long"
+        post = Post.objects.create(title=title, content="Lorem ipsum", author=self.user, type=Post.QUESTION,
+                                   tag_val="snp")
+        post.add_tags("snp")
+        self.assertEqual(dict(latest=1, open=1, snp=1), self.counts(targets))
+
+        url = reverse("post-moderation", kwargs=dict(pk=post.id))
+        client.post(url, dict(action="1", comment="Off topic"))
+        self.assertEqual(Post.CLOSED, Post.objects.get(pk=post.id).status)
+        self.assertEqual(dict(latest=0, open=0, snp=0), self.counts(targets))
+
+        client.post(url, dict(action="0"))
+        self.assertEqual(dict(latest=1, open=1, snp=1), self.counts(targets))
+
+        # Removed posts take their tags along.
+        Post.objects.get(pk=post.id).delete()
+        self.assertEqual(dict(latest=0, open=0, snp=0), self.counts(targets))
+
+    def test_prune(self):
+        "Expired buckets are deleted"
+        counters.incr("type", "latest")
+        counters.incr("type", "latest", date=const.now() - timedelta(days=3))
+        counters.flush()
+        self.assertEqual(4, ActivityCount.objects.count())
+        counters.prune()
+        self.assertEqual(3, ActivityCount.objects.count())
+
+    def test_unread_messages(self):
+        "Only the unread messages are counted"
+        request = RequestFactory().get("/")
+        request.user = self.user
+        self.user.profile.last_login = self.since
+        start = get_counts(request)["messages"]
+
+        body = MessageBody.objects.create(author=self.user, subject="Hello", text="Hello")
+        for unread in (True, True, False):
+            Message.objects.create(user=self.user, body=body, unread=unread)
+        self.assertEqual(start + 2, get_counts(request)["messages"])
@@ -0,0 +1,100 @@
+import logging
+from unittest import skipUnless
+
+from django.db import connection, connections as databases, transaction
+from django.test import TestCase
+from haystack import connections
+from haystack.inputs import AutoQuery
+from haystack.query import SearchQuerySet
+
+from biostar.server import dbsearch
+from biostar.apps.posts.models import Post
+from biostar.apps.planet.models import Blog, BlogPost
+from biostar.apps.users.models import User
+from biostar.const import now
+
+logging.disable(logging.WARNING)
+
+
+class DatabaseSearchTest(TestCase):
+    def setUp(self):
+        self.info = connections.connections_info['default']
+        connections.connections_info['default'] = dict(ENGINE='biostar.server.dbsearch.DatabaseEngine')
+        connections.reload('default')
+
+        self.user = User.objects.create(email='test@test.com', password='...')
+        self.one = Post.objects.create(title="Aligning reads with bowtie", content="Lorem ipsum <b>dolor</b>",
+                                       author=self.user, type=Post.QUESTION)
+        self.two = Post.objects.create(title="Mapping RNA-seq data", content="Bowtie is not splice aware",
+                                       author=self.user, type=Post.QUESTION)
+        blog = Blog.objects.create(title="Blog", feed="http://example.com/feed", link="http://example.com")
+        self.entry = BlogPost.objects.create(blog=blog, title="Bowtie tutorial", content="Aligning", html="Aligning",
+                                             creation_date=now(), link="http://example.com/1")
+
+    def tearDown(self):
+        connections.connections_info['default'] = self.info
+        connections.reload('default')
+
+    def found(self, text, model=Post):
+        return sorted(int(row.pk) for row in SearchQuerySet().models(model).filter(content=AutoQuery(text)))
+
+    def test_parse(self):
+        self.assertEqual(dbsearch.parse('(bowtie AND "rna seq" AND NOT mapping)'),
+                         (["bowtie", "rna seq"], ["mapping"]))
+
+    def test_search(self):
+        "Saves update the index right away"
+        self.assertEqual(self.found("bowtie"), [self.one.id, self.two.id])
+        self.assertEqual(self.found("bowtie -mapping"), [self.one.id])
+        self.assertEqual(self.found('"rna-seq data"'), [self.two.id])
+        self.assertEqual(self.found("aligned"), [self.one.id])
+        self.assertEqual(self.found("bowtie", model=BlogPost), [self.entry.id])
+
+        # The title weighs more than the text.
+        rows = list(SearchQuerySet().models(Post).filter(content=AutoQuery("bowtie")).highlight())
+        self.assertEqual(int(rows[0].pk), self.one.id)
+        self.assertTrue('<span class="highlighted">Bowtie</span>' in rows[1].highlighted[0])
+
+        self.one.title = "Aligning reads with bwa"
+        self.one.save()
+        self.two.delete()
+        self.assertEqual(self.found("bowtie"), [])
+        self.assertEqual(self.found("bwa"), [self.one.id])
+
+    def test_transaction(self):
+        "The index entry is rolled back with the post"
+        try:
+            with transaction.atomic():
+                Post.objects.create(title="Calling variants", content="Lorem", author=self.user, type=Post.QUESTION)
+                self.assertEqual(len(self.found("variants")), 1)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.found("variants"), [])
+
+    def test_more_like_this(self):
+        other = Post.objects.create(title="Aligning long reads", content="Lorem", author=self.user, type=Post.QUESTION)
+        rows = [int(row.pk) for row in SearchQuerySet().models(Post).more_like_this(self.one)]
+        self.assertEqual(rows, [other.id, self.two.id])
+
+    @skipUnless(connection.vendor == 'postgresql', "runs on PostgreSQL only")
+    def test_postgresql(self):
+        "Servers before 9.6 match the words of a phrase in any order"
+        backend = connections['default'].get_backend()
+        database = databases['default']
+
+        # The migration has created the index of the vectors.
+        cursor = database.cursor()
+        cursor.execute("SELECT 1 FROM pg_class WHERE relname = 'search_doc_vector'")
+        self.assertTrue(cursor.fetchone())
+        self.assertEqual(self.found('"rna-seq data"'), [self.two.id])
+        self.assertEqual(self.found('"data rna-seq"'), [])
+
+        version = database.pg_version
+        database.__dict__['pg_version'] = 90300
+        try:
+            self.assertEqual(backend.tsquery, "plainto_tsquery")
+            self.assertEqual(self.found('"data rna-seq"'), [self.two.id])
+            self.assertEqual(self.found("bowtie -mapping"), [self.one.id])
+        finally:
+            database.__dict__['pg_version'] = version
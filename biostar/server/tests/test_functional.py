@@ -1,5 +1,6 @@
 from django.test import TestCase, SimpleTestCase
 from django.test import Client
+from django.test.utils import override_settings
 from django.core.urlresolvers import reverse
 from django.conf import settings
 from biostar.apps.users.models import User
@@ -44,6 +45,7 @@ POST_DATA = [
     (TITLE_2, CAT_2, TAG_VAL_2),
 ]
 
+@override_settings(NOTIFY_IN_BACKGROUND=False)
 class UserTest(TestCase):
     # The name of test users
 
@@ -0,0 +1,87 @@
+import logging, shutil, tempfile
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from haystack import connections
+from haystack.query import SearchQuerySet
+
+from biostar.server import indexing
+from biostar.apps.posts.models import Post
+from biostar.apps.users.models import User
+
+logging.disable(logging.WARNING)
+
+
+class IndexQueueTest(TestCase):
+    def setUp(self):
+        # Each test writes into its own search index.
+        self.temp = tempfile.mkdtemp()
+        self.info = connections.connections_info['default']
+        connections.connections_info['default'] = dict(self.info, PATH=self.temp)
+        connections.reload('default')
+
+        self.override = override_settings(INDEX_SPOOL_DIR=self.temp + "/spool")
+        self.override.enable()
+
+        self.user = User.objects.create(email='test@test.com', password='...')
+        self.post = Post.objects.create(title="Aligning reads with bowtie", content="Lorem ipsum",
+                                        author=self.user, type=Post.QUESTION)
+
+    def tearDown(self):
+        self.override.disable()
+        connections.connections_info['default'] = self.info
+        connections.reload('default')
+        shutil.rmtree(self.temp, ignore_errors=True)
+
+    def found(self, text):
+        return sorted(int(row.pk) for row in SearchQuerySet().models(Post).filter(content=text))
+
+    def test_drain(self):
+        "Only the changed documents are indexed"
+        self.assertEqual(self.found("bowtie"), [])
+        self.assertTrue(indexing.lag() > 0)
+
+        indexing.drain()
+        self.assertEqual(self.found("bowtie"), [self.post.id])
+        self.assertEqual(indexing.lag(), 0)
+        self.assertFalse(Post.objects.filter(changed=True).exists())
+
+        answer = Post.objects.create(content="Try hisat2", author=self.user, type=Post.ANSWER, parent=self.post)
+        comment = Post.objects.create(content="Or hisat2", author=self.user, type=Post.COMMENT, parent=answer)
+        self.post.title = "Aligning reads with bwa"
+        self.post.save()
+
+        indexing.drain()
+        self.assertEqual(self.found("hisat2"), [answer.id])
+        self.assertEqual(self.found("bowtie"), [])
+        self.assertEqual(self.found("bwa"), [self.post.id])
+
+        # Removed posts are queued by the delete signal.
+        comment.delete()
+        answer.delete()
+        self.assertEqual(indexing.drain(), 2)
+        self.assertEqual(self.found("hisat2"), [])
+
+        # An answer moved to a comment leaves the index.
+        answer = Post.objects.create(content="Try star", author=self.user, type=Post.ANSWER, parent=self.post)
+        indexing.drain()
+        self.assertEqual(self.found("star"), [answer.id])
+        Post.objects.filter(pk=answer.id).update(type=Post.COMMENT, changed=True)
+        indexing.drain()
+        self.assertEqual(self.found("star"), [])
+
+    @override_settings(INDEX_BATCH_SIZE=2)
+    def test_backlog(self):
+        "A drain stops at the limit and leaves the rest queued"
+        for step in range(4):
+            Post.objects.create(title="Calling variants %s" % step, content="Lorem ipsum", author=self.user,
+                                type=Post.QUESTION)
+
+        indexing.drain(limit=2)
+        self.assertEqual(indexing.stats()["left"], 3)
+        self.assertEqual(len(self.found("variants")), 1)
+        self.assertTrue(indexing.lag() > 0)
+
+        indexing.drain()
+        self.assertEqual(indexing.stats()["left"], 0)
+        self.assertEqual(len(self.found("variants")), 4)
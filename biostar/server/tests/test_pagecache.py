@@ -0,0 +1,151 @@
+import logging, shutil, tempfile
+
+from django.test import TestCase
+from django.test.client import Client
+from django.test.utils import override_settings
+from django.core.cache import get_cache
+from django.core.urlresolvers import reverse
+
+from biostar import const
+from biostar.server import pagecache, counters
+from biostar.apps.posts.models import Post, Vote
+from biostar.apps.users.models import User
+
+
+logging.disable(logging.WARNING)
+haystack_logger = logging.getLogger('haystack')
+
+
+@override_settings(PAGE_CACHE_ENABLED=True)
+class PageCacheTest(TestCase):
+    def setUp(self):
+        # Disable haystack logger (testing will raise errors on more_like_this field in templates).
+        haystack_logger.setLevel(logging.CRITICAL)
+
+        # The default cache is a dummy cache in development.
+        self.cache = pagecache.cache
+        pagecache.cache = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='pagecache-test')
+        pagecache.cache.clear()
+        pagecache.PAGE_STATS.clear()
+
+        self.spool = tempfile.mkdtemp()
+        self.override = self.settings(COUNTER_SPOOL_DIR=self.spool)
+        self.override.enable()
+
+        self.user = User.objects.create(email='test@test.com', password='...')
+        title = "Post 1, title needs to be sufficiently long"
+        self.post = Post.objects.create(title=title, content="Lorem ipsum", author=self.user, type=Post.QUESTION,
+                                        tag_val="rna-seq")
+        self.post.add_tags("rna-seq")
+
+    def tearDown(self):
+        pagecache.cache = self.cache
+        self.override.disable()
+        shutil.rmtree(self.spool)
+
+    def get(self, url, client=None, **params):
+        client = client or Client()
+        response = client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def stats(self, url, **params):
+        label = u"%s?sort=%s&limit=%s&page=%s" % (url, params.get("sort", const.POST_SORT_DEFAULT),
+                                                  params.get("limit", const.POST_LIMIT_DEFAULT), params.get("page", 1))
+        return pagecache.PAGE_STATS[(label, "hit")], pagecache.PAGE_STATS[(label, "miss")]
+
+    def test_list_pages(self):
+        "Anonymous list pages are served from the cache until a write purges them"
+        home, topic = reverse("home"), reverse("topic-list", kwargs=dict(topic="rna-seq"))
+
+        first = self.get(home).content
+        self.assertEqual(self.get(home).content, first)
+        self.get(home, sort="update", page="1")
+        self.assertEqual(self.stats(home), (2, 1))
+
+        self.get(topic)
+        self.get(topic)
+        self.assertEqual(self.stats(topic), (1, 1))
+
+        # Unknown parameters bypass the cache.
+        self.get(home, q="rna")
+        self.assertEqual(self.stats(home), (2, 1))
+
+        # A vote purges the lists that show the post.
+        Vote.objects.create(author=self.user, post=self.post, type=Vote.UP)
+        self.get(home)
+        self.get(topic)
+        self.assertEqual(self.stats(home), (2, 2))
+        self.assertEqual(self.stats(topic), (1, 2))
+
+    def test_thread_page(self):
+        "Answers purge the thread, each visitor gets its own token"
+        url = self.post.get_absolute_url()
+
+        one, two = Client(), Client()
+        content = self.get(url, client=one).content
+        self.assertEqual(self.stats(url), (0, 1))
+
+        other = self.get(url, client=two).content
+        self.assertEqual(self.stats(url), (1, 1))
+        token = two.cookies['csrftoken'].value
+        self.assertTrue(token in other)
+        self.assertTrue(one.cookies['csrftoken'].value not in other)
+
+        Post.objects.create(content="An answer", author=self.user, type=Post.ANSWER, parent=self.post)
+        content = self.get(url).content
+        self.assertEqual(self.stats(url), (1, 2))
+        self.assertTrue("An answer" in content)
+
+    def test_authenticated(self):
+        "Authenticated users are not served from the cache"
+        self.user.set_password("password")
+        self.user.save()
+        client = Client()
+        client.login(username=self.user.email, password="password")
+        self.get(reverse("home"), client=client)
+        self.assertEqual(self.stats(reverse("home")), (0, 0))
+
+    def test_multi_tag_topic(self):
+        "A page of several tags is purged by a change to any of them"
+        url = "/t/snp+rna-seq/"
+        self.get(url)
+        self.get(url)
+        self.assertEqual(self.stats(url), (1, 1))
+
+        Vote.objects.create(author=self.user, post=self.post, type=Vote.UP)
+        self.get(url)
+        self.assertEqual(self.stats(url), (1, 2))
+
+    def test_counts(self):
+        "Cached pages do not show the counts of the session that rendered them"
+        home, count = reverse("home"), "<sup><b>1</b></sup>"
+        counters.flush()
+        with self.settings(PAGE_CACHE_ENABLED=False):
+            self.assertTrue(count in self.get(home).content)
+        self.assertTrue(count not in self.get(home).content)
+
+    def test_render_home(self):
+        "The warmed home page is served to the next visitor"
+        home = reverse("home")
+        pagecache.render_home()
+        self.assertEqual(self.stats(home), (0, 1))
+
+        content = self.get(home).content
+        self.assertEqual(self.stats(home), (1, 1))
+        self.assertTrue(self.post.title in content)
+        self.assertTrue(pagecache.CSRF_SLOT not in content and "NOTPROVIDED" not in content)
+
+    def test_retag(self):
+        "A post that changes its tags is purged from the lists of its previous tags"
+        topic = reverse("topic-list", kwargs=dict(topic="rna-seq"))
+        self.get(topic)
+        self.get(topic)
+        self.assertEqual(self.stats(topic), (1, 1))
+
+        self.post.tag_val = "snp"
+        self.post.save()
+        self.post.add_tags("snp")
+        content = self.get(topic).content
+        self.assertEqual(self.stats(topic), (1, 2))
+        self.assertTrue(self.post.title not in content)
@@ -0,0 +1,73 @@
+import logging, shutil, tempfile
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.core.cache import get_cache
+from django.core.urlresolvers import reverse
+from haystack import connections
+
+from biostar.server import indexing, searchcache
+from biostar.apps.posts.models import Post
+from biostar.apps.users.models import User
+
+logging.disable(logging.WARNING)
+
+
+@override_settings(SEARCH_POPULAR_FLUSH=1)
+class SearchCacheTest(TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.info = connections.connections_info['default']
+        connections.connections_info['default'] = dict(self.info, PATH=self.temp)
+        connections.reload('default')
+
+        # The default cache is a dummy cache in development.
+        self.cache = searchcache.cache
+        searchcache.cache = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='searchcache-test')
+        searchcache.cache.clear()
+        self.shared = searchcache.shared
+        searchcache.shared = lambda: True
+
+        self.user = User.objects.create(email='test@test.com', password='...')
+        self.post = Post.objects.create(title="Aligning reads with bowtie", content="Lorem ipsum bowtie",
+                                        author=self.user, type=Post.QUESTION, status=Post.OPEN)
+        indexing.drain()
+
+    def tearDown(self):
+        searchcache.cache = self.cache
+        searchcache.shared = self.shared
+        connections.connections_info['default'] = self.info
+        connections.reload('default')
+        shutil.rmtree(self.temp, ignore_errors=True)
+
+    def test_cache(self):
+        "Results are cached under the normalized query until the index changes"
+        rows = searchcache.search("Bowtie")
+        self.assertEqual([row['pk'] for row in rows], [self.post.id])
+        self.assertEqual(rows[0]['url'], self.post.get_absolute_url())
+        self.assertEqual(rows[0]['title'], self.post.title)
+        self.assertTrue("bowtie" in rows[0]['context'].lower())
+
+        with self.assertNumQueries(0):
+            self.assertEqual(searchcache.search("  bowtie "), rows)
+
+        # The update warms the popular query.
+        other = Post.objects.create(title="Mapping with bowtie", content="Lorem ipsum", author=self.user,
+                                    type=Post.QUESTION, status=Post.OPEN)
+        indexing.drain()
+        with self.assertNumQueries(0):
+            rows = searchcache.search("bowtie")
+        self.assertEqual(sorted(row['pk'] for row in rows), sorted([self.post.id, other.id]))
+
+        # Index updates made elsewhere are seen from the generation of the index on disk.
+        third = Post.objects.create(title="Indexing with bowtie", content="Lorem ipsum", author=self.user,
+                                    type=Post.QUESTION, status=Post.OPEN)
+        indexing.index_posts([third.id])
+        rows = searchcache.search("bowtie")
+        self.assertEqual(len(rows), 3)
+
+    def test_search_page(self):
+        response = self.client.get(reverse("search-page"), dict(q="bowtie"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self.post.get_absolute_url() in response.content)
+        self.assertTrue("Aligning reads" in response.content)
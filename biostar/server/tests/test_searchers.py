@@ -0,0 +1,80 @@
+import logging, shutil, tempfile, threading
+
+from django.test import TestCase
+from haystack import connections
+from haystack.query import SearchQuerySet
+
+from biostar.server import indexing, searchers
+from biostar.apps.posts.models import Post
+from biostar.apps.users.models import User
+
+logging.disable(logging.WARNING)
+
+
+class SearcherPoolTest(TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.info = connections.connections_info['default']
+        connections.connections_info['default'] = dict(self.info, PATH=self.temp)
+        connections.reload('default')
+
+        for kind in searchers.SEARCH_LATENCY.values():
+            kind.clear()
+
+        self.user = User.objects.create(email='test@test.com', password='...')
+        Post.objects.create(title="Aligning reads with bowtie", content="Lorem ipsum", author=self.user,
+                            type=Post.QUESTION)
+        indexing.drain()
+
+    def tearDown(self):
+        connections.connections_info['default'] = self.info
+        connections.reload('default')
+        shutil.rmtree(self.temp, ignore_errors=True)
+
+    def search(self, text):
+        return len(SearchQuerySet().filter(content=text))
+
+    def counts(self):
+        return len(searchers.SEARCH_LATENCY["cold"]), len(searchers.SEARCH_LATENCY["warm"])
+
+    def test_reuse(self):
+        "Searchers are kept open until the index changes"
+        pool = connections['default'].get_backend().index.pool
+
+        self.assertEqual(self.search("bowtie"), 1)
+        self.assertEqual(self.counts(), (1, 0))
+        searcher = pool.idle[0]
+
+        self.assertEqual(self.search("bowtie"), 1)
+        self.assertEqual(self.counts(), (1, 1))
+        self.assertTrue(pool.idle[0] is searcher)
+
+        # A new generation opens a new searcher.
+        Post.objects.create(title="Mapping with bowtie", content="Lorem ipsum", author=self.user, type=Post.QUESTION)
+        indexing.drain()
+        self.assertEqual(self.search("bowtie"), 2)
+        self.assertEqual(self.counts(), (2, 1))
+        self.assertFalse(pool.idle[0] is searcher)
+
+        stats = searchers.latency_percentiles()
+        self.assertEqual(stats["cold"][0], 2)
+        self.assertEqual(stats["warm"][0], 1)
+
+    def test_threads(self):
+        "Concurrent searches use separate searchers"
+        found = []
+
+        def run():
+            for step in range(5):
+                found.append(self.search("bowtie"))
+
+        threads = [threading.Thread(target=run) for step in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(found, [1] * 20)
+        pool = connections['default'].get_backend().index.pool
+        self.assertTrue(0 < len(pool.idle) <= 4)
+        self.assertEqual(len(set(id(searcher) for searcher in pool.idle)), len(pool.idle))
@@ -0,0 +1,48 @@
+import logging
+
+from django.test import TestCase
+from django.core.cache import get_cache
+
+from biostar.server import context
+from biostar.apps.posts.models import Post, Vote
+from biostar.apps.users.models import User
+
+
+logging.disable(logging.WARNING)
+
+
+class SidebarCacheTest(TestCase):
+    def setUp(self):
+        # The default cache is a dummy cache in development.
+        self.cache = context.cache
+        context.cache = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='sidebar-test')
+        context.cache.clear()
+        context.SIDEBAR_STATS.clear()
+
+        self.user = User.objects.create(email='test@test.com', password='...')
+        title = "Post 1, title needs to be sufficiently long"
+        self.post = Post.objects.create(title=title, content="Lorem ipsum", author=self.user, type=Post.QUESTION)
+
+    def tearDown(self):
+        context.cache = self.cache
+
+    def test_no_queries_on_hit(self):
+        "A warm sidebar block does not touch the database"
+        for name in context.SIDEBAR_BLOCKS:
+            context.get_sidebar(name)
+
+        with self.assertNumQueries(0):
+            for name in context.SIDEBAR_BLOCKS:
+                context.get_sidebar(name)
+
+        self.assertEqual(context.SIDEBAR_STATS['miss'], 4)
+        self.assertEqual(context.SIDEBAR_STATS['hit'], 4)
+
+    def test_invalidation(self):
+        "New content moves the block to a new generation"
+        self.assertEqual(context.get_sidebar("votes"), [])
+        Vote.objects.create(author=self.user, post=self.post, type=Vote.UP)
+        rows = context.get_sidebar("votes")
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['post']['url'], self.post.get_absolute_url())
+        self.assertEqual(context.SIDEBAR_STATS['miss'], 2)
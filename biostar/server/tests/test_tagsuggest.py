@@ -0,0 +1,75 @@
+import json, logging, os, shutil, tempfile
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.core.urlresolvers import reverse
+
+from biostar.server import tagsuggest
+from biostar.apps.posts.models import Post, Tag
+from biostar.apps.users.models import User
+
+logging.disable(logging.WARNING)
+
+TEMP_DIR = tempfile.mkdtemp()
+
+
+@override_settings(TAG_SUGGEST_PATH=os.path.join(TEMP_DIR, "tags.json"), TAG_SUGGEST_CHECK=0)
+class TagSuggestTest(TestCase):
+    def setUp(self):
+        self.suggestions = tagsuggest.suggestions
+        tagsuggest.suggestions = tagsuggest.Suggestions()
+        self.user = User.objects.create(email='test@test.com', password='...')
+
+    def tearDown(self):
+        tagsuggest.suggestions = self.suggestions
+        for name in os.listdir(TEMP_DIR):
+            os.remove(os.path.join(TEMP_DIR, name))
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TagSuggestTest, cls).tearDownClass()
+        shutil.rmtree(TEMP_DIR, ignore_errors=True)
+
+    def ask(self, tags):
+        post = Post.objects.create(title="Lorem ipsum", content="Lorem ipsum", author=self.user, type=Post.QUESTION)
+        post.add_tags(tags)
+
+    def test_trie(self):
+        trie = tagsuggest.TagTrie(size=2)
+        for name, count in [("bowtie", 5), ("bwa", 10), ("bowtie2", 7), ("blast", 1)]:
+            trie.update(name, count)
+        self.assertEqual(trie.complete("b"), ["bwa", "bowtie2"])
+        self.assertEqual(trie.complete("bow"), ["bowtie2", "bowtie"])
+        self.assertEqual(trie.complete("x"), [])
+
+        # Lower counts and removed tags let other tags in.
+        trie.update("bwa", 2)
+        self.assertEqual(trie.complete("b"), ["bowtie2", "bowtie"])
+        trie.remove("bowtie2")
+        self.assertEqual(trie.complete("b"), ["bowtie", "bwa"])
+        self.assertEqual(trie.complete("bowtie2"), [])
+
+    def test_suggest(self):
+        self.ask("rna-seq,deseq2")
+        self.ask("rna-seq,deseq2,r")
+        self.ask("rna-seq,star")
+        self.ask("dna,diffbind")
+        self.ask("dna,diffbind")
+        self.ask("dna,diffbind")
+
+        # Before the batch job the tag counts come from the database.
+        self.assertEqual(tagsuggest.suggest("d"), ["diffbind", "dna", "deseq2"])
+
+        self.assertEqual(tagsuggest.build(), 6)
+        self.assertEqual(tagsuggest.suggest("d", chosen=["rna-seq"]), ["deseq2", "diffbind", "dna"])
+        self.assertEqual(tagsuggest.suggest("", chosen=["rna-seq", "deseq2"]), ["R", "star", "diffbind", "dna"])
+
+        # New posts are added to the previous counts.
+        self.ask("rna-seq,diffbind")
+        self.ask("rna-seq,diffbind")
+        self.assertEqual(tagsuggest.build(), 2)
+        self.assertEqual(tagsuggest.suggest("d", chosen=["rna-seq"]), ["diffbind", "deseq2", "dna"])
+        self.assertEqual(tagsuggest.build(full=True), 8)
+
+        data = json.loads(self.client.get(reverse("suggest-tags"), dict(q="d", chosen="rna-seq")).content)
+        self.assertEqual(data, ["diffbind", "deseq2", "dna"])
@@ -0,0 +1,125 @@
+import logging
+
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.contrib.auth.models import AnonymousUser
+from django.core.urlresolvers import reverse
+from django.core.cache import get_cache
+from django.template import Context
+
+from biostar.server import thread
+from biostar.server.templatetags import server_tags
+from biostar.apps.posts.models import Post, Vote
+from biostar.apps.users.models import User
+
+
+logging.disable(logging.WARNING)
+haystack_logger = logging.getLogger('haystack')
+
+
+class ThreadTest(TestCase):
+    def setUp(self):
+        # Disable haystack logger (testing will raise errors on more_like_this field in templates).
+        haystack_logger.setLevel(logging.CRITICAL)
+
+        self.user = User.objects.create(email='test@test.com', password='...')
+        self.other = User.objects.create(email='other@test.com', password='...')
+
+        title = "Post 1, title needs to be sufficiently long"
+        self.root = Post.objects.create(title=title, content="Lorem ipsum", author=self.user, type=Post.QUESTION)
+        self.root.add_tags("tagA, tagB")
+
+    def grow(self, size):
+        "Adds answers with comments by alternating authors until the thread has the given size"
+        parent = self.root
+        while Post.objects.filter(root=self.root).count() < size:
+            author = self.other if parent.author == self.user else self.user
+            if parent.type == Post.COMMENT:
+                parent = self.root
+            post_type = Post.ANSWER if parent == self.root else Post.COMMENT
+            parent = Post.objects.create(content="Reply", author=author, type=post_type, parent=parent)
+            Vote.objects.create(author=self.user, post=parent, type=Vote.UP)
+
+    def get_request(self, user):
+        request = RequestFactory().get(reverse('post-details', kwargs={'pk': self.root.id}))
+        request.user = user
+        return request
+
+    def test_query_count(self):
+        "The thread is assembled with a fixed number of queries"
+        self.grow(200)
+
+        with self.assertNumQueries(7):
+            post = thread.assemble(request=self.get_request(self.user), pk=self.root.id)
+            tags = list(post.tag_set.all())
+            for reply in post.answers + [c for group in post.tree.values() for c in group]:
+                reply.author.profile.location, reply.lastedit_user.name, reply.root.view_count
+
+        self.assertEqual(len(tags), 2)
+        self.assertEqual(len(post.answers) + sum(map(len, post.tree.values())), 199)
+
+        with self.assertNumQueries(5):
+            thread.assemble(request=self.get_request(AnonymousUser()), pk=self.root.id)
+
+
+class CommentRenderTest(TestCase):
+    def setUp(self):
+        # The default cache is a dummy cache in development.
+        self.cache = server_tags.cache
+        server_tags.cache = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='comments-test')
+        server_tags.cache.clear()
+
+        self.user = User.objects.create(email='test@test.com', password='...')
+        self.other = User.objects.create(email='other@test.com', password='...')
+
+        title = "Post 1, title needs to be sufficiently long"
+        self.root = Post.objects.create(title=title, content="Lorem ipsum", author=self.user, type=Post.QUESTION)
+        answer = Post.objects.create(content="Answer", author=self.other, type=Post.ANSWER, parent=self.root)
+        parent = answer
+        for step in range(4):
+            author = self.user if step % 2 else self.other
+            parent = Post.objects.create(content="Comment %s" % step, author=author, type=Post.COMMENT, parent=parent)
+        Vote.objects.create(author=self.user, post=parent, type=Vote.UP)
+        self.answer = answer
+
+    def tearDown(self):
+        server_tags.cache = self.cache
+
+    def render(self, user):
+        request = RequestFactory().get(reverse('post-details', kwargs={'pk': self.root.id}))
+        request.user = user
+        post = thread.assemble(request=request, pk=self.root.id)
+        return server_tags.render_comments(request, self.answer, post.tree)
+
+    def reference(self, user):
+        "Renders the comments one template at a time"
+        request = RequestFactory().get(reverse('post-details', kwargs={'pk': self.root.id}))
+        request.user = user
+        post = thread.assemble(request=request, pk=self.root.id)
+
+        def traverse(node):
+            data = ['<div class="indent">', server_tags.COMMENT_BODY.render(Context({"post": node, "slot": None}))]
+            data.extend(traverse(child) for child in post.tree.get(node.id, []))
+            data.append("</div>")
+            return '\n'.join(data)
+
+        return '\n'.join(traverse(node) for node in post.tree[self.answer.id])
+
+    def test_cached_render(self):
+        "Cached fragments give the same page as rendering each comment"
+        for user in (self.user, self.other, AnonymousUser()):
+            self.maxDiff = None
+            self.assertEqual(self.render(user), self.reference(user))
+
+        # A warm render does not touch the template.
+        expected = self.reference(self.user)
+        body, server_tags.COMMENT_BODY = server_tags.COMMENT_BODY, None
+        try:
+            self.assertEqual(self.render(self.user), expected)
+        finally:
+            server_tags.COMMENT_BODY = body
+
+        edit = reverse('post-edit', kwargs={'pk': self.answer.id + 1})
+        self.assertTrue(edit in self.render(self.other))
+        self.assertTrue(edit not in self.render(AnonymousUser()))
+        self.assertEqual(self.render(self.user).count('vote mark on'), 1)
@@ -0,0 +1,117 @@
+import json, logging, os, shutil, tempfile
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.core.urlresolvers import reverse
+from django.db import connection
+from haystack import connections
+
+from biostar.server import titles, indexing
+from biostar.apps.posts.models import Post
+from biostar.apps.users.models import User
+
+logging.disable(logging.WARNING)
+
+TEMP_DIR = tempfile.mkdtemp()
+
+
+@override_settings(TITLE_INDEX=os.path.join(TEMP_DIR, "titles.db"))
+class TitleIndexTest(TestCase):
+    def setUp(self):
+        # The index file outlives the database rows of each test.
+        titles.rebuild([])
+
+        # The titles are refreshed by the drain of the search index.
+        self.temp = tempfile.mkdtemp()
+        self.info = connections.connections_info['default']
+        connections.connections_info['default'] = dict(self.info, PATH=self.temp + "/index")
+        connections.reload('default')
+        self.override = override_settings(INDEX_SPOOL_DIR=self.temp + "/spool")
+        self.override.enable()
+
+        self.user = User.objects.create(email='test@test.com', password='...')
+        self.one = Post.objects.create(title="Aligning RNA-seq reads with bowtie", content="Lorem ipsum",
+                                       author=self.user, type=Post.QUESTION)
+        self.two = Post.objects.create(title="Calling variants from aligned reads", content="Lorem ipsum",
+                                       author=self.user, type=Post.TUTORIAL)
+        indexing.drain()
+
+    def tearDown(self):
+        self.override.disable()
+        connections.connections_info['default'] = self.info
+        connections.reload('default')
+        shutil.rmtree(self.temp, ignore_errors=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TitleIndexTest, cls).tearDownClass()
+        shutil.rmtree(TEMP_DIR, ignore_errors=True)
+
+    def ids(self, text, **kwargs):
+        return [row['id'] for row in titles.search(text, **kwargs)]
+
+    def test_prefix_search(self):
+        "Each word of the query matches a word prefix of the title"
+        self.assertEqual(set(self.ids("alig")), set([self.one.id, self.two.id]))
+        self.assertEqual(self.ids("ali bow"), [self.one.id])
+        self.assertEqual(self.ids("READS var"), [self.two.id])
+        self.assertEqual(self.ids("alig", types=[Post.QUESTION]), [self.one.id])
+        self.assertEqual(self.ids("eads"), [])
+        self.assertEqual(self.ids(""), [])
+
+        # Longer words than the stored prefixes are checked on the title.
+        self.assertEqual(self.ids("calling variants"), [self.two.id])
+        self.assertEqual(self.ids("variantsx"), [])
+
+        # Newer titles that share the stored prefix but not the word do not take up the limit.
+        three = Post.objects.create(title="Assembling a transcriptome", content="Lorem ipsum", author=self.user,
+                                    type=Post.QUESTION)
+        for step in range(3):
+            Post.objects.create(title="Transcriptional regulation %s" % step, content="Lorem ipsum",
+                                author=self.user, type=Post.QUESTION)
+        indexing.drain()
+        self.assertEqual(self.ids("transcriptome", limit=1), [three.id])
+
+        # Lookups do not touch the database.
+        with self.assertNumQueries(0):
+            row = titles.search("bowtie")[0]
+        self.assertEqual(row['url'], self.one.get_absolute_url())
+        self.assertEqual(row['author'], self.user.name)
+
+    def test_updates(self):
+        "The index follows edits and removals"
+        self.one.title = "Mapping single cell data"
+        self.one.save()
+
+        # The saves wait for the drain.
+        self.assertEqual(self.ids("sing"), [])
+        indexing.drain()
+        self.assertEqual(self.ids("ali"), [self.two.id])
+        self.assertEqual(self.ids("sing"), [self.one.id])
+
+        self.one.status = Post.DELETED
+        self.one.save()
+        indexing.drain()
+        self.assertEqual(self.ids("sing"), [])
+
+        Post.objects.create(content="An answer", author=self.user, type=Post.ANSWER, parent=self.two)
+        self.two.delete()
+        indexing.drain()
+        self.assertEqual(self.ids("ali"), [])
+
+    def test_search_view(self):
+        "The autocomplete view returns highlighted titles"
+        response = self.client.get(reverse("search-title"), dict(q="bow"))
+        items = json.loads(response.content)["items"]
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0]["url"], self.one.get_absolute_url())
+        self.assertTrue("<b>bowtie</b>" in items[0]["text"])
+
+    def test_rebuild(self):
+        "The index is rebuilt along with the search index"
+        from biostar.server.management.commands import build_index
+
+        titles.rebuild([])
+        self.assertEqual(self.ids("ali"), [])
+        build_index.build(workers=0)
+        self.assertEqual(set(self.ids("ali")), set([self.one.id, self.two.id]))
@@ -0,0 +1,60 @@
+import logging, shutil, tempfile
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from biostar import awards
+from biostar.celery import app
+from biostar.apps.badges.models import Award
+from biostar.apps.users.models import User
+from biostar.server.management.commands import user_crawl
+
+logging.disable(logging.WARNING)
+
+
+class UserCrawlTest(TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.override = override_settings(USER_CRAWL_DIR=self.temp + "/crawl", AWARD_SPOOL_DIR=self.temp + "/spool")
+        self.override.enable()
+
+        awards.init_awards()
+        for step in range(10):
+            user = User.objects.create(email="user%s@site.com" % step)
+            user.profile.info = "A" * 100
+            user.profile.save()
+        self.ids = sorted(User.objects.values_list("id", flat=True))
+
+        # The award tasks of the crawler run right away.
+        self.eager = app.conf.CELERY_ALWAYS_EAGER
+        app.conf.CELERY_ALWAYS_EAGER = True
+
+    def tearDown(self):
+        app.conf.CELERY_ALWAYS_EAGER = self.eager
+        self.override.disable()
+        shutil.rmtree(self.temp, ignore_errors=True)
+
+    def test_crawl(self):
+        "Each run continues where the previous one stopped, all users are covered in a cycle."
+        eq = self.assertEqual
+
+        ranges = user_crawl.bounds(2)
+        eq(self.ids[0], ranges[0][0])
+        eq(self.ids[-1], ranges[1][1])
+        eq(ranges[0][1] + 1, ranges[1][0])
+
+        crawled = lambda: sorted(Award.objects.values_list("user_id", flat=True))
+
+        # The partitions of five users are crawled three users at a time.
+        eq(6, user_crawl.crawl_awards(2, limit=3, batch=2))
+        eq(self.ids[:3] + self.ids[5:8], crawled())
+        eq(self.ids[2], user_crawl.load_checkpoint(0, 2))
+
+        eq(4, user_crawl.crawl_awards(2, limit=3, batch=2))
+        eq(self.ids, crawled())
+        eq(None, user_crawl.load_checkpoint(0, 2))
+
+        # The next cycle starts over and finds nothing new.
+        eq(3, user_crawl.crawl_awards(2, selected=[1], limit=3))
+        eq(self.ids, crawled())
+        eq(self.ids[7], user_crawl.load_checkpoint(1, 2))
@@ -0,0 +1,86 @@
+"""
+Assembles a thread for display.
+
+The whole thread is built once per request from a fixed number of queries:
+the root, the posts in the thread, the votes of the user, the subscription,
+the related and the similar questions. The number of queries does not depend on the size of the thread.
+"""
+from django.http import Http404
+from biostar.apps.posts.models import Post, Vote, Subscription, RelatedPosts, SimilarPost
+from biostar.apps.posts.auth import post_permissions
+from biostar.const import OrderedDict
+
+
+def assemble(request, pk):
+    "Returns the post decorated with everything needed to render the thread"
+    user = request.user
+
+    try:
+        obj = Post.objects.select_related("root", "author__profile", "lastedit_user").prefetch_related("tag_set").get(pk=pk)
+    except Post.DoesNotExist:
+        raise Http404
+
+    # Update the post views.
+    Post.update_post_views(obj, request=request)
+
+    # Adds the permissions
+    obj = post_permissions(request=request, post=obj)
+
+    # Bail out if not at top level.
+    if not obj.is_toplevel:
+        return obj
+
+    # This will be piggybacked on the main object.
+    obj.sub = Subscription.get_sub(post=obj, user=user)
+
+    # Populate the object to build a tree that contains all posts in the thread.
+    # Answers sorted before comments.
+    thread = [post_permissions(request=request, post=post) for post in Post.objects.get_thread(obj, user)]
+
+    # Do a little preprocessing.
+    answers = [p for p in thread if p.type == Post.ANSWER]
+
+    tree = OrderedDict()
+    for post in thread:
+
+        if post.type == Post.COMMENT:
+            tree.setdefault(post.parent_id, []).append(post)
+
+    store = {Vote.UP: set(), Vote.BOOKMARK: set()}
+
+    if user.is_authenticated():
+        pids = [p.id for p in thread]
+        votes = Vote.objects.filter(post_id__in=pids, author=user).values_list("post_id", "type")
+
+        for post_id, vote_type in votes:
+            store.setdefault(vote_type, set()).add(post_id)
+
+    # Shortcuts to each storage.
+    bookmarks = store[Vote.BOOKMARK]
+    upvotes = store[Vote.UP]
+
+    # Can the current user accept answers
+    can_accept = obj.author == user
+
+    def decorate(post):
+        post.has_bookmark = post.id in bookmarks
+        post.has_upvote = post.id in upvotes
+        post.can_accept = can_accept or post.has_accepted
+
+    # Add attributes by mutating the objects
+    map(decorate, thread + [obj])
+
+    # Additional attributes used during rendering
+    obj.tree = tree
+    obj.answers = answers
+
+    # Related questions are only maintained for questions.
+    if obj.type == Post.QUESTION:
+        obj.related_posts = list(RelatedPosts.objects.filter(post=obj).select_related("similar_post"))
+        similar = SimilarPost.objects.filter(post=obj).exclude(similar__status=Post.DELETED)
+        obj.similar_questions = [row.similar for row in similar.select_related("similar").order_by("-score")]
+    else:
+        obj.related_posts = []
+        obj.similar_questions = []
+
+    return obj
@@ -0,0 +1,164 @@
+"""
+Title autocomplete index.
+
+The titles of the top level posts are kept in a dedicated SQLite file next to the search index.
+Each post stores its id, type, title, url and author. Every word of the title is indexed by its
+prefixes (edge n-grams) together with the rank of the post. A lookup walks the prefix of the
+longest query word in rank order and checks the other words with primary key lookups.
+Words longer than the stored prefixes are checked on the title within the same walk.
+Queries never touch the main database.
+
+The index follows the search index: the drain of biostar.server.indexing refreshes
+the titles of the posts it indexes, build_index rebuilds it.
+"""
+from __future__ import print_function, unicode_literals, absolute_import, division
+import calendar, logging, re, sqlite3, threading
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, type INTEGER, rank REAL, title TEXT, url TEXT, author TEXT)",
+    "CREATE TABLE IF NOT EXISTS grams (gram TEXT, rank REAL, id INTEGER, PRIMARY KEY (gram, rank, id)) WITHOUT ROWID",
+]
+
+# Connections are opened for each thread and index path.
+local = threading.local()
+
+
+def connect(path=None):
+    "Returns the connection to the index, creates the index if necessary"
+    path = path or settings.TITLE_INDEX
+    conns = local.__dict__.setdefault("conns", {})
+    if path not in conns:
+        conn = sqlite3.connect(path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.create_function("has_prefixes", 2, has_prefixes)
+        for sql in SCHEMA:
+            conn.execute(sql)
+        conns[path] = conn
+    return conns[path]
+
+
+def words(text):
+    return WORD_RE.findall(text.lower())
+
+
+def has_prefixes(title, prefixes):
+    "True when each of the space separated prefixes starts a word of the title"
+    found = words(title)
+    return all(any(word.startswith(prefix) for word in found) for prefix in prefixes.split())
+
+
+def grams(title):
+    "The prefixes of each word in the title"
+    found = set()
+    for word in words(title):
+        for size in range(1, min(len(word), settings.TITLE_INDEX_MAX_GRAM) + 1):
+            found.add(word[:size])
+    return found
+
+
+def rank_of(post):
+    "Recently active posts come first"
+    return calendar.timegm(post.lastedit_date.utctimetuple())
+
+
+def indexed(post):
+    from biostar.apps.posts.models import Post
+    return post.is_toplevel and post.status != Post.DELETED
+
+
+def delete_doc(conn, pk):
+    row = conn.execute("SELECT rank, title FROM docs WHERE id=?", (pk,)).fetchone()
+    if row:
+        rank, title = row
+        conn.executemany("DELETE FROM grams WHERE gram=? AND rank=? AND id=?",
+                         [(gram, rank, pk) for gram in grams(title)])
+        conn.execute("DELETE FROM docs WHERE id=?", (pk,))
+
+
+def add_doc(conn, pk, post_type, rank, title, url, author):
+    conn.execute("INSERT INTO docs VALUES (?, ?, ?, ?, ?, ?)", (pk, post_type, rank, title, url, author))
+    conn.executemany("INSERT INTO grams VALUES (?, ?, ?)", [(gram, rank, pk) for gram in grams(title)])
+
+
+def doc_of(post):
+    return (post.id, post.type, rank_of(post), post.title, post.get_absolute_url(), post.author.name)
+
+
+def refresh(posts, ids, path=None):
+    "Replaces the posts in the index and removes the other ids. Posts that should not be listed are removed."
+    conn = connect(path)
+    with conn:
+        for pk in ids:
+            delete_doc(conn, pk)
+        for post in posts:
+            if indexed(post):
+                add_doc(conn, *doc_of(post))
+
+
+def rebuild(posts, path=None, batch_size=1000):
+    "Replaces the whole index with the posts. Returns the number of indexed posts."
+    conn = connect(path)
+    with conn:
+        conn.execute("DELETE FROM grams")
+        conn.execute("DELETE FROM docs")
+
+    count, batch = 0, []
+    for post in posts:
+        if indexed(post):
+            batch.append(doc_of(post))
+        if len(batch) >= batch_size:
+            count += add_docs(conn, batch)
+            batch = []
+    count += add_docs(conn, batch)
+    return count
+
+
+def add_docs(conn, docs):
+    with conn:
+        conn.executemany("INSERT INTO docs VALUES (?, ?, ?, ?, ?, ?)", docs)
+        conn.executemany("INSERT INTO grams VALUES (?, ?, ?)",
+                         [(gram, doc[2], doc[0]) for doc in docs for gram in grams(doc[3])])
+    return len(docs)
+
+
+def search(text, limit=20, types=None, path=None):
+    """
+    Returns the posts whose title has a word starting with each word of the text.
+    The results are dictionaries with the id, type, title, url and author.
+    """
+    query = words(text)
+    if not query:
+        return []
+
+    size = settings.TITLE_INDEX_MAX_GRAM
+    prefixes = sorted(set(word[:size] for word in query), key=len, reverse=True)
+
+    # The longest prefix selects the fewest rows, the others are looked up.
+    sql = ["SELECT d.id, d.type, d.title, d.url, d.author FROM grams g JOIN docs d ON d.id = g.id WHERE g.gram = ?"]
+    params = [prefixes[0]]
+    for prefix in prefixes[1:]:
+        sql.append("AND EXISTS (SELECT 1 FROM grams x WHERE x.gram = ? AND x.rank = g.rank AND x.id = g.id)")
+        params.append(prefix)
+    if types:
+        sql.append("AND d.type IN (%s)" % ",".join("?" * len(types)))
+        params.extend(types)
+
+    # Words longer than the prefixes are checked on the title before the limit applies.
+    longer = [word for word in query if len(word) > size]
+    if longer:
+        sql.append("AND has_prefixes(d.title, ?)")
+        params.append(" ".join(longer))
+
+    sql.append("ORDER BY g.rank DESC LIMIT ?")
+    params.append(limit)
+
+    results = []
+    for pk, post_type, title, url, author in connect(path).execute(" ".join(sql), params):
+        results.append(dict(id=pk, type=post_type, title=title, url=url, author=author))
+    return results
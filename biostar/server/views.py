@@ -9,12 +9,10 @@ from biostar.apps.users.models import User
 from biostar.apps.posts.models import Post, Vote, Tag, Subscription, ReplyToken, RelatedPosts
 from biostar.apps.posts.views import NewPost, NewAnswer
 from biostar.apps.badges.models import Badge, Award
-from biostar.apps.posts.auth import post_permissions
 from biostar.apps.util import html
 
 from django.contrib import messages
 from datetime import datetime, timedelta
-from biostar.const import OrderedDict
 from biostar import const
 from braces.views import LoginRequiredMixin, JSONResponseMixin
 from django import shortcuts
@@ -24,7 +22,7 @@ from django.core.paginator import Paginator
 import logging
 from django.contrib.flatpages.models import FlatPage
 from haystack.query import SearchQuerySet
-from . import moderate
+from . import moderate, pagecache, thread
 from django.http import Http404
 import markdown, pyzmail
 from biostar.apps.util.email_reply_parser import EmailReplyParser
@@ -147,7 +145,7 @@ def reset_counts(request, label):
         request.session[settings.SESSION_KEY] = counts
 
 
-class PostList(BaseListMixin):
+class PostList(pagecache.PageCacheMixin, BaseListMixin):
     """
     This is the base class for any view that produces a list of posts.
     """
@@ -168,6 +166,17 @@ class PostList(BaseListMixin):
         else:
             return _("Latest Posts")
 
+    def page_scopes(self):
+        topic = Tag.fixcase(self.kwargs.get("topic", ""))
+        # Pages of the user are not cached.
+        if topic in AUTH_TOPIC:
+            return []
+        if not topic or topic in (LATEST, UNANSWERED) or topic in POST_TYPES:
+            return [pagecache.topic_scope(topic)]
+        # A tag search changes with each of its tags.
+        include, exclude = Post.objects.parse_tags(topic)
+        return [pagecache.topic_scope(name) for name in sorted(set(include + exclude))]
+
     def get_queryset(self):
         self.topic = self.kwargs.get("topic", "")
 
@@ -367,7 +376,7 @@ class EditUser(EditUser):
     template_name = "user_edit.html"
 
 
-class PostDetails(DetailView):
+class PostDetails(pagecache.PageCacheMixin, DetailView):
     """
     Shows a thread, top level post and all related content.
     """
@@ -385,81 +394,29 @@ class PostDetails(DetailView):
 
         return self.render_to_response(context)
 
-    def get_object(self):
-        user = self.request.user
-
-        obj = super(PostDetails, self).get_object()
-
-        # Update the post views.
-        Post.update_post_views(obj, request=self.request)
-
-        # Adds the permissions
-        obj = post_permissions(request=self.request, post=obj)
-
-        # This will be piggybacked on the main object.
-        obj.sub = Subscription.get_sub(post=obj, user=user)
-
-        # Bail out if not at top level.
-        if not obj.is_toplevel:
-            return obj
-
-        # Populate the object to build a tree that contains all posts in the thread.
-        # Answers sorted before comments.
-        thread = [post_permissions(request=self.request, post=post) for post in Post.objects.get_thread(obj, user)]
-
-        # Do a little preprocessing.
-        answers = [p for p in thread if p.type == Post.ANSWER]
-
-        tree = OrderedDict()
-        for post in thread:
-
-            if post.type == Post.COMMENT:
-                tree.setdefault(post.parent_id, []).append(post)
+    def page_scopes(self):
+        return [pagecache.post_scope(self.kwargs["pk"])]
 
-        store = {Vote.UP: set(), Vote.BOOKMARK: set()}
+    def page_hit(self, request):
+        # The view is counted even if the page comes from the cache.
+        Post.update_post_views(Post(pk=self.kwargs["pk"]), request=request)
 
-        if user.is_authenticated():
-            pids = [p.id for p in thread]
-            votes = Vote.objects.filter(post_id__in=pids, author=user).values_list("post_id", "type")
-
-            for post_id, vote_type in votes:
-                store.setdefault(vote_type, set()).add(post_id)
-
-        # Shortcuts to each storage.
-        bookmarks = store[Vote.BOOKMARK]
-        upvotes = store[Vote.UP]
-
-        # Can the current user accept answers
-        can_accept = obj.author == user
-
-        def decorate(post):
-            post.has_bookmark = post.id in bookmarks
-            post.has_upvote = post.id in upvotes
-            post.can_accept = can_accept or post.has_accepted
-
-        # Add attributes by mutating the objects
-        map(decorate, thread + [obj])
-
-        # Additional attributes used during rendering
-        obj.tree = tree
-        obj.answers = answers
-
-        # Add the more like this field
-        post = super(PostDetails, self).get_object()
-
-        return obj
+    def get_object(self):
+        # The thread is assembled only once per request.
+        if not hasattr(self, "thread"):
+            self.thread = thread.assemble(request=self.request, pk=self.kwargs["pk"])
+        return self.thread
 
     def get_context_data(self, **kwargs):
         context = super(PostDetails, self).get_context_data(**kwargs)
         context['request'] = self.request
 
         # Pass related questions into template. TODO: Add backward relation.
-        if self.get_object().type == 0:
-            related_questions = RelatedPosts.objects.filter(post=self.get_object())
-            context['easier_questions'] = [post for post in related_questions if post.type == 0]
-            context['harder_questions'] = [post for post in related_questions if post.type == 1]
-            context['common_questions'] = [post for post in related_questions if post.type == 2]
-            context['special_questions'] = [post for post in related_questions if post.type == 3]
+        related_questions = getattr(self.object, "related_posts", [])
+        context['easier_questions'] = [post for post in related_questions if post.type == RelatedPosts.EASIER]
+        context['harder_questions'] = [post for post in related_questions if post.type == RelatedPosts.HARDER]
+        context['common_questions'] = [post for post in related_questions if post.type == RelatedPosts.COMMON]
+        context['special_questions'] = [post for post in related_questions if post.type == RelatedPosts.SPECIAL]
 
         return context
 
@@ -478,14 +435,10 @@ class ChangeSub(LoginRequiredMixin, View):
         user = self.request.user
         post = Post.objects.get(pk=pk)
 
-        subs = Subscription.objects.filter(post=post, user=user)
         if new_type is None:
-            subs.delete()
+            Subscription.objects.filter(post=post, user=user).delete()
         else:
-            if subs:
-                subs.update(type=new_type)
-            else:
-                Subscription.objects.create(post=post, user=user, type=new_type)
+            Subscription.objects.subscribe(post, [user.id], new_type, update=True)
 
         return shortcuts.redirect(post.get_absolute_url())
 
@@ -89,6 +89,16 @@ FLATPAGE_IMPORT_DIR = abspath(HOME_DIR, "import", "pages")
 # Default search index location.
 WHOOSH_INDEX = abspath(LIVE_DIR, "whoosh_index")
 
+# The title autocomplete index and the longest word prefix that it stores.
+TITLE_INDEX = abspath(LIVE_DIR, "title_index.db")
+TITLE_INDEX_MAX_GRAM = 10
+
+# The tag counts and co-occurring tags published by the tag suggestion job.
+TAG_SUGGEST_PATH = abspath(LIVE_DIR, "tag_suggest.json")
+
+# The user crawler keeps the last crawled id of each partition here.
+USER_CRAWL_DIR = abspath(LIVE_DIR, "crawl")
+
 # These settings create an admin user.
 # The default password is the SECRET_KEY.
 ADMIN_NAME = get_env("BIOSTAR_ADMIN_NAME")
@@ -312,13 +322,30 @@ DEBUG_TOOLBAR_PATCH_SETTINGS = False
 
 # Default search is provided via Whoosh
 
+# The search index may also live in the site database (SQLite FTS5 or PostgreSQL).
+# Set the ENGINE to 'biostar.server.dbsearch.DatabaseEngine' for that, the PATH is not used then.
 HAYSTACK_CONNECTIONS = {
     'default': {
-        'ENGINE': 'haystack.backends.whoosh_backend.WhooshEngine',
+        'ENGINE': 'biostar.server.searchers.PooledWhooshEngine',
         'PATH': WHOOSH_INDEX,
     },
 }
 
+# The number of idle searchers that each process keeps open.
+SEARCH_POOL_SIZE = 4
+
+# Search results are cached for this many seconds or until the index changes.
+SEARCH_CACHE_TIMEOUT = 5 * 60
+
+# The number of results that are kept for a query.
+SEARCH_CACHE_RESULTS = 50
+
+# The most popular queries are searched again after each index update.
+SEARCH_WARM_QUERIES = 20
+
+# Each process adds up this many searches before merging them into the popular queries.
+SEARCH_POPULAR_FLUSH = 20
+
 TEMPLATE_CONTEXT_PROCESSORS = (
     # Django specific context processors.
     "django.core.context_processors.debug",
@@ -420,9 +447,129 @@ RECENT_VOTE_COUNT = 7
 RECENT_USER_COUNT = 7
 RECENT_POST_COUNT = 12
 
+# How long the sidebar blocks stay cached. Writes invalidate them sooner.
+SIDEBAR_CACHE_TIMEOUT = 10 * 60
+
+# Notifications for new posts are sent by a celery task.
+# When set to False they are sent while the post is saved.
+NOTIFY_IN_BACKGROUND = True
+
+# The number of subscribers that are notified in one step.
+NOTIFY_CHUNK_SIZE = 500
+
+# Notifications that made no progress for this many minutes are restarted.
+NOTIFY_RESUME_MINUTES = 10
+
+# How long a rendered comment stays cached. Edits and votes invalidate it sooner.
+# This also limits how stale the relative dates shown on comments may get.
+COMMENT_CACHE_TIMEOUT = 5 * 60
+
+# Serve post lists and threads to anonymous users from a page cache.
+# New posts, edits, votes and moderation purge the affected pages.
+# The purges reach other processes only through a shared cache such as memcached.
+PAGE_CACHE_ENABLED = False
+
+# How long a cached page is kept when nothing purges it.
+PAGE_CACHE_TIMEOUT = 10 * 60
+
+# Render the first home page again after it has been purged.
+# Purges within the delay (in seconds) share one render.
+PAGE_CACHE_WARM_HOME = False
+PAGE_CACHE_WARM_DELAY = 5
+
 # Time between two accesses from the same IP to qualify as a different view.
 POST_VIEW_MINUTES = 5
 
+# The minutes counted by the traffic estimate.
+TRAFFIC_MINUTES = 60
+
+# The traffic estimate keeps 2 ** TRAFFIC_PRECISION registers per minute, the error is about 3% at 10.
+TRAFFIC_PRECISION = 10
+
+# Accepted post views are spooled here until the flush_views command stores them.
+POST_VIEW_SPOOL_DIR = abspath(LIVE_DIR, "spool")
+
+# Seconds after which the spool files of an unfinished view flush are taken over.
+POST_VIEW_FLUSH_TIMEOUT = 3600
+
+# Deleted posts and blog posts wait here for the search index.
+INDEX_SPOOL_DIR = abspath(LIVE_DIR, "spool", "index")
+
+# Seconds between a change and the indexing, the changes within the delay are indexed together.
+INDEX_QUEUE_DELAY = 5
+
+# The number of documents written to the index in one step.
+INDEX_BATCH_SIZE = 100
+
+# The most documents indexed by one drain, a larger backlog continues in the next drain.
+INDEX_QUEUE_LIMIT = 2000
+
+# The most days returned by one statistics range request.
+STATS_RANGE_LIMIT = 400
+
+# The user crawler splits the user ids into this many ranges, each range is crawled on its own.
+USER_CRAWL_PARTITIONS = 4
+
+# Users crawled in each partition by one run, the crawl continues with the next run.
+USER_CRAWL_LIMIT = 5000
+
+# User ids sent in one award task.
+USER_CRAWL_BATCH = 500
+
+# Changed user counters wait here for the award checks.
+AWARD_SPOOL_DIR = abspath(LIVE_DIR, "spool", "awards")
+
+# Seconds between a counter change and the award check, the changes within the delay are checked together.
+AWARD_CHECK_DELAY = 60
+
+# Seconds after which the lock and the spool files of an unfinished award check are taken over.
+AWARD_CHECK_TIMEOUT = 3600
+
+# The number of similar questions stored for each question.
+SIMILAR_POSTS_LIMIT = 10
+
+# Questions less similar than this are not listed.
+SIMILAR_MIN_SCORE = 0.1
+
+# The words of the questions are hashed into this many features.
+SIMILAR_FEATURES = 2 ** 20
+
+# Words found in a larger fraction of the questions are ignored.
+SIMILAR_MAX_DF = 0.1
+
+# Questions compared with all others in one matrix product.
+SIMILAR_CHUNK_SIZE = 500
+
+# Tag suggestions returned for a partial tag name.
+TAG_SUGGEST_LIMIT = 10
+
+# Completions kept at each node of the tag trie, co-occurring tags are ranked among these.
+TAG_SUGGEST_CANDIDATES = 50
+
+# Co-occurring tags kept for each tag.
+TAG_SUGGEST_RELATED = 20
+
+# Seconds between checks for newly published tag suggestion counts.
+TAG_SUGGEST_CHECK = 10
+
+# Seconds to keep the expansions of tags into their descendants, saving a tag starts a new version.
+TAG_TREE_TIMEOUT = 24 * 3600
+
+# Seconds between rebuilds of the in-memory tag index, its change events are kept twice as long.
+TAG_INDEX_REBUILD = 3600
+
+# Seconds of tag change events that each tag search reads again, finds the events of late commits.
+TAG_INDEX_SYNC_WINDOW = 120
+
+# Tag searches with at most this many posts load their page with one lookup by id.
+TAG_INDEX_IN_LIMIT = 500
+
+# Larger tag searches read the ids of the sorted posts in chunks of this size.
+TAG_INDEX_SCAN_CHUNK = 1000
+
+# Sorted ids read before a tag search loads the sort fields of all its posts by id instead.
+TAG_INDEX_SCAN_LIMIT = 20000
+
 # Default  expiration in seconds.
 CACHE_TIMEOUT = 60
 
@@ -446,9 +593,22 @@ CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.dummy.DummyCache' if DEBUG else 'django.core.cache.backends.locmem.LocMemCache',
         'LOCATION': 'unique-snowflake'
-    }
+    },
+    # Keeps the oEmbed lookups across restarts.
+    'embeds': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': abspath(LIVE_DIR, "embeds"),
+    },
 }
 
+# The function that performs the oEmbed lookups and its timeout in seconds.
+OEMBED_FETCHER = 'biostar.apps.util.html.fetch_oembed'
+OEMBED_TIMEOUT = 3
+
+# How long the oEmbed results are kept. Failed lookups are retried sooner.
+OEMBED_CACHE_TIMEOUT = 30 * 24 * 3600
+OEMBED_RETRY_TIMEOUT = 60 * 60
+
 # The celery configuration file
 CELERY_CONFIG = 'biostar.celeryconfig'
 
@@ -468,6 +628,15 @@ EXTERNAL_SESSION_FIELDS = "title tag_val content".split()
 # How far to look for posts for anonymous users.
 COUNT_INTERVAL_WEEKS = 10000
 
+# How long the activity counters remember events.
+COUNTER_RETENTION_DAYS = 90
+
+# The events of the activity counters are spooled here until the flush_counters command stores them.
+COUNTER_SPOOL_DIR = abspath(LIVE_DIR, "spool", "counters")
+
+# Seconds after which the spool files of an unfinished counter flush are taken over.
+COUNTER_FLUSH_TIMEOUT = 3600
+
 # How frequently do we update the counts for authenticated users.
 SESSION_UPDATE_SECONDS = 10 * 60
 SESSION_COOKIE_NAME = "biostar2"
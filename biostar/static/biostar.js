@@ -201,12 +201,34 @@ $(document).ready(function () {
         tagval.removeClass("textinput textInput form-control")
         tagval.width("96%")
 
-        var tag_list = $.ajax({
-            url: "/local/search/tags/",
-            dataType: 'json',
-            success: function (response) {
-                tagval.select2({
-                    tags: response
+        // Suggestions complete the typed text and follow the tags chosen so far.
+        tagval.select2({
+            multiple: true,
+            tokenSeparators: [","],
+            initSelection: function (element, callback) {
+                var data = [];
+                $.each(element.val().split(","), function (index, name) {
+                    if (name) {
+                        data.push({id: name, text: name});
+                    }
+                });
+                callback(data);
+            },
+            createSearchChoice: function (term) {
+                return {id: term, text: term};
+            },
+            query: function (query) {
+                $.ajax({
+                    url: "/local/search/tags/",
+                    dataType: 'json',
+                    data: {q: query.term, chosen: tagval.val()},
+                    success: function (response) {
+                        query.callback({
+                            results: $.map(response, function (name) {
+                                return {id: name, text: name};
+                            })
+                        });
+                    }
                 });
             }
         });
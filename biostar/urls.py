@@ -117,6 +117,8 @@ urlpatterns = patterns('',
     url(r'^api/stats/day/(?P<day>\d+)/$', api.daily_stats_on_day, name='api-stats-on-day'),
     url(r'^api/stats/date/(?P<year>\d{4})/(?P<month>\d{2})/(?P<day>\d{2})/$',
         api.daily_stats_on_date, name='api-stats-on-date'),
+    url(r'^api/stats/range/(?P<start>\d{4}-\d{2}-\d{2})/(?P<end>\d{4}-\d{2}-\d{2})/$',
+        api.daily_stats_in_range, name='api-stats-in-range'),
 
     # Uncomment the next line to enable the admin:
     url(r'^admin/', include(admin.site.urls)),